@@ -0,0 +1,392 @@
+# audit_writer.py – batched and background audit log writes
+
+import atexit
+import glob
+import json
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from typing import Callable, Dict, List, Tuple
+
+from resilience import is_transient
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+def _try_lock(path: str):
+    """Open ``path`` and lock it exclusively without waiting.
+
+    Returns the open file (the lock lasts until it is closed or the process
+    exits), or None if another process holds the lock.
+    """
+    f = open(path, "a+")
+    try:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        f.close()
+        return None
+    return f
+
+
+def _read_spill(path: str) -> List[Dict]:
+    rows = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                rows.append(json.loads(line))
+    return rows
+
+
+class AuditBuffer:
+    """Collects audit rows for one logical operation and writes them in bulk.
+
+    Rows are handed to ``write_rows`` (one bulk insert) when the buffer
+    reaches ``max_events``, when the oldest buffered row is older than
+    ``max_age`` seconds, or when ``flush()`` is called at the end of the
+    operation.
+    """
+
+    def __init__(self, write_rows: Callable[[List[Dict]], bool],
+                 max_events: int = 50, max_age: float = 2.0):
+        self.write_rows = write_rows
+        self.max_events = max_events
+        self.max_age = max_age
+        self.rows: List[Dict] = []
+        self._oldest = None
+
+    def add(self, row: Dict) -> bool:
+        if not self.rows:
+            self._oldest = time.monotonic()
+        self.rows.append(row)
+
+        if len(self.rows) >= self.max_events or time.monotonic() - self._oldest >= self.max_age:
+            return self.flush()
+        return True
+
+    def flush(self) -> bool:
+        if not self.rows:
+            return True
+        rows, self.rows = self.rows, []
+        self._oldest = None
+        return self.write_rows(rows)
+
+
+class AuditQueue:
+    """Bounded in-process audit queue drained by a background flush thread.
+
+    ``put_many`` returns as soon as the rows are queued, so the Streamlit
+    script thread never waits on the database. When the queue is full the
+    caller is held for up to ``put_timeout`` seconds (backpressure) and rows
+    that still do not fit are dropped and counted.
+
+    Every queued row is also appended to ``spill_path``. After each
+    successful flush the file is rewritten with only the rows still
+    pending, and rows found there at start-up are re-queued. Events
+    therefore survive a crash, delivered at least once.
+
+    The spill file belongs to one process at a time, through a lock on
+    ``<spill_path>.lock``. A process that finds it taken (e.g. a CLI
+    script started next to the app) spills to its own
+    ``<name>.<pid><ext>`` instead. At start-up, private spill files whose
+    owner is gone are re-queued and removed.
+
+    ``write_rows`` returns True or raises. A transient failure (see
+    resilience.is_transient), or a False return, puts the batch back in
+    front to be retried. Any other exception means the database rejected
+    the rows. The batch is then retried row by row, and rows that still
+    fail go to ``<name>.rejected<ext>`` with their error instead of
+    blocking the queue.
+    """
+
+    def __init__(self, write_rows: Callable[[List[Dict]], bool], spill_path: str = "audit_spool.jsonl",
+                 maxsize: int = 5000, batch_size: int = 200, flush_interval: float = 1.0,
+                 put_timeout: float = 0.5):
+        self.write_rows = write_rows
+        self.spill_path = spill_path
+        root, ext = os.path.splitext(spill_path)
+        self.dead_letter_path = f"{root}.rejected{ext}"
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+
+        self._pending = deque()
+        self._inflight: List[Dict] = []
+        self._cond = threading.Condition()
+        self._closing = False
+
+        self.queued = 0
+        self.flushed = 0
+        self.dropped = 0
+        self.recovered = 0
+        self.failed_flushes = 0
+        self.dead_lettered = 0
+        self.flushes = 0
+        self.last_flush_ms = 0.0
+        self.total_flush_ms = 0.0
+
+        self.spill_path, self._spill_lock, self._private_spill = self._claim_spill(spill_path)
+        self._recover_spill()
+        self._adopt_orphans(spill_path)
+        self._thread = threading.Thread(target=self._run, name="audit-flush", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    # ------------------------------------------------------------------
+    # Producer side
+    # ------------------------------------------------------------------
+    def put_many(self, rows: List[Dict]) -> bool:
+        """Queue rows for the flush thread; False if any had to be dropped"""
+        accepted = []
+        with self._cond:
+            deadline = time.monotonic() + self.put_timeout
+            for i, row in enumerate(rows):
+                while len(self._pending) >= self.maxsize:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.notify_all()
+                    self._cond.wait(remaining)
+
+                if len(self._pending) >= self.maxsize:
+                    self.dropped += len(rows) - i
+                    print(f"Audit queue full: dropped {len(rows) - i} audit events")
+                    break
+
+                self._pending.append(row)
+                accepted.append(row)
+
+            self._spill_append(accepted)
+            self.queued += len(accepted)
+            if accepted:
+                self._cond.notify_all()
+
+        return len(accepted) == len(rows)
+
+    # ------------------------------------------------------------------
+    # Flush thread
+    # ------------------------------------------------------------------
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closing:
+                    self._cond.wait()
+                if not self._pending and self._closing:
+                    return
+
+                # Give a partial batch up to one interval to fill up
+                deadline = time.monotonic() + self.flush_interval
+                while len(self._pending) < self.batch_size and not self._closing:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+
+                count = min(self.batch_size, len(self._pending))
+                batch = [self._pending.popleft() for _ in range(count)]
+                self._inflight = batch
+                self._cond.notify_all()
+
+            start = time.perf_counter()
+            retry, rejected = self._deliver(batch)
+            elapsed_ms = (time.perf_counter() - start) * 1000
+
+            with self._cond:
+                self._inflight = []
+                self.flushed += len(batch) - len(retry) - len(rejected)
+                if rejected:
+                    self._dead_letter(rejected)
+                if not retry:
+                    self.flushes += 1
+                    self.last_flush_ms = elapsed_ms
+                    self.total_flush_ms += elapsed_ms
+                if retry:
+                    # Put the undelivered rows back in front
+                    self.failed_flushes += 1
+                    self._pending.extendleft(reversed(retry))
+                if len(retry) < len(batch):
+                    self._rewrite_spill()
+                if retry:
+                    # ... and retry them after an interval
+                    if not self._closing:
+                        self._cond.wait(self.flush_interval)
+                    else:
+                        return
+
+    def _deliver(self, batch: List[Dict]) -> Tuple[List[Dict], List[Tuple[Dict, Exception]]]:
+        """Write ``batch``; returns (rows to retry later, (row, error) pairs the database rejected)"""
+        try:
+            return ([] if self.write_rows(batch) else batch), []
+        except Exception as e:
+            if is_transient(e):
+                print("Audit flush error:", e)
+                return batch, []
+            print(f"Audit batch of {len(batch)} rejected, retrying row by row:", e)
+
+        rejected = []
+        for index, row in enumerate(batch):
+            try:
+                if not self.write_rows([row]):
+                    return batch[index:], rejected
+            except Exception as e:
+                if is_transient(e):
+                    print("Audit flush error:", e)
+                    return batch[index:], rejected
+                rejected.append((row, e))
+        return [], rejected
+
+    def close(self, timeout: float = 10.0):
+        """Stop accepting work once everything queued has been flushed (or timeout)"""
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+        with self._cond:
+            done = not self._pending and not self._inflight
+        if done and self._private_spill:
+            # Nothing left to recover: do not leave a per-process file behind
+            self._remove_spill(self.spill_path, self._spill_lock)
+            self._spill_lock = None
+
+    # ------------------------------------------------------------------
+    # Spill file
+    # ------------------------------------------------------------------
+    def _spill_append(self, rows: List[Dict]):
+        if not rows:
+            return
+        try:
+            with open(self.spill_path, "a", encoding="utf-8") as f:
+                for row in rows:
+                    f.write(json.dumps(row, default=str) + "\n")
+                f.flush()
+        except OSError as e:
+            print("Audit spill write error:", e)
+
+    def _dead_letter(self, rejected: List[Tuple[Dict, Exception]]):
+        self.dead_lettered += len(rejected)
+        print(f"Audit: {len(rejected)} rejected events moved to {self.dead_letter_path}")
+        try:
+            with open(self.dead_letter_path, "a", encoding="utf-8") as f:
+                for row, error in rejected:
+                    entry = {"rejected_at": datetime.now().isoformat(), "error": str(error), "row": row}
+                    f.write(json.dumps(entry, default=str) + "\n")
+        except OSError as e:
+            print("Audit dead-letter write error:", e)
+
+    def _rewrite_spill(self):
+        try:
+            unflushed = list(self._inflight) + list(self._pending)
+            tmp_path = f"{self.spill_path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                for row in unflushed:
+                    f.write(json.dumps(row, default=str) + "\n")
+            os.replace(tmp_path, self.spill_path)
+        except OSError as e:
+            print("Audit spill rewrite error:", e)
+
+    @staticmethod
+    def _claim_spill(spill_path: str):
+        """(path, lock file, private?) for this process: ``spill_path`` if no
+        other process owns it, else a per-process file next to it"""
+        lock = _try_lock(f"{spill_path}.lock")
+        if lock is not None:
+            return spill_path, lock, False
+        root, ext = os.path.splitext(spill_path)
+        private_path = f"{root}.{os.getpid()}{ext}"
+        print(f"Audit spill {spill_path} is in use by another process, spilling to {private_path}")
+        return private_path, _try_lock(f"{private_path}.lock"), True
+
+    def _recover_spill(self):
+        if not os.path.exists(self.spill_path):
+            return
+        try:
+            rows = _read_spill(self.spill_path)
+        except (OSError, ValueError) as e:
+            print("Audit spill recovery error:", e)
+            return
+        self._pending.extend(rows)
+        self.recovered += len(rows)
+        if rows:
+            print(f"Recovered {len(rows)} unflushed audit events from {self.spill_path}")
+
+    def _adopt_orphans(self, spill_path: str):
+        """Re-queue the private spill files of processes that exited without flushing"""
+        root, ext = os.path.splitext(spill_path)
+        for path in glob.glob(f"{glob.escape(root)}.*{ext}"):
+            if path == self.spill_path or not path[len(root) + 1:-len(ext) or None].isdigit():
+                continue
+            lock = _try_lock(f"{path}.lock")
+            if lock is None:
+                continue  # its process is still running
+            try:
+                rows = _read_spill(path)
+            except (OSError, ValueError) as e:
+                print("Audit spill recovery error:", e)
+                lock.close()
+                continue
+            self._pending.extend(rows)
+            self.recovered += len(rows)
+            self._rewrite_spill()
+            self._remove_spill(path, lock)
+            if rows:
+                print(f"Recovered {len(rows)} unflushed audit events from {path}")
+
+    @staticmethod
+    def _remove_spill(path: str, lock):
+        for stale in (path, f"{path}.lock"):
+            try:
+                os.remove(stale)
+            except OSError:
+                pass
+        if lock is not None:
+            lock.close()
+
+    # ------------------------------------------------------------------
+    # Counters
+    # ------------------------------------------------------------------
+    def stats(self) -> Dict:
+        with self._cond:
+            return {
+                "queued": self.queued,
+                "flushed": self.flushed,
+                "dropped": self.dropped,
+                "recovered": self.recovered,
+                "pending": len(self._pending) + len(self._inflight),
+                "failed_flushes": self.failed_flushes,
+                "dead_lettered": self.dead_lettered,
+                "last_flush_ms": round(self.last_flush_ms, 1),
+                "avg_flush_ms": round(self.total_flush_ms / self.flushes, 1) if self.flushes else 0.0,
+            }
+
+
+# One queue per spill file for the whole process: several SupabaseDatabase
+# instances must not drain (and rewrite) the same file concurrently. Each
+# file belongs to one backend; its rows must not reach another one.
+_queues: Dict[str, Tuple[object, AuditQueue]] = {}
+_queues_lock = threading.Lock()
+
+
+def shared_audit_queue(write_rows: Callable[[List[Dict]], bool],
+                       spill_path: str = "audit_spool.jsonl", owner=None, **kwargs) -> AuditQueue:
+    """Return the process-wide AuditQueue for ``spill_path``, starting it on first use.
+
+    ``owner`` is the backend ``write_rows`` writes to. Asking for a spill
+    file that already has a queue for a different owner raises ValueError.
+    """
+    key = os.path.abspath(spill_path)
+    with _queues_lock:
+        if key not in _queues:
+            _queues[key] = (owner, AuditQueue(write_rows, spill_path=spill_path, **kwargs))
+        queue_owner, queue = _queues[key]
+        if queue_owner is not owner:
+            raise ValueError(f"Audit spill file {spill_path} is already used by another backend's queue")
+        return queue
@@ -1,6 +1,6 @@
 # auth_simple.py - FIXED: session state preserved across reruns
 import streamlit as st
-from supabase_db import SupabaseDatabase
+from supabase_db import get_database
 import base64
 import pandas as pd
 
@@ -12,12 +12,11 @@ class SimpleAuth:
         print("=== DEBUG SimpleAuth.__init__() ===")
 
     def get_db(self):
-        """Create Supabase connection only when needed"""
+        """Use the process-wide database connection (shared with main_app)"""
         print("=== DEBUG SimpleAuth.get_db() ===")
         if self.db is None:
-            print("Creating new SupabaseDatabase instance...")
-            self.db = SupabaseDatabase()
-            print("✅ SupabaseDatabase instance created")
+            self.db = get_database()
+            print("✅ Shared SupabaseDatabase instance attached")
         return self.db
 
     def get_logo_base64(self):
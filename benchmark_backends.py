@@ -0,0 +1,46 @@
+# benchmark_backends.py
+import statistics
+import sys
+import time
+
+from supabase_db import get_database
+
+
+READ_CALLS = [
+    ("get_inventory", lambda db: db.get_inventory()),
+    ("get_usage_stats", lambda db: db.get_usage_stats()),
+    ("get_expired_items", lambda db: db.get_expired_items()),
+    ("get_audit_logs", lambda db: db.get_audit_logs(limit=200)),
+    ("get_all_users", lambda db: db.get_all_users()),
+]
+
+
+def benchmark_backend(engine: str, repeats: int = 5):
+    print(f"\n⏱️  Backend: {engine}")
+    print("-" * 60)
+
+    try:
+        db = get_database(engine)
+    except Exception as e:
+        print(f"❌ Could not open {engine} backend: {e}")
+        return
+
+    for name, call in READ_CALLS:
+        timings = []
+        rows = 0
+        for _ in range(repeats):
+            start = time.perf_counter()
+            result = call(db)
+            timings.append((time.perf_counter() - start) * 1000)
+            rows = len(result)
+        print(f"{name:<20} median {statistics.median(timings):8.1f} ms   "
+              f"max {max(timings):8.1f} ms   rows {rows}")
+
+
+if __name__ == "__main__":
+    engines = sys.argv[1:] or ["supabase", "sqlite"]
+    print("📊 Storage backend read latency")
+    print("=" * 60)
+    for engine in engines:
+        benchmark_backend(engine)
+    print("=" * 60)
@@ -0,0 +1,86 @@
+# category_rules.py – item categorisation from keyword rules, shared by the importer and the Add Item form
+
+import json
+import os
+import re
+import threading
+from functools import lru_cache
+from typing import Dict, List, Tuple
+
+import pandas as pd
+
+# Rules file; CATEGORY_RULES_FILE points at a site-specific copy
+RULES_PATH = os.getenv(
+    "CATEGORY_RULES_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "category_rules.json")
+)
+
+
+class CategoryRules:
+    """Keyword rules compiled into a single regex.
+
+    Rules are in priority order: a name gets the category of the first
+    rule with a keyword anywhere in the lower-cased name, or ``default``.
+    All keywords form one alternation inside a lookahead, listed in rule
+    order, so one ``findall`` pass reports at each position the
+    highest-priority keyword starting there (overlapping keywords
+    included). The best of those decides. Results are memoised per name.
+    """
+
+    def __init__(self, rules: List[Tuple[str, List[str]]], default: str = "General Supplies",
+                 cache_size: int = 8192):
+        self.rules = [(category, [k.lower() for k in keywords]) for category, keywords in rules]
+        self.default = default
+
+        self._priority: Dict[str, int] = {}
+        for index, (_, keywords) in enumerate(self.rules):
+            for keyword in keywords:
+                self._priority.setdefault(keyword, index)
+
+        alternation = "|".join(re.escape(k) for k in self._priority)
+        self._pattern = re.compile(f"(?=({alternation}))") if alternation else None
+        self.classify = lru_cache(maxsize=cache_size)(self._classify)
+
+    @classmethod
+    def from_file(cls, path: str = RULES_PATH) -> "CategoryRules":
+        with open(path, encoding="utf-8") as f:
+            config = json.load(f)
+        rules = [(rule["category"], rule.get("keywords", [])) for rule in config.get("rules", [])]
+        return cls(rules, default=config.get("default", "General Supplies"))
+
+    @property
+    def categories(self) -> List[str]:
+        """Every category the rules can produce, in rule order, default last"""
+        categories = list(dict.fromkeys(category for category, _ in self.rules))
+        if self.default not in categories:
+            categories.append(self.default)
+        return categories
+
+    def _classify(self, name: str) -> str:
+        if self._pattern is None:
+            return self.default
+        best = None
+        for keyword in self._pattern.findall(str(name).lower()):
+            priority = self._priority[keyword]
+            if best is None or priority < best:
+                best = priority
+                if best == 0:
+                    break
+        return self.default if best is None else self.rules[best][0]
+
+    def classify_many(self, names) -> pd.Series:
+        """Category per name for a Series/list, classifying each distinct name once"""
+        names = pd.Series(names).astype(str)
+        return names.map({name: self.classify(name) for name in names.unique()})
+
+
+_rules = None
+_rules_lock = threading.Lock()
+
+
+def get_category_rules() -> CategoryRules:
+    """Process-wide rules from RULES_PATH, loaded on first use"""
+    global _rules
+    with _rules_lock:
+        if _rules is None:
+            _rules = CategoryRules.from_file()
+        return _rules
@@ -1,12 +1,13 @@
 # check_tables.py
-from supabase_db import SupabaseDatabase
+from supabase_db import get_database
 import streamlit as st
 
 def check_database_tables():
     print("🔍 Checking database tables...")
     print("=" * 60)
     
-    db = SupabaseDatabase()
+    db = get_database()
+    print(f"Storage backend: {db.backend.name}")
     
     # Check inventory table
     try:
@@ -17,20 +18,28 @@ def check_database_tables():
     
     # Check usage_logs table
     try:
-        response = db.supabase.table("usage_logs").select("id", count="exact").limit(1).execute()
-        print(f"✅ Usage logs table exists")
+        usage_count = db.backend.count("usage_logs")
+        print(f"✅ Usage logs table exists ({usage_count} rows)")
     except Exception as e:
         print(f"❌ Usage logs table error: {e}")
         print("   Run the SQL script to create usage_logs table")
     
     # Check audit_logs table
     try:
-        response = db.supabase.table("audit_logs").select("id", count="exact").limit(1).execute()
-        print(f"✅ Audit logs table exists")
+        audit_count = db.backend.count("audit_logs")
+        print(f"✅ Audit logs table exists ({audit_count} rows)")
     except Exception as e:
         print(f"❌ Audit logs table error: {e}")
         print("   Run the SQL script to create audit_logs table")
     
+    # Check server-side objects from supabase_migrations.sql
+    try:
+        db.backend.select("usage_stats_by_item", limit=1)
+        print(f"✅ usage_stats_by_item view exists")
+    except Exception as e:
+        print(f"❌ usage_stats_by_item view error: {e}")
+        print("   Run supabase_migrations.sql in the Supabase SQL editor")
+    
     # Check users table
     try:
         users = db.get_all_users()
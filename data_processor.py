@@ -1,9 +1,60 @@
 # data_processor.py
 import pandas as pd
+import numpy as np
+import io
+import multiprocessing
+import os
 import re
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
+from itertools import repeat
+
+from openpyxl import load_workbook
+
+from category_rules import get_category_rules
+
+# Columns of the frame load_excel_data returns (the inventory table's import columns)
+PROCESSED_COLUMNS = ['item_id', 'item_name', 'category', 'quantity', 'unit', 'expiry_date',
+                     'storage_location', 'supplier', 'reorder_level', 'status']
+
+# Cell texts pd.read_excel reads as missing; the streaming reader does the same
+NA_STRINGS = {'', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN',
+              '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null'}
+
+# File types load_data accepts (also the importer's uploader filter)
+IMPORT_TYPES = ['xlsx', 'xls', 'csv', 'parquet']
+
+
+def _as_stream(source):
+    """File object for a path, file object or bytes, positioned at the start"""
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return io.BytesIO(source)
+    if hasattr(source, 'seek'):
+        source.seek(0)
+    return source
+
+
+def _read_sheet(source, sheet, chunk_size):
+    """Raw rows of one sheet (process pool worker for load_workbook_data)"""
+    chunks = list(DataProcessor.iter_excel_rows(source, chunk_size, sheet=sheet))
+    return pd.concat(chunks) if chunks else pd.DataFrame()
+
+
+def _concat(chunks):
+    chunks = [chunk for chunk in chunks if not chunk.empty]
+    if not chunks:
+        return pd.DataFrame(columns=PROCESSED_COLUMNS)
+    return pd.concat(chunks, ignore_index=True)
+
 
 class DataProcessor:
+    # Rows per streamed chunk (Excel, CSV and Parquet readers)
+    CHUNK_SIZE = 5000
+    # Workbooks smaller than this are read in-process; starting workers costs more
+    PARALLEL_MIN_BYTES = 1_000_000
+    
     @staticmethod
     def parse_quantity_string(quantity_str):
         """Parse quantity strings like '3packs (200per pack)' and return total units only"""
@@ -19,78 +70,226 @@ class DataProcessor:
             return 0
     
     @staticmethod
-    def load_excel_data(file_path):
-        """Load and process Excel data - returns units only"""
-        df = pd.read_excel(file_path)
-        
-        # Process data with units only
-        parsed_data = []
-        for index, row in df.iterrows():
-            # Skip rows with missing item names
-            if pd.isna(row.get('Item')):
-                continue
-                
-            # Get total units - use the value from 'Total Units' column
-            total_units = 0
-            if 'Total Units' in row and not pd.isna(row['Total Units']):
-                try:
-                    total_units = int(row['Total Units'])
-                except:
-                    total_units = 0
-            
-            # Extract category from item name (more comprehensive)
-            item_lower = str(row['Item']).lower()
-            
-            if any(x in item_lower for x in ['glove', 'mask', 'gown']):
-                category = 'PPE'
-            elif any(x in item_lower for x in ['silica', 'desiccant']):
-                category = 'Desiccants'
-            elif any(x in item_lower for x in ['needle', 'syringe', 'lancet']):
-                category = 'Medical Devices'
-            elif any(x in item_lower for x in ['tube', 'vial', 'pipette', 'petri', 'falcon']):
-                category = 'Labware'
-            elif any(x in item_lower for x in ['agar', 'broth', 'medium', 'buffer', 'solution', 'acid', 'base']):
-                category = 'Reagents'
-            elif any(x in item_lower for x in ['paper', 'filter', 'slide', 'cover', 'container']):
-                category = 'Consumables'
-            elif any(x in item_lower for x in ['methanol', 'chloroform', 'glycerol', 'giemsa', 'tryzol']):
-                category = 'Chemicals'
-            elif any(x in item_lower for x in ['scale', 'thermometer', 'microscope', 'pipette aid']):
-                category = 'Equipment'
-            elif any(x in item_lower for x in ['box', 'bag', 'rack', 'holder']):
-                category = 'Packaging'
-            else:
-                category = 'General Supplies'
-            
-            # Generate item ID
-            item_id = f"BIO-{category[:3].upper()}-{str(index + 1).zfill(4)}"
+    def load_data(source, file_name, workers: int = None):
+        """Load and process an inventory file, picking the reader from ``file_name``'s extension.
+        
+        Every format gives the same columns (PROCESSED_COLUMNS): CSV and
+        Parquet are read in chunks, workbooks sheet by sheet (see
+        load_workbook_data).
+        """
+        extension = os.path.splitext(file_name)[1].lower().lstrip('.')
+        if extension in ('xlsx', 'xls'):
+            return DataProcessor.load_workbook_data(source, workers)
+        if extension == 'csv':
+            return _concat(DataProcessor.process_chunks(DataProcessor.iter_csv_rows(source)))
+        if extension == 'parquet':
+            return _concat(DataProcessor.process_chunks(DataProcessor.iter_parquet_rows(source)))
+        raise ValueError(f"Unsupported file type '{extension}' (expected one of: {', '.join(IMPORT_TYPES)})")
+    
+    @staticmethod
+    def load_excel_data(source):
+        """Load and process Excel data - returns units only
+        
+        ``source`` is a path, a file object (e.g. a Streamlit upload) or the
+        file's bytes. Only the first sheet is read; see load_workbook_data.
+        """
+        return _concat(DataProcessor.iter_excel_data(source))
+    
+    @staticmethod
+    def load_workbook_data(source, workers: int = None):
+        """Load and process every sheet of a workbook, one storage location per sheet.
+        
+        Rows are tagged with their sheet name as ``storage_location`` and
+        numbered across the whole workbook, so item IDs stay unique between
+        sheets. Sheets are parsed concurrently in a process pool of up to
+        ``workers`` processes (default: CPU count). A single-sheet workbook
+        gives the same rows as load_excel_data.
+        """
+        if hasattr(source, 'read'):
+            source = _as_stream(source).read()
+        sheets = DataProcessor.excel_sheet_names(source)
+        if len(sheets) <= 1:
+            return DataProcessor.load_excel_data(source)
+        
+        size = len(source) if isinstance(source, (bytes, bytearray)) else os.path.getsize(source)
+        workers = min(len(sheets), workers or os.cpu_count() or 1)
+        frames = None
+        if workers > 1 and size >= DataProcessor.PARALLEL_MIN_BYTES:
+            try:
+                # Spawned, not forked: the Streamlit server process is multi-threaded
+                with ProcessPoolExecutor(max_workers=workers,
+                                         mp_context=multiprocessing.get_context('spawn')) as pool:
+                    frames = list(pool.map(_read_sheet, repeat(source), sheets, repeat(DataProcessor.CHUNK_SIZE)))
+            except (BrokenProcessPool, OSError) as e:
+                print("Parallel sheet parsing unavailable, reading sheets in-process:", e)
+        if frames is None:
+            frames = [_read_sheet(source, sheet, DataProcessor.CHUNK_SIZE) for sheet in sheets]
+        
+        processed, offset = [], 0
+        for sheet, frame in zip(sheets, frames):
+            frame.index = frame.index + offset
+            offset += len(frame)
+            processed.append(DataProcessor.process_rows(frame, storage_location=sheet))
+        return _concat(processed)
+    
+    @staticmethod
+    def excel_sheet_names(source):
+        """Sheet names of a workbook, in workbook order"""
+        source = _as_stream(source)
+        if not zipfile.is_zipfile(source):
+            return pd.ExcelFile(_as_stream(source)).sheet_names
+        workbook = load_workbook(_as_stream(source), read_only=True)
+        try:
+            return list(workbook.sheetnames)
+        finally:
+            workbook.close()
+    
+    @staticmethod
+    def iter_excel_data(source, chunk_size: int = None):
+        """Processed chunks of the first sheet (see process_rows), streamed"""
+        return DataProcessor.process_chunks(DataProcessor.iter_excel_rows(source, chunk_size))
+    
+    @staticmethod
+    def process_chunks(chunks, storage_location: str = None):
+        """process_rows over raw chunks, skipping chunks with nothing to import"""
+        for chunk in chunks:
+            processed = DataProcessor.process_rows(chunk, storage_location)
+            if not processed.empty:
+                yield processed
+    
+    @staticmethod
+    def iter_csv_rows(source, chunk_size: int = None):
+        """Yield a CSV file as raw DataFrame chunks, indexed by data row position"""
+        reader = pd.read_csv(_as_stream(source), chunksize=chunk_size or DataProcessor.CHUNK_SIZE)
+        with reader:
+            yield from reader
+    
+    @staticmethod
+    def iter_parquet_rows(source, chunk_size: int = None):
+        """Yield a Parquet file as raw DataFrame chunks (needs pyarrow), indexed by row position"""
+        import pyarrow.parquet as pq
+        
+        offset = 0
+        for batch in pq.ParquetFile(_as_stream(source)).iter_batches(batch_size=chunk_size or DataProcessor.CHUNK_SIZE):
+            chunk = batch.to_pandas()
+            chunk.index = range(offset, offset + len(chunk))
+            offset += len(chunk)
+            yield chunk
+    
+    @staticmethod
+    def iter_excel_rows(source, chunk_size: int = None, sheet=0):
+        """Yield one sheet (index or name) as raw DataFrame chunks of up to ``chunk_size`` rows.
+        
+        ``source`` is a path, a file object or bytes. .xlsx sheets are streamed with
+        openpyxl's read-only mode, so memory stays flat however long the sheet
+        is. The first row is the header, as with pd.read_excel, and every chunk
+        is indexed by data row position so IDs stay the same across chunks.
+        Legacy .xls files are read whole and then chunked.
+        """
+        chunk_size = chunk_size or DataProcessor.CHUNK_SIZE
+        source = _as_stream(source)
+        
+        if not zipfile.is_zipfile(source):
+            df = pd.read_excel(_as_stream(source), sheet_name=sheet)
+            for start in range(0, len(df), chunk_size):
+                yield df.iloc[start:start + chunk_size]
+            return
+        
+        workbook = load_workbook(_as_stream(source), read_only=True, data_only=True)
+        try:
+            worksheet = workbook[sheet] if isinstance(sheet, str) else workbook.worksheets[sheet]
+            rows = worksheet.iter_rows(values_only=True)
+            header = next(rows, None)
+            if header is None:
+                return
+            columns = [name if name is not None else f"Unnamed: {i}" for i, name in enumerate(header)]
+            width = len(columns)
             
-            # Handle expiry date - make it optional
-            expiry_date = None
-            if 'Expiry Date' in row and not pd.isna(row['Expiry Date']):
-                try:
-                    # Try to parse date
-                    if isinstance(row['Expiry Date'], (datetime, pd.Timestamp)):
-                        expiry_date = row['Expiry Date'].strftime('%Y-%m-%d')
-                    else:
-                        expiry_date = str(row['Expiry Date'])
-                except:
-                    expiry_date = None
+            offset, batch = 0, []
+            for row in rows:
+                # Read-only rows can be ragged; pad or trim to the header
+                row = tuple(None if isinstance(value, str) and value in NA_STRINGS else value
+                            for value in row[:width])
+                batch.append(row + (None,) * (width - len(row)))
+                if len(batch) == chunk_size:
+                    yield pd.DataFrame.from_records(batch, columns=columns,
+                                                    index=range(offset, offset + len(batch)))
+                    offset, batch = offset + len(batch), []
             
-            parsed_data.append({
-                'item_id': item_id,
-                'item_name': str(row['Item']).strip(),
-                'category': category,
-                'quantity': int(total_units),  # Store as quantity (units)
-                'unit': str(row.get('Unit', 'Units')).strip(),
-                'expiry_date': expiry_date,
-                'storage_location': 'Main Store',
-                'supplier': 'Standard Supplier',
-                'reorder_level': 50,  # Default reorder level in units
-                'status': 'Active'
-            })
-        
-        return pd.DataFrame(parsed_data)
+            # Drop trailing blank rows, as pd.read_excel does
+            while batch and all(value is None for value in batch[-1]):
+                batch.pop()
+            if batch:
+                yield pd.DataFrame.from_records(batch, columns=columns,
+                                                index=range(offset, offset + len(batch)))
+        finally:
+            workbook.close()
+    
+    @staticmethod
+    def process_rows(df, storage_location: str = None):
+        """Turn raw sheet rows (Item, Total Units, Unit, Expiry Date) into inventory rows"""
+        # Skip rows with missing item names (IDs still follow the sheet row)
+        if 'Item' not in df.columns:
+            return pd.DataFrame(columns=PROCESSED_COLUMNS)
+        df = df[df['Item'].notna()]
+        if df.empty:
+            return pd.DataFrame(columns=PROCESSED_COLUMNS)
+        
+        items = df['Item'].astype(str)
+        row_numbers = pd.Series(df.index + 1, index=df.index)
+        
+        # Get total units - use the value from 'Total Units' column
+        if 'Total Units' in df.columns:
+            total_units = pd.to_numeric(df['Total Units'], errors='coerce').fillna(0)
+            total_units = np.trunc(total_units).astype('int64')
+        else:
+            total_units = pd.Series(0, index=df.index, dtype='int64')
+        
+        category = DataProcessor.categorize(items)
+        
+        # Generate item ID
+        item_id = ('BIO-' + category.str[:3].str.upper() + '-'
+                   + row_numbers.astype(str).str.zfill(4))
+        
+        if 'Unit' in df.columns:
+            unit = df['Unit'].astype(str).str.strip().where(df['Unit'].notna(), 'Units')
+        else:
+            unit = 'Units'
+        
+        return pd.DataFrame({
+            'item_id': item_id,
+            'item_name': items.str.strip(),
+            'category': category,
+            'quantity': total_units,  # Store as quantity (units)
+            'unit': unit,
+            'expiry_date': DataProcessor.normalize_expiry(df.get('Expiry Date')),
+            'storage_location': storage_location or 'Main Store',
+            'supplier': 'Standard Supplier',
+            'reorder_level': 50,  # Default reorder level in units
+            'status': 'Active'
+        }, columns=PROCESSED_COLUMNS).reset_index(drop=True)
+    
+    @staticmethod
+    def categorize(items):
+        """Category for each item name from the rules in category_rules.json"""
+        return get_category_rules().classify_many(items)
+    
+    @staticmethod
+    def normalize_expiry(values):
+        """Expiry values as strings: date cells as 'YYYY-MM-DD', text kept as written, blanks as None"""
+        if values is None:
+            return None
+        if pd.api.types.is_datetime64_any_dtype(values):
+            dates = values
+        else:
+            # Only real date cells are reformatted. Text is never parsed: guessing
+            # the order of e.g. "06/08/2026" would silently swap day and month
+            is_date = values.map(lambda value: isinstance(value, (datetime, pd.Timestamp)))
+            dates = pd.to_datetime(values.where(is_date), errors='coerce')
+        
+        expiry = values.astype(str).where(values.notna(), None)
+        expiry = expiry.where(dates.isna(), dates.dt.strftime('%Y-%m-%d'))
+        return expiry.astype(object).where(expiry.notna(), None)
     
     @staticmethod
     def calculate_metrics(df):
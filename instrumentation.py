@@ -0,0 +1,219 @@
+# instrumentation.py – per-call latency, row and payload metrics for SupabaseDatabase
+
+import functools
+import inspect
+import math
+import os
+import threading
+import time
+from collections import deque
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Dict, List
+
+import pandas as pd
+
+# Tab/action the current Streamlit run is serving; set once per rerun by main_app
+_caller: ContextVar = ContextVar("db_caller", default="unknown")
+
+# Open instrumented calls on this thread; HTTP byte counts are added to each
+_active = threading.local()
+
+
+def set_caller(caller: str):
+    """Attribute database calls made by the current run to ``caller``"""
+    _caller.set(caller)
+
+
+def add_bytes(count: int):
+    """Credit bytes received to every instrumented call open on this thread"""
+    for frame in getattr(_active, "frames", []):
+        frame["bytes"] += count
+
+
+def _push_frame() -> Dict:
+    frame = {"bytes": 0}
+    _active.__dict__.setdefault("frames", []).append(frame)
+    return frame
+
+
+def _pop_frame(frame: Dict):
+    # By identity: open frames are equal-looking dicts
+    frames = _active.frames
+    for index in range(len(frames) - 1, -1, -1):
+        if frames[index] is frame:
+            del frames[index]
+            return
+
+
+def _percentile(values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of an already sorted list"""
+    if not values:
+        return 0.0
+    index = max(0, math.ceil(pct * len(values)) - 1)
+    return values[index]
+
+
+def _row_count(result):
+    if isinstance(result, (pd.DataFrame, list)):
+        return len(result)
+    return None
+
+
+class QueryMetrics:
+    """Ring buffer of recent database calls with p50/p95 summaries.
+
+    With ``metrics_path`` set, a Prometheus-style text snapshot is written
+    there at most every ``write_interval`` seconds, for scraping.
+    """
+
+    def __init__(self, capacity: int = 2000, metrics_path: str = None, write_interval: float = 10.0):
+        self.records = deque(maxlen=capacity)
+        self.metrics_path = metrics_path
+        self.write_interval = write_interval
+        self._last_write = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, method: str, seconds: float, rows=None, nbytes: int = 0, ok: bool = True):
+        entry = {
+            "time": datetime.now(),
+            "caller": _caller.get(),
+            "method": method,
+            "ms": seconds * 1000,
+            "rows": rows,
+            "bytes": nbytes,
+            "ok": ok,
+        }
+        with self._lock:
+            self.records.append(entry)
+            due = self.metrics_path and time.monotonic() - self._last_write >= self.write_interval
+            if due:
+                self._last_write = time.monotonic()
+        if due:
+            self.write_text()
+
+    def recent(self, limit: int = 50) -> pd.DataFrame:
+        with self._lock:
+            rows = list(self.records)[-limit:]
+        return pd.DataFrame(rows[::-1])
+
+    def summary(self) -> pd.DataFrame:
+        """One row per method: calls, errors, p50/p95/max ms, avg rows, total bytes"""
+        with self._lock:
+            records = list(self.records)
+
+        by_method: Dict[str, List[Dict]] = {}
+        for entry in records:
+            by_method.setdefault(entry["method"], []).append(entry)
+
+        summary = []
+        for method, entries in by_method.items():
+            durations = sorted(e["ms"] for e in entries)
+            row_counts = [e["rows"] for e in entries if e["rows"] is not None]
+            summary.append({
+                "method": method,
+                "calls": len(entries),
+                "errors": sum(1 for e in entries if not e["ok"]),
+                "p50_ms": round(_percentile(durations, 0.50), 1),
+                "p95_ms": round(_percentile(durations, 0.95), 1),
+                "max_ms": round(durations[-1], 1),
+                "avg_rows": round(sum(row_counts) / len(row_counts), 1) if row_counts else None,
+                "bytes": sum(e["bytes"] for e in entries),
+                "callers": ", ".join(sorted({e["caller"] for e in entries})),
+            })
+
+        frame = pd.DataFrame(summary)
+        if not frame.empty:
+            frame = frame.sort_values("p95_ms", ascending=False, ignore_index=True)
+        return frame
+
+    def to_text(self) -> str:
+        """Prometheus text exposition of the summary (covers the ring buffer window)"""
+        lines = [
+            "# HELP dashboard_db_call_ms Latency of SupabaseDatabase calls in the recent window",
+            "# TYPE dashboard_db_call_ms summary",
+        ]
+        summary = self.summary()
+        for row in summary.to_dict("records"):
+            label = f'method="{row["method"]}"'
+            lines.append(f'dashboard_db_call_ms{{{label},quantile="0.5"}} {row["p50_ms"]}')
+            lines.append(f'dashboard_db_call_ms{{{label},quantile="0.95"}} {row["p95_ms"]}')
+            lines.append(f'dashboard_db_call_ms_count{{{label}}} {row["calls"]}')
+        for metric, column, help_text in [
+            ("dashboard_db_call_errors", "errors", "Failed SupabaseDatabase calls in the recent window"),
+            ("dashboard_db_bytes_received", "bytes", "HTTP bytes received by SupabaseDatabase calls in the recent window"),
+        ]:
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} gauge")
+            for row in summary.to_dict("records"):
+                lines.append(f'{metric}{{method="{row["method"]}"}} {row[column]}')
+        return "\n".join(lines) + "\n"
+
+    def write_text(self):
+        try:
+            tmp_path = f"{self.metrics_path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(self.to_text())
+            os.replace(tmp_path, self.metrics_path)
+        except OSError as e:
+            print("Metrics write error:", e)
+
+
+# Process-wide collector; main_app and the CLI scripts read from it
+metrics = QueryMetrics(metrics_path=os.getenv("STORAGE_METRICS_FILE", "db_metrics.prom"))
+
+
+def _timed(name: str, func):
+    if inspect.isgeneratorfunction(func):
+        @functools.wraps(func)
+        def generator_wrapper(*args, **kwargs):
+            nbytes, rows, ok, elapsed = 0, 0, True, 0.0
+            generator = func(*args, **kwargs)
+            try:
+                while True:
+                    # Time only the work done inside the generator, not the consumer
+                    frame = _push_frame()
+                    start = time.perf_counter()
+                    try:
+                        item = next(generator)
+                    except StopIteration:
+                        return
+                    finally:
+                        elapsed += time.perf_counter() - start
+                        _pop_frame(frame)
+                        nbytes += frame["bytes"]
+                    rows += _row_count(item) or 0
+                    yield item
+            except Exception:
+                ok = False
+                raise
+            finally:
+                metrics.record(name, elapsed, rows, nbytes, ok)
+        return generator_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        frame = _push_frame()
+        start = time.perf_counter()
+        result, ok = None, True
+        try:
+            result = func(*args, **kwargs)
+            return result
+        except Exception:
+            ok = False
+            raise
+        finally:
+            _pop_frame(frame)
+            metrics.record(name, time.perf_counter() - start, _row_count(result), frame["bytes"], ok)
+    return wrapper
+
+
+def instrumented(exclude=()):
+    """Class decorator: time every public method of the class into ``metrics``"""
+    def decorate(cls):
+        for attr, value in list(vars(cls).items()):
+            if attr.startswith("_") or attr in exclude or not inspect.isfunction(value):
+                continue
+            setattr(cls, attr, _timed(attr, value))
+        return cls
+    return decorate
@@ -0,0 +1,153 @@
+# inventory_sync.py – incremental inventory refresh from updated_at watermarks and tombstones
+
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Dict
+
+import pandas as pd
+
+from resilience import CircuitOpenError, is_transient
+from storage_backends import StorageBackend
+
+
+class InventorySync:
+    """Resident copy of the inventory table, kept current with delta queries.
+
+    The first refresh loads the whole table. Later refreshes ask only for
+    rows with ``updated_at`` after the watermark and for item_ids in
+    ``inventory_tombstones`` (filled by a delete trigger) deleted after it,
+    and merge both into the resident frame by item_id. Refresh cost
+    therefore follows the number of changes, not the table size.
+
+    The watermark is the newest server timestamp seen, less ``lookback``
+    seconds, so a row committed late by a concurrent transaction is still
+    picked up. Rows fetched twice are simply merged again. A full reload
+    runs every ``full_every`` seconds as a safety net.
+    """
+
+    def __init__(self, backend: StorageBackend, page_size: int = 1000,
+                 lookback: float = 5.0, full_every: float = 3600.0):
+        self.backend = backend
+        self.page_size = page_size
+        self.lookback = lookback
+        self.full_every = full_every
+        self._frame = None
+        self._watermark = None
+        self._full_at = 0.0
+        self._lock = threading.Lock()
+
+        self.full_loads = 0
+        self.delta_syncs = 0
+        self.rows_fetched = 0
+        self.rows_deleted = 0
+        self.last_sync = None
+
+    def refresh(self) -> pd.DataFrame:
+        """Bring the resident copy up to date and return it, ordered by item_id"""
+        with self._lock:
+            if (self._frame is None or self._watermark is None
+                    or time.monotonic() - self._full_at >= self.full_every):
+                self._full_load()
+            else:
+                try:
+                    self._apply_delta()
+                except Exception as e:
+                    if not (isinstance(e, CircuitOpenError) or is_transient(e)):
+                        # e.g. updated_at or the tombstone table not migrated yet
+                        print("Inventory delta sync unavailable, reloading in full:", e)
+                        self._full_load()
+                    else:
+                        # Backend unreachable: the last synced copy is the best we have
+                        print("Inventory delta sync failed, keeping last synced copy:", e)
+            return self._frame.reset_index()
+
+    def apply(self, update: Callable[[pd.DataFrame], pd.DataFrame]):
+        """Apply a local write to the resident copy (``update`` maps the
+        refresh() frame to its new value, like a ReadCache patch)"""
+        with self._lock:
+            if self._frame is None:
+                return
+            try:
+                self._frame = self._indexed(update(self._frame.reset_index()))
+            except Exception as e:
+                print("Resident inventory patch failed, reloading on next refresh:", e)
+                self._frame = None
+                self._watermark = None
+
+    def reset(self):
+        """Forget the resident copy; the next refresh reloads the table"""
+        with self._lock:
+            self._frame = None
+            self._watermark = None
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "rows": 0 if self._frame is None else len(self._frame),
+                "full_loads": self.full_loads,
+                "delta_syncs": self.delta_syncs,
+                "rows_fetched": self.rows_fetched,
+                "rows_deleted": self.rows_deleted,
+                "watermark": self._watermark.isoformat(timespec="milliseconds") if self._watermark else None,
+                "last_sync": self.last_sync,
+            }
+
+    # ------------------------------------------------------------------
+    # Loading
+    # ------------------------------------------------------------------
+    def _full_load(self):
+        rows = []
+        for page in self.backend.iter_pages("inventory", "item_id", page_size=self.page_size):
+            rows.extend(page)
+
+        frame = pd.DataFrame(rows)
+        self._frame = self._indexed(frame)
+        self._watermark = self._newest(frame, "updated_at")
+        self._full_at = time.monotonic()
+        self.full_loads += 1
+        self.rows_fetched += len(rows)
+        self.last_sync = datetime.now()
+
+    def _apply_delta(self):
+        since = (self._watermark - timedelta(seconds=self.lookback)).isoformat(timespec="milliseconds")
+
+        changed = []
+        for page in self.backend.iter_pages("inventory", "item_id", filters=[("updated_at", "gt", since)],
+                                            page_size=self.page_size):
+            changed.extend(page)
+        deleted = self.backend.select("inventory_tombstones", "item_id, deleted_at",
+                                      filters=[("deleted_at", "gt", since)])
+
+        frame = self._frame
+        if deleted:
+            gone = frame.index.intersection([row["item_id"] for row in deleted])
+            frame = frame.drop(index=gone)
+            self.rows_deleted += len(gone)
+        if changed:
+            updates = pd.DataFrame(changed).set_index("item_id")
+            frame = pd.concat([frame.drop(index=frame.index.intersection(updates.index)), updates])
+            frame = frame.sort_index()
+
+        self._frame = frame
+        newest = [self._watermark,
+                  self._newest(pd.DataFrame(changed), "updated_at"),
+                  self._newest(pd.DataFrame(deleted), "deleted_at")]
+        self._watermark = max(ts for ts in newest if ts is not None)
+        self.delta_syncs += 1
+        self.rows_fetched += len(changed)
+        self.last_sync = datetime.now()
+
+    @staticmethod
+    def _indexed(frame: pd.DataFrame) -> pd.DataFrame:
+        # Always keyed by item_id, so refresh() returns an item_id column even for an empty table
+        if "item_id" not in frame.columns:
+            return pd.DataFrame(index=pd.Index([], name="item_id"))
+        return frame.set_index("item_id")
+
+    @staticmethod
+    def _newest(frame: pd.DataFrame, column: str):
+        if frame.empty or column not in frame.columns:
+            return None
+        newest = pd.to_datetime(frame[column], utc=True, format="ISO8601", errors="coerce").max()
+        return None if pd.isna(newest) else newest.to_pydatetime()
@@ -6,13 +6,17 @@ import plotly.graph_objects as go
 from datetime import datetime, timedelta
 import numpy as np
 from auth_simple import SimpleAuth
-from supabase_db import SupabaseDatabase
-from data_processor import DataProcessor
+from supabase_db import get_database
+from request_context import get_request_context
+from instrumentation import metrics as db_metrics, set_caller
+from data_processor import DataProcessor, IMPORT_TYPES
+from category_rules import get_category_rules
 from dotenv import load_dotenv
 from PIL import Image
 import io
 import os
 import base64
+import hashlib
 import time
 import json
 
@@ -41,28 +45,16 @@ user = auth.check_auth()
 if not user:
     st.stop()
 
-@st.cache_resource(ttl=300)  # Cache for 5 minutes
-def get_database():
-    return SupabaseDatabase()
-
+# One process-wide client (pooled keep-alive connections), shared with SimpleAuth
 db = get_database()
 
-# Ensure get_usage_trends method exists
-if not hasattr(db, 'get_usage_trends'):
-    # Add the missing method
-    def get_usage_trends_fallback(self):
-        """Fallback method for get_usage_trends"""
-        try:
-            # Try to get usage stats as fallback
-            return self.get_usage_stats()
-        except:
-            return pd.DataFrame()
-    
-    # Add the method to the db instance
-    db.get_usage_trends = lambda: get_usage_trends_fallback(db)
+# This session's IP / user agent, passed to every write for audit attribution
+request_ctx = get_request_context()
 
 # Initialize systems
 processor = DataProcessor()
+category_rules = get_category_rules()
+AUTO_CATEGORY = "Auto (from item name)"
 
 # Get Supabase credentials from Streamlit secrets or environment
 def get_supabase_creds():
@@ -76,37 +68,50 @@ def get_supabase_creds():
 
 # Get client info function
 def get_client_info():
-    """Get client IP and user agent"""
-    import streamlit as st
-    
-    # Try to get IP from various sources
-    ip_address = "Unknown"
-    user_agent = "Unknown"
-    
-    try:
-        # Get headers from Streamlit request context
-        ctx = st.runtime.get_instance()._session_mgr.list_active_sessions()[0].request
-        if hasattr(ctx, 'headers'):
-            headers = ctx.headers
-            ip_address = headers.get('X-Forwarded-For', headers.get('Remote-Addr', 'Unknown'))
-            user_agent = headers.get('User-Agent', 'Unknown')
-    except:
-        pass
-    
-    return ip_address, user_agent
+    """Get client IP and user agent of this session (captured once per session)"""
+    context = get_request_context()
+    return context.ip_address or "Unknown", context.user_agent or "Unknown"
 
 # Logo function matching VC.py
 def get_base64_of_image(image_path):
     with open(image_path, "rb") as f:
         return base64.b64encode(f.read()).decode()
 
-# Load data with caching
-@st.cache_data(ttl=60)  # Cache for 60 seconds
+# Stream DataFrame pages into one CSV without building the full table first
+def frames_to_csv(frames):
+    buffer = io.StringIO()
+    for i, frame in enumerate(frames):
+        frame.to_csv(buffer, index=False, header=(i == 0))
+    return buffer.getvalue()
+
+# Parse an upload once: the processed frame is kept in session state under a
+# hash of the file's content and name (the extension picks the reader), so
+# preview, validation and import reruns reuse it
+def parse_upload(uploaded_file):
+    data = uploaded_file.getvalue()
+    digest = hashlib.sha256(data)
+    digest.update(uploaded_file.name.encode())
+    digest = digest.hexdigest()
+    parsed = st.session_state.get('import_parse')
+    if parsed is None or parsed['digest'] != digest:
+        # Only the latest upload is kept
+        parsed = {'digest': digest, 'frame': processor.load_data(data, uploaded_file.name)}
+        st.session_state.import_parse = parsed
+    return parsed['frame'].copy()
+
+# Served from the data layer's shared read cache; writes patch it in place
 def load_inventory_data():
     return db.get_inventory()
 
+# One tiny query per rerun: cached reads are refetched only for tables whose
+# data version moved since the last run
+db.check_data_versions()
 inventory_df = load_inventory_data()
 
+if db.is_degraded():
+    st.warning("⚠️ The database is not responding. Showing the last data loaded successfully; "
+               "changes may fail until the connection recovers.")
+
 # FIX: Use quantity column directly (don't rename)
 if 'quantity' not in inventory_df.columns:
     # If database has different column name, adjust here
@@ -172,6 +177,9 @@ tab_mapping = {
 st.session_state.active_tab = tab_mapping[selected_tab]
 active_tab = st.session_state.active_tab
 
+# Attribute this run's database calls to the tab being rendered
+set_caller(active_tab)
+
 # ========== UPDATED CUSTOM CSS WITH NEW SIDEBAR STYLING ==========
 st.markdown("""
     <style>
@@ -652,7 +660,7 @@ with st.sidebar:
     st.markdown("### ⚡ Quick Actions")
     
     if st.button("🔄 Refresh Data", use_container_width=True, type="secondary"):
-        st.cache_data.clear()
+        db.cache.invalidate()
         st.rerun()
     
     if st.button("📥 Export Current", use_container_width=True, type="secondary"):
@@ -906,13 +914,10 @@ elif active_tab == "Inventory":
             
             with col1:
                 item_name = st.text_input("Item Name*", placeholder="e.g., Sterile Gloves")
-                # Expanded category options
-                category_options = [
-                    "PPE", "Desiccants", "Medical Devices", "Labware", 
-                    "Reagents", "Chemicals", "Consumables", "Equipment", 
-                    "Packaging", "General Supplies"
-                ]
-                category = st.selectbox("Category*", category_options)
+                # Categories come from category_rules.json, same as the importer
+                category_options = [AUTO_CATEGORY] + category_rules.categories
+                category = st.selectbox("Category*", category_options,
+                                        help="Auto picks the category the importer would give this item name")
                 quantity = st.number_input("Quantity (Units)*", min_value=1, value=100, step=1,
                                         help="Total number of units")
             
@@ -935,6 +940,9 @@ elif active_tab == "Inventory":
                 if not item_name:
                     st.error("Item Name is required!")
                 else:
+                    if category == AUTO_CATEGORY:
+                        category = category_rules.classify(item_name)
+                    
                     item_id = f"BIO-{category[:3].upper()}-{datetime.now().strftime('%Y%m%d')}-{len(inventory_df)+1:04d}"
                     
                     item_data = {
@@ -955,9 +963,8 @@ elif active_tab == "Inventory":
                     # Get client info for audit
                     ip_address, user_agent = get_client_info()
                     
-                    if db.add_inventory_item(item_data, user):
-                        st.success(f"✅ Item '{item_name}' added successfully!")
-                        st.cache_data.clear()
+                    if db.add_inventory_item(item_data, user, context=request_ctx):
+                        st.success(f"✅ Item '{item_name}' added successfully as {category}!")
                         st.rerun()
                     else:
                         st.error("❌ Failed to add item.")
@@ -985,11 +992,7 @@ elif active_tab == "Inventory":
                                                 index=["Main Store", "Lab A", "Lab B", "Cold Room", "Quarantine", "Archive"]
                                                 .index(item_data.get('storage_location', 'Main Store')))
                         # Add category editing
-                        category_options = [
-                            "PPE", "Desiccants", "Medical Devices", "Labware", 
-                            "Reagents", "Chemicals", "Consumables", "Equipment", 
-                            "Packaging", "General Supplies"
-                        ]
+                        category_options = list(category_rules.categories)
                         current_category = item_data.get('category', 'General Supplies')
                         if current_category not in category_options:
                             category_options.append(current_category)
@@ -1066,12 +1069,18 @@ elif active_tab == "Inventory":
                             # Get client info for audit
                             ip_address, user_agent = get_client_info()
                             
-                            if db.update_inventory_item(item_data['item_id'], updates, user):
+                            # Conditional on the version this form was loaded with
+                            result = db.update_inventory_item(item_data['item_id'], updates, user,
+                                                              original=item_data, context=request_ctx)
+                            if result:
                                 st.success("✅ Item updated successfully!")
-                                st.cache_data.clear()
                                 st.rerun()
+                            elif result.status == "conflict":
+                                # The cached row was replaced with the current one, so the
+                                # next run of the form shows fresh data (and version)
+                                st.warning(f"⚠️ {result.message}")
                             else:
-                                st.error("❌ Failed to update item.")
+                                st.error(f"❌ Failed to update item. {result.message}")
                         else:
                             st.info("No changes were made to the item.")
     
@@ -1119,9 +1128,9 @@ elif active_tab == "Inventory":
                         ip_address, user_agent = get_client_info()
                         
                         # Delete the item
-                        if db.delete_inventory_item(item_data['item_id'], user, delete_reason):
+                        if db.delete_inventory_item(item_data['item_id'], user, delete_reason,
+                                                    context=request_ctx):
                             st.success(f"✅ Item '{item_to_delete}' has been deleted successfully!")
-                            st.cache_data.clear()
                             time.sleep(1)
                             st.rerun()
                         else:
@@ -1190,12 +1199,10 @@ elif active_tab == "Usage":
                             
                             # Show loading spinner
                             with st.spinner("Logging usage..."):
-                                success = db.log_usage(usage_data, user)
+                                success = db.log_usage(usage_data, user, context=request_ctx)
                             
                             if success:
                                 st.success(f"✅ Usage of {units_used} units logged successfully!")
-                                # Force refresh data
-                                st.cache_data.clear()
                                 st.rerun()
                             else:
                                 st.error("❌ Failed to log usage.")
@@ -1340,148 +1347,130 @@ elif active_tab == "Usage":
             
             # Try to get usage trends data
             try:
-                detailed_usage_df = db.get_usage_trends()
+                # Time period selector
+                col1, col2, col3 = st.columns(3)
+                with col1:
+                    time_period = st.selectbox("Time Period", 
+                                             ["Daily", "Weekly", "Monthly", "Quarterly"])
+                with col2:
+                    chart_type = st.selectbox("Chart Type", 
+                                            ["Line Chart", "Bar Chart", "Area Chart"])
+                with col3:
+                    top_n = st.slider("Top N Items", 5, 20, 10)
+                
+                # Window over the full usage history; bucketing happens in the database
+                col_d1, col_d2 = st.columns(2)
+                with col_d1:
+                    trend_start = st.date_input("From", value=datetime.now().date() - timedelta(days=365),
+                                                key="trend_start")
+                with col_d2:
+                    trend_end = st.date_input("To", value=datetime.now().date(), key="trend_end")
+                window_end = trend_end + timedelta(days=1)  # inclusive end date
                 
-                if detailed_usage_df is None or detailed_usage_df.empty:
-                    st.info("No usage data available for trend analysis. Start logging usage to see trends.")
+                # Item selector (items with any logged usage)
+                usage_totals = db.get_usage_stats()
+                if 'item_name' in usage_totals.columns:
+                    all_items = sorted(usage_totals['item_name'].dropna().unique().tolist())
                 else:
-                    # Process the data
-                    if 'usage_date' in detailed_usage_df.columns:
-                        # Convert to datetime and extract time components
-                        detailed_usage_df['usage_date'] = pd.to_datetime(detailed_usage_df['usage_date'])
-                        detailed_usage_df['usage_month'] = detailed_usage_df['usage_date'].dt.strftime('%Y-%m')
-                        detailed_usage_df['usage_week'] = detailed_usage_df['usage_date'].dt.strftime('%Y-%W')
-                        detailed_usage_df['day_of_week'] = detailed_usage_df['usage_date'].dt.day_name()
-                    
-                    # Time period selector
-                    col1, col2, col3 = st.columns(3)
-                    with col1:
-                        time_period = st.selectbox("Time Period", 
-                                                 ["Daily", "Weekly", "Monthly", "Quarterly"])
-                    with col2:
-                        chart_type = st.selectbox("Chart Type", 
-                                                ["Line Chart", "Bar Chart", "Area Chart"])
-                    with col3:
-                        top_n = st.slider("Top N Items", 5, 20, 10)
+                    all_items = []
+                
+                selected_items = st.multiselect("Select specific items (or leave empty for all)", 
+                                              all_items)
+                
+                granularity = {"Daily": "day", "Weekly": "week",
+                               "Monthly": "month", "Quarterly": "quarter"}[time_period]
+                title_suffix = time_period
+                trend_df = db.get_usage_trends(trend_start, window_end, granularity,
+                                               items=selected_items or None, top_n=top_n)
+                
+                if trend_df is None or trend_df.empty:
+                    st.info("No usage data in this period for trend analysis. Start logging usage to see trends.")
+                else:
+                    x_col = 'bucket'
                     
-                    # Item selector
-                    if 'item_name' in detailed_usage_df.columns:
-                        all_items = detailed_usage_df['item_name'].unique().tolist()
-                    else:
-                        all_items = []
+                    # Create trend chart
+                    st.markdown(f"##### 📊 {title_suffix} Usage Trends (Top {top_n} Items)")
                     
-                    selected_items = st.multiselect("Select specific items (or leave empty for all)", 
-                                                  all_items)
+                    if chart_type == "Line Chart":
+                        fig = px.line(
+                            trend_df,
+                            x=x_col,
+                            y='units_used',
+                            color='item_name',
+                            title=f"{title_suffix} Usage Trends",
+                            labels={'units_used': 'Units Used', x_col: 'Date'},
+                            markers=True
+                        )
+                    elif chart_type == "Bar Chart":
+                        fig = px.bar(
+                            trend_df,
+                            x=x_col,
+                            y='units_used',
+                            color='item_name',
+                            title=f"{title_suffix} Usage Trends",
+                            labels={'units_used': 'Units Used', x_col: 'Date'},
+                            barmode='stack'
+                        )
+                    else:  # Area Chart
+                        fig = px.area(
+                            trend_df,
+                            x=x_col,
+                            y='units_used',
+                            color='item_name',
+                            title=f"{title_suffix} Usage Trends",
+                            labels={'units_used': 'Units Used', x_col: 'Date'}
+                        )
                     
-                    if selected_items:
-                        filtered_df = detailed_usage_df[detailed_usage_df['item_name'].isin(selected_items)]
-                    else:
-                        filtered_df = detailed_usage_df
+                    fig.update_layout(
+                        height=500,
+                        plot_bgcolor='white',
+                        paper_bgcolor='white',
+                        hovermode='x unified',
+                        xaxis_title="Date",
+                        yaxis_title="Units Used",
+                        legend_title="Item Name"
+                    )
+                    st.plotly_chart(fig, use_container_width=True)
                     
-                    if not filtered_df.empty and 'units_used' in filtered_df.columns:
-                        # Group by time period
-                        if time_period == "Daily":
-                            grouped = filtered_df.groupby(['usage_date', 'item_name'])['units_used'].sum().reset_index()
-                            x_col = 'usage_date'
-                            title_suffix = "Daily"
-                        elif time_period == "Weekly":
-                            filtered_df['week_start'] = filtered_df['usage_date'] - pd.to_timedelta(filtered_df['usage_date'].dt.dayofweek, unit='D')
-                            grouped = filtered_df.groupby(['week_start', 'item_name'])['units_used'].sum().reset_index()
-                            x_col = 'week_start'
-                            title_suffix = "Weekly"
-                        elif time_period == "Monthly":
-                            filtered_df['month'] = filtered_df['usage_date'].dt.to_period('M').dt.to_timestamp()
-                            grouped = filtered_df.groupby(['month', 'item_name'])['units_used'].sum().reset_index()
-                            x_col = 'month'
-                            title_suffix = "Monthly"
-                        else:  # Quarterly
-                            filtered_df['quarter'] = filtered_df['usage_date'].dt.to_period('Q').dt.to_timestamp()
-                            grouped = filtered_df.groupby(['quarter', 'item_name'])['units_used'].sum().reset_index()
-                            x_col = 'quarter'
-                            title_suffix = "Quarterly"
+                    # Department-wise usage
+                    st.markdown("##### 🏢 Department-wise Usage")
+                    dept_usage = db.get_usage_breakdown(trend_start, window_end, "department",
+                                                        items=selected_items or None)
+                    if not dept_usage.empty:
+                        top_dept_items = dept_usage.groupby('item_name')['units_used'].sum().nlargest(10).index.tolist()
+                        dept_usage_filtered = dept_usage[dept_usage['item_name'].isin(top_dept_items)]
                         
-                        # Get top N items by total usage for the trend chart
-                        total_usage_by_item = filtered_df.groupby('item_name')['units_used'].sum().nlargest(top_n)
-                        top_items_list = total_usage_by_item.index.tolist()
-                        trend_df = grouped[grouped['item_name'].isin(top_items_list)]
-                        
-                        # Create trend chart
-                        if not trend_df.empty:
-                            st.markdown(f"##### 📊 {title_suffix} Usage Trends (Top {top_n} Items)")
-                            
-                            if chart_type == "Line Chart":
-                                fig = px.line(
-                                    trend_df,
-                                    x=x_col,
-                                    y='units_used',
-                                    color='item_name',
-                                    title=f"{title_suffix} Usage Trends",
-                                    labels={'units_used': 'Units Used', x_col: 'Date'},
-                                    markers=True
-                                )
-                            elif chart_type == "Bar Chart":
-                                fig = px.bar(
-                                    trend_df,
-                                    x=x_col,
-                                    y='units_used',
-                                    color='item_name',
-                                    title=f"{title_suffix} Usage Trends",
-                                    labels={'units_used': 'Units Used', x_col: 'Date'},
-                                    barmode='stack'
-                                )
-                            else:  # Area Chart
-                                fig = px.area(
-                                    trend_df,
-                                    x=x_col,
-                                    y='units_used',
-                                    color='item_name',
-                                    title=f"{title_suffix} Usage Trends",
-                                    labels={'units_used': 'Units Used', x_col: 'Date'}
-                                )
-                            
-                            fig.update_layout(
-                                height=500,
-                                plot_bgcolor='white',
-                                paper_bgcolor='white',
-                                hovermode='x unified',
-                                xaxis_title="Date",
-                                yaxis_title="Units Used",
-                                legend_title="Item Name"
+                        if not dept_usage_filtered.empty:
+                            fig2 = px.sunburst(
+                                dept_usage_filtered,
+                                path=['department', 'item_name'],
+                                values='units_used',
+                                title="Department-wise Usage Distribution",
+                                color='units_used',
+                                color_continuous_scale='Viridis'
                             )
-                            st.plotly_chart(fig, use_container_width=True)
-                        
-                        # Department-wise usage
-                        st.markdown("##### 🏢 Department-wise Usage")
-                        if 'department' in filtered_df.columns:
-                            dept_usage = filtered_df.groupby(['department', 'item_name'])['units_used'].sum().reset_index()
-                            top_dept_items = dept_usage.groupby('item_name')['units_used'].sum().nlargest(10).index.tolist()
-                            dept_usage_filtered = dept_usage[dept_usage['item_name'].isin(top_dept_items)]
-                            
-                            if not dept_usage_filtered.empty:
-                                fig2 = px.sunburst(
-                                    dept_usage_filtered,
-                                    path=['department', 'item_name'],
-                                    values='units_used',
-                                    title="Department-wise Usage Distribution",
-                                    color='units_used',
-                                    color_continuous_scale='Viridis'
-                                )
-                                fig2.update_layout(height=500)
-                                st.plotly_chart(fig2, use_container_width=True)
-                        
-                        # Usage heatmap by day of week and hour
-                        st.markdown("##### 🕒 Usage Patterns")
-                        col_h1, col_h2 = st.columns(2)
-                        
-                        with col_h1:
-                            # Day of week heatmap
-                            filtered_df['day_of_week'] = filtered_df['usage_date'].dt.day_name()
+                            fig2.update_layout(height=500)
+                            st.plotly_chart(fig2, use_container_width=True)
+                    
+                    # Usage heatmap by day of week
+                    st.markdown("##### 🕒 Usage Patterns")
+                    col_h1, col_h2 = st.columns(2)
+                    
+                    with col_h1:
+                        # Day of week heatmap (weekday 0 = Monday)
+                        day_usage = db.get_usage_breakdown(trend_start, window_end, "weekday",
+                                                           items=selected_items or None)
+                        if not day_usage.empty:
                             day_order = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
-                            filtered_df['day_of_week'] = pd.Categorical(filtered_df['day_of_week'], categories=day_order, ordered=True)
-                            day_usage = filtered_df.groupby(['day_of_week', 'item_name'])['units_used'].sum().reset_index()
+                            day_usage['day_of_week'] = pd.Categorical(
+                                day_usage['weekday'].map(dict(enumerate(day_order))),
+                                categories=day_order, ordered=True
+                            )
                             
                             # Pivot for heatmap
-                            day_pivot = day_usage.pivot(index='item_name', columns='day_of_week', values='units_used').fillna(0)
+                            day_pivot = day_usage.pivot_table(index='item_name', columns='day_of_week',
+                                                              values='units_used', aggfunc='sum',
+                                                              observed=True).fillna(0)
                             
                             if not day_pivot.empty:
                                 fig3 = px.imshow(
@@ -1493,38 +1482,37 @@ elif active_tab == "Usage":
                                 )
                                 fig3.update_layout(height=400)
                                 st.plotly_chart(fig3, use_container_width=True)
-                        
-                        with col_h2:
-                            # Purpose-wise breakdown
-                            if 'purpose' in filtered_df.columns:
-                                purpose_usage = filtered_df.groupby('purpose')['units_used'].sum().reset_index()
-                                purpose_usage = purpose_usage.sort_values('units_used', ascending=False).head(10)
-                                
-                                if not purpose_usage.empty:
-                                    fig4 = px.bar(
-                                        purpose_usage,
-                                        x='units_used',
-                                        y='purpose',
-                                        orientation='h',
-                                        color='units_used',
-                                        title="Top 10 Usage Purposes",
-                                        text='units_used'
-                                    )
-                                    fig4.update_traces(texttemplate='%{text:,}', textposition='outside')
-                                    fig4.update_layout(height=400, yaxis={'categoryorder':'total ascending'})
-                                    st.plotly_chart(fig4, use_container_width=True)
-                        
-                        # Export detailed trends
-                        st.markdown("##### 📥 Export Trend Data")
-                        csv = detailed_usage_df.to_csv(index=False)
-                        st.download_button(
-                            "💾 Download Detailed Usage Data",
-                            data=csv,
-                            file_name=f"usage_trends_{datetime.now().strftime('%Y%m%d')}.csv",
-                            mime="text/csv"
-                        )
-                    else:
-                        st.info("Usage data doesn't contain required columns for analysis.")
+                    
+                    with col_h2:
+                        # Purpose-wise breakdown
+                        purpose_usage = db.get_usage_breakdown(trend_start, window_end, "purpose",
+                                                               items=selected_items or None)
+                        if not purpose_usage.empty:
+                            purpose_usage = purpose_usage.groupby('purpose')['units_used'].sum().reset_index()
+                            purpose_usage = purpose_usage.sort_values('units_used', ascending=False).head(10)
+                            
+                            fig4 = px.bar(
+                                purpose_usage,
+                                x='units_used',
+                                y='purpose',
+                                orientation='h',
+                                color='units_used',
+                                title="Top 10 Usage Purposes",
+                                text='units_used'
+                            )
+                            fig4.update_traces(texttemplate='%{text:,}', textposition='outside')
+                            fig4.update_layout(height=400, yaxis={'categoryorder':'total ascending'})
+                            st.plotly_chart(fig4, use_container_width=True)
+                    
+                    # Export the bucketed series shown above
+                    st.markdown("##### 📥 Export Trend Data")
+                    csv = trend_df.to_csv(index=False)
+                    st.download_button(
+                        f"💾 Download {title_suffix} Usage Trends",
+                        data=csv,
+                        file_name=f"usage_trends_{granularity}_{datetime.now().strftime('%Y%m%d')}.csv",
+                        mime="text/csv"
+                    )
                         
             except AttributeError as e:
                 st.error(f"Database method error: {str(e)}")
@@ -1543,21 +1531,19 @@ elif active_tab == "Usage":
 elif active_tab == "Expiry":
     st.markdown('<div class="section-header"><h2>⏰ Expiry Management</h2></div>', unsafe_allow_html=True)
     
-    expired_items = db.get_expired_items()
-    
-    if not expired_items.empty and 'days_to_expiry' in expired_items.columns:
+    # Bucket counts are evaluated by the database; only displayed rows are fetched
+    expiry_counts = db.count_expiry_buckets()
+
+    if sum(expiry_counts.values()) > 0:
         # Status cards
         col1, col2, col3, col4 = st.columns(4)
-        
-        # Calculate counts for different expiry categories
-        expired = (expired_items['days_to_expiry'] <= 0).sum()
-        expiring_30 = ((expired_items['days_to_expiry'] > 0) & 
-                      (expired_items['days_to_expiry'] <= 30)).sum()
-        expiring_90 = ((expired_items['days_to_expiry'] > 30) & 
-                      (expired_items['days_to_expiry'] <= 90)).sum()
-        expiring_180 = ((expired_items['days_to_expiry'] > 90) & 
-                       (expired_items['days_to_expiry'] <= 180)).sum()
-        
+
+        # Counts for different expiry categories
+        expired = expiry_counts["Expired"]
+        expiring_30 = expiry_counts["< 30 days"]
+        expiring_90 = expiry_counts["30-90 days"]
+        expiring_180 = expiry_counts["90-180 days"]
+
         status_cards = [
             (col1, expired, "Expired", "#ef4444", "❌"),
             (col2, expiring_30, "< 30 Days", "#f59e0b", "⚠️"),
@@ -1580,22 +1566,10 @@ elif active_tab == "Expiry":
         # Expiry timeline
         st.markdown("#### 📅 Expiry Timeline")
         
-        # Categorize items
-        def categorize_expiry(days):
-            if days <= 0:
-                return "Expired"
-            elif days <= 30:
-                return "< 30 days"
-            elif days <= 90:
-                return "30-90 days"
-            elif days <= 180:
-                return "90-180 days"
-            else:
-                return "> 180 days"
-        
-        expired_items['expiry_category'] = expired_items['days_to_expiry'].apply(categorize_expiry)
-        category_counts = expired_items['expiry_category'].value_counts()
-        
+        # Non-empty expiry categories
+        category_counts = pd.Series(expiry_counts)
+        category_counts = category_counts[category_counts > 0]
+
         fig = px.bar(
             x=category_counts.index,
             y=category_counts.values,
@@ -1611,7 +1585,7 @@ elif active_tab == "Expiry":
         # Expired items table
         st.markdown("#### 🚨 Expired Items Requiring Action")
         
-        truly_expired = expired_items[expired_items['days_to_expiry'] <= 0]
+        truly_expired = db.get_expired_items(bucket="expired")
         if not truly_expired.empty:
             # Use the correct quantity column name
             quantity_col = 'quantity' if 'quantity' in truly_expired.columns else 'total_units'
@@ -1661,9 +1635,13 @@ elif active_tab == "Expiry":
                             new_qty = max(int(current_qty) - qty, 0)
                             updates = {'quantity': new_qty}
                             
-                            if db.update_inventory_item(item_data['item_id'], updates, user):
+                            result = db.update_inventory_item(item_data['item_id'], updates, user,
+                                                              original=item_data, context=request_ctx)
+                            if result:
                                 st.success(f"{qty} units of {selected_expired} marked for disposal.")
                                 st.info(f"Remaining stock: {new_qty} units")
+                            else:
+                                st.error(f"❌ {result.message or 'Failed to update item.'}")
                     
                     elif action == "Update Expiry":
                         new_expiry = st.date_input("New Expiry Date", 
@@ -1673,9 +1651,13 @@ elif active_tab == "Expiry":
                         
                         if st.button("📅 Update Expiry", type="primary"):
                             updates = {'expiry_date': new_expiry.strftime('%Y-%m-%d')}
-                            if db.update_inventory_item(item_data['item_id'], updates, user):
+                            result = db.update_inventory_item(item_data['item_id'], updates, user,
+                                                              original=item_data, context=request_ctx)
+                            if result:
                                 st.success("Expiry date updated!")
                                 st.rerun()
+                            else:
+                                st.error(f"❌ {result.message or 'Failed to update item.'}")
                     
                     elif action == "Extend Shelf Life":
                         st.info("""
@@ -1698,9 +1680,13 @@ elif active_tab == "Expiry":
                             new_expiry = pd.to_datetime(item_data['expiry_date']) + timedelta(days=extension_days)
                             updates = {'expiry_date': new_expiry.strftime('%Y-%m-%d')}
                             
-                            if db.update_inventory_item(item_data['item_id'], updates, user):
+                            result = db.update_inventory_item(item_data['item_id'], updates, user,
+                                                              original=item_data, context=request_ctx)
+                            if result:
                                 st.success(f"Shelf life extended by {extension_days} days!")
                                 st.rerun()
+                            else:
+                                st.error(f"❌ {result.message or 'Failed to update item.'}")
                 
                 with col2:
                     quantity = item_data.get('quantity') or item_data.get('total_units', 0)
@@ -1736,9 +1722,8 @@ elif active_tab == "Expiry":
         # Items expiring soon
         st.markdown("#### ⚠️ Items Expiring Soon (≤ 30 days)")
         
-        expiring_soon = expired_items[(expired_items['days_to_expiry'] > 0) & 
-                                     (expired_items['days_to_expiry'] <= 30)]
-        
+        expiring_soon = db.get_items_expiring_soon(days_threshold=30)
+
         if not expiring_soon.empty:
             # Sort by days to expiry
             expiring_soon = expiring_soon.sort_values('days_to_expiry')
@@ -1784,7 +1769,7 @@ elif active_tab == "Expiry":
         
         with col_e2:
             if st.button("Export All Expiry Data", use_container_width=True):
-                csv = expired_items.to_csv(index=False)
+                csv = db.get_expired_items().to_csv(index=False)
                 st.download_button(
                     "💾 Download CSV",
                     data=csv,
@@ -1793,11 +1778,8 @@ elif active_tab == "Expiry":
                 )
     
     else:
-        if expired_items.empty:
-            st.info("No items with expiry dates found in inventory.")
-        else:
-            st.info("Expiry data loaded but 'days_to_expiry' column not found. Check data structure.")
-        
+        st.info("No items with expiry dates found in inventory.")
+
         # Show how to add expiry dates
         with st.expander("📝 How to add expiry dates to items"):
             st.markdown("""
@@ -1979,6 +1961,7 @@ elif active_tab == "Analytics":
         
         with col3:
             if st.button("⏰ Expiry Report", use_container_width=True):
+                # Every item with an expiry date, expired or not
                 expired = db.get_expired_items()
                 if not expired.empty:
                     csv = expired.to_csv(index=False)
@@ -2199,24 +2182,40 @@ elif active_tab == "AuditTrails":
                 selected_record = st.text_input("Enter Record ID")
         
         if selected_record:
-            # Get audit history for this record - FIXED PARAMETERS
+            # Get audit history for this record in one indexed query, a page at a time
+            history_page_size = 100
+            cursor_key = f"history_before_{table_select}_{selected_record}"
+            history_before = st.session_state.get(cursor_key)
+            
+            history_total = db.count_audit_logs(table_name=table_select, record_id=selected_record)
             record_history = db.get_audit_logs(
                 table_name=table_select,
-                # Note: The method doesn't have a record_id parameter based on your supabase_db.py
-                # We need to filter after fetching
-                limit=50
+                record_id=selected_record,
+                limit=history_page_size,
+                before=history_before
             )
             
-            # Filter for the specific record
-            if not record_history.empty and 'record_id' in record_history.columns:
-                record_history = record_history[record_history['record_id'] == selected_record]
+            if history_total:
+                col_h1, col_h2, col_h3 = st.columns([3, 1, 1])
+                with col_h1:
+                    st.caption(f"{history_total:,} audit events for this record"
+                               f"{' (showing older events)' if history_before else ''}")
+                with col_h2:
+                    if history_before and st.button("⬅️ Newest", key=f"{cursor_key}_newest"):
+                        st.session_state[cursor_key] = None
+                        st.rerun()
+                with col_h3:
+                    if len(record_history) == history_page_size and st.button("Older ➡️", key=f"{cursor_key}_older"):
+                        last_event = record_history.iloc[-1]
+                        st.session_state[cursor_key] = (last_event['timestamp'], int(last_event['id']))
+                        st.rerun()
             
             if not record_history.empty:
                 # Display as timeline using Streamlit components
                 st.markdown(f"##### Timeline for {table_select}: {selected_record}")
                 
                 # Sort by timestamp (newest first)
-                record_history = record_history.sort_values('timestamp', ascending=False)
+                record_history = record_history.sort_values(['timestamp', 'id'], ascending=False)
                 record_history['timestamp'] = pd.to_datetime(record_history['timestamp']).dt.strftime('%Y-%m-%d %H:%M:%S')
                 
                 # Create expanders for each event
@@ -2963,7 +2962,7 @@ elif active_tab == "Settings":
         
         with col_m2:
             if st.button("🧹 Clear Cache", use_container_width=True):
-                st.cache_data.clear()
+                db.cache.invalidate()
                 st.success("Cache cleared successfully!")
         
         with col_m3:
@@ -2973,28 +2972,36 @@ elif active_tab == "Settings":
     with tab3:
         st.markdown("#### 📤 Data Import & Export")
         
-        import_tab1, import_tab2, import_tab3 = st.tabs(["Import Excel", "Export Data", "Backup"])
+        import_tab1, import_tab2, import_tab3 = st.tabs(["Import Data", "Export Data", "Backup"])
         
         with import_tab1:
-            st.markdown("##### 📥 Import from Excel")
+            st.markdown("##### 📥 Import from Excel, CSV or Parquet")
             
             st.info("""
-            **Supported Excel Format:**
+            **Supported Formats:** Excel (`.xlsx`, `.xls`), CSV and Parquet
             - Columns should include: `Item`, `Quantity`, `Unit`, `Expiry Date`
             - Example row: "Gloves", "600", "Units", "2024-12-31"
             - The system will import total units directly
+            - Workbooks with several sheets import every sheet, using the sheet name as the storage location
             """)
             
-            uploaded_file = st.file_uploader("Choose Excel file", 
-                                           type=['xlsx', 'xls'],
+            uploaded_file = st.file_uploader("Choose file", 
+                                           type=IMPORT_TYPES,
                                            key="excel_import")
             
             if uploaded_file:
                 try:
-                    # Preview data
-                    df = pd.read_excel(uploaded_file)
+                    # Parsed once per file content; reruns reuse the processed frame
+                    processed_df = parse_upload(uploaded_file)
                     st.write("**Preview of uploaded data:**")
-                    st.dataframe(df.head(), use_container_width=True)
+                    st.dataframe(processed_df.head(), use_container_width=True)
+                    
+                    # Validate against the parsed rows and the current inventory
+                    existing_ids = set(inventory_df['item_id']) if 'item_id' in inventory_df.columns else set()
+                    col_v1, col_v2, col_v3 = st.columns(3)
+                    col_v1.metric("Rows to Import", len(processed_df))
+                    col_v2.metric("Existing Item IDs", int(processed_df['item_id'].isin(existing_ids).sum()))
+                    col_v3.metric("Zero Quantity", int((processed_df['quantity'] == 0).sum()))
                     
                     # Import options
                     st.markdown("##### ⚙️ Import Options")
@@ -3012,27 +3019,24 @@ elif active_tab == "Settings":
                     
                     if st.button("🚀 Process and Import", type="primary"):
                         with st.spinner("Processing data..."):
-                            # Process the data
-                            processed_df = processor.load_excel_data(uploaded_file.name)
-                            
                             # Add supplier information
                             processed_df['supplier'] = default_supplier
                             
-                            # Import to database
-                            success_count = 0
-                            error_count = 0
-                            errors = []
-                            
-                            for _, row in processed_df.iterrows():
-                                try:
-                                    if db.add_inventory_item(row.to_dict()):
-                                        success_count += 1
-                                    else:
-                                        error_count += 1
-                                        errors.append(f"Failed to add: {row['item_name']}")
-                                except Exception as e:
-                                    error_count += 1
-                                    errors.append(f"Error with {row['item_name']}: {str(e)}")
+                            # Insert the parsed rows chunk by chunk
+                            success_count, error_count, errors = 0, 0, []
+                            progress = st.empty()
+                            for start in range(0, len(processed_df), processor.CHUNK_SIZE):
+                                chunk = processed_df.iloc[start:start + processor.CHUNK_SIZE]
+                                
+                                # Import to database in chunked multi-row inserts
+                                results = db.add_inventory_items(chunk, user=user, context=request_ctx)
+                                chunk_success = sum(1 for r in results if r['success'])
+                                success_count += chunk_success
+                                error_count += len(results) - chunk_success
+                                if len(errors) < 10:
+                                    errors += [f"Failed to add {r['item_id']}: {r['error']}"
+                                               for r in results if not r['success']][:10 - len(errors)]
+                                progress.caption(f"{success_count + error_count} rows processed...")
                             
                             # Show results
                             st.success(f"✅ Import completed!")
@@ -3041,13 +3045,13 @@ elif active_tab == "Settings":
                             
                             if errors:
                                 with st.expander("View Errors"):
-                                    for error in errors[:10]:  # Show first 10 errors
+                                    for error in errors:  # First 10 errors only
                                         st.error(error)
                             
                             st.rerun()
                 
                 except Exception as e:
-                    st.error(f"❌ Error reading Excel file: {str(e)}")
+                    st.error(f"❌ Error reading file: {str(e)}")
         
         with import_tab2:
             st.markdown("##### 📤 Export Data")
@@ -3056,8 +3060,7 @@ elif active_tab == "Settings":
             
             with col_e1:
                 if st.button("📋 Export Inventory", use_container_width=True):
-                    inventory_data = db.get_inventory()
-                    csv = inventory_data.to_csv(index=False)
+                    csv = frames_to_csv(db.iter_inventory())
                     st.download_button(
                         "💾 Download Inventory CSV",
                         data=csv,
@@ -3067,8 +3070,7 @@ elif active_tab == "Settings":
             
             with col_e2:
                 if st.button("📝 Export Usage Logs", use_container_width=True):
-                    usage_stats = db.get_usage_stats()
-                    csv = usage_stats.to_csv(index=False)
+                    csv = frames_to_csv(db.iter_usage_logs())
                     st.download_button(
                         "💾 Download Usage Logs CSV",
                         data=csv,
@@ -3190,6 +3192,24 @@ elif active_tab == "Settings":
             st.metric("Total Units in Stock", f"{total_units:,}")
             st.metric("System Users", users_count)
             st.metric("Database Size", "Supabase Cloud")
+            
+            # Last background health probe of the shared connection
+            db_health = db.health()
+            if db_health.get('backend'):
+                if db_health['healthy'] is None:
+                    health_label = "⏳ Checking"
+                elif db_health['healthy']:
+                    health_label = "✅ Reachable"
+                else:
+                    health_label = "❌ Unreachable"
+                st.metric("Database Health", health_label,
+                          delta=f"{db_health['latency_ms']} ms" if db_health['latency_ms'] is not None else None,
+                          delta_color="off")
+                if db_health['last_error']:
+                    st.caption(f"Last probe error: {db_health['last_error']}")
+            if 'circuit' in db_health:
+                st.caption(f"Circuit breaker: {db_health['circuit']} · "
+                           f"Reads served from last-known-good cache: {db_health['stale_reads']:,}")
         
         with col_s2:
             st.markdown("##### 🔧 Technical Information")
@@ -3212,27 +3232,74 @@ elif active_tab == "Settings":
             """)
         
         st.markdown("---")
-        st.markdown("##### 📈 System Logs")
-        
-        # Display recent activities (simulated)
-        activities = [
-            {"time": "10:30 AM", "user": "admin", "action": "Logged in", "details": "Successful login"},
-            {"time": "10:15 AM", "user": "jsmith", "action": "Updated item", "details": "Updated gloves quantity"},
-            {"time": "09:45 AM", "user": "admin", "action": "Added user", "details": "Added new manager"},
-            {"time": "Yesterday", "user": "system", "action": "Backup", "details": "Daily backup completed"},
-            {"time": "Yesterday", "user": "mjones", "action": "Logged usage", "details": "Used 50 units of gloves"}
-        ]
+        st.markdown("##### 🧾 Audit Queue")
+        
+        audit_stats = db.audit_queue_stats()
+        if audit_stats:
+            col_q1, col_q2, col_q3, col_q4, col_q5 = st.columns(5)
+            with col_q1:
+                st.metric("Queued", f"{audit_stats['queued']:,}")
+            with col_q2:
+                st.metric("Flushed", f"{audit_stats['flushed']:,}")
+            with col_q3:
+                st.metric("Pending", f"{audit_stats['pending']:,}")
+            with col_q4:
+                st.metric("Dropped", f"{audit_stats['dropped']:,}")
+            with col_q5:
+                st.metric("Avg Flush", f"{audit_stats['avg_flush_ms']:.1f} ms",
+                          delta=f"last {audit_stats['last_flush_ms']:.1f} ms", delta_color="off")
+            
+            if audit_stats['failed_flushes'] or audit_stats['recovered']:
+                st.caption(f"Failed flushes: {audit_stats['failed_flushes']} · "
+                           f"Recovered from spill file: {audit_stats['recovered']}")
+        else:
+            st.info("Audit events are written inline (background audit queue disabled).")
+        
+        st.caption(f"No-change edits (not stored): {db.audit_counters['update_attempts']:,} · "
+                   f"No-op audit events suppressed: {db.audit_counters['suppressed_noops']:,}")
+        
+        cache_stats = db.cache_stats()
+        st.caption(f"Read cache ({cache_stats['mode']}): {cache_stats['entries']} entries · "
+                   f"hit rate {cache_stats['hit_rate']:.0%} ({cache_stats['hits']:,} hits, "
+                   f"{cache_stats['misses']:,} misses) · {cache_stats['invalidations']:,} invalidations")
         
-        for activity in activities:
-            with st.container():
-                col_l1, col_l2, col_l3 = st.columns([1, 2, 3])
-                with col_l1:
-                    st.write(f"**{activity['time']}**")
-                with col_l2:
-                    st.write(f"**{activity['user']}** - {activity['action']}")
-                with col_l3:
-                    st.write(activity['details'])
-                st.markdown("---")
+        sync_stats = db.sync_stats()
+        st.caption(f"Inventory sync: {sync_stats['full_loads']} full loads, "
+                   f"{sync_stats['delta_syncs']:,} delta syncs · "
+                   f"{sync_stats['rows_fetched']:,} rows fetched for {sync_stats['rows']:,} resident items · "
+                   f"watermark {sync_stats['watermark'] or '—'}")
+        
+        st.markdown("---")
+        st.markdown("##### 📈 Query Performance")
+        st.caption(f"Database calls in this process (last {db_metrics.records.maxlen:,} calls), slowest p95 first")
+        
+        query_summary = db_metrics.summary()
+        if not query_summary.empty:
+            query_summary['KB received'] = (query_summary['bytes'] / 1024).round(1)
+            st.dataframe(
+                query_summary[['method', 'calls', 'errors', 'p50_ms', 'p95_ms', 'max_ms',
+                               'avg_rows', 'KB received', 'callers']],
+                use_container_width=True, hide_index=True
+            )
+            
+            st.markdown("##### 🕒 Recent Queries")
+            recent_queries = db_metrics.recent(50)
+            recent_queries['time'] = recent_queries['time'].dt.strftime('%H:%M:%S')
+            recent_queries['ms'] = recent_queries['ms'].round(1)
+            st.dataframe(recent_queries[['time', 'caller', 'method', 'ms', 'rows', 'bytes', 'ok']],
+                         use_container_width=True, hide_index=True, height=300)
+            
+            st.download_button(
+                label="📥 Download Metrics (Prometheus text)",
+                data=db_metrics.to_text(),
+                file_name="db_metrics.prom",
+                mime="text/plain"
+            )
+            if db_metrics.metrics_path:
+                st.caption(f"Also written to `{db_metrics.metrics_path}` every "
+                           f"{db_metrics.write_interval:.0f} s for scraping.")
+        else:
+            st.info("No database calls recorded yet.")
     
     with tab5:  # New Reset System Tab
         st.markdown("#### 🔄 Reset System Data")
@@ -3272,55 +3339,20 @@ elif active_tab == "Settings":
                                     # Get client info for audit
                                     ip_address, user_agent = get_client_info()
                                     
-                                    # 1. Reset all inventory quantities to default values
-                                    all_items = db.get_inventory()
-                                    reset_count = 0
-                                    
-                                    for _, item in all_items.iterrows():
-                                        # Set to default values based on category
-                                        category = str(item.get('category', '')).lower()
-                                        
-                                        if 'ppe' in category or 'glove' in str(item.get('item_name', '')).lower():
-                                            default_qty = 500
-                                        elif 'reagent' in category or 'chemical' in category:
-                                            default_qty = 100
-                                        elif 'device' in category or 'equipment' in category:
-                                            default_qty = 10
-                                        elif 'consumable' in category:
-                                            default_qty = 200
-                                        elif 'desiccant' in category:
-                                            default_qty = 300
-                                        else:
-                                            default_qty = 200  # General default
-                                        
-                                        # Update quantity
-                                        db.update_inventory_item(
-                                            item['item_id'], 
-                                            {'quantity': default_qty},
-                                            user
-                                        )
-                                        reset_count += 1
+                                    # 1. Reset all inventory quantities to category defaults
+                                    #    (one update per distinct quantity, one summary audit)
+                                    reset_count = db.reset_inventory_to_defaults(user, context=request_ctx)
                                     
                                     # 2. Clear usage logs (delete all usage entries)
-                                    # Note: This assumes there's a method to clear usage logs
-                                    # If not, we need to add it to supabase_db.py
-                                    try:
-                                        # Attempt to clear usage logs
-                                        # This would need to be implemented in supabase_db.py
-                                        # db.clear_all_usage_logs()
-                                        st.info("Note: Usage logs clearing requires database method implementation")
-                                    except:
-                                        pass
-                                    
-                                    # 3. Log the reset action in audit
-                                    # This would need to be implemented
+                                    logs_cleared, logs_message = db.clear_all_usage_logs(user, context=request_ctx)
                                     
                                     st.success(f"✅ System reset completed successfully!")
                                     st.info(f"Inventory quantities reset for {reset_count} items.")
-                                    st.warning("⚠️ Usage logs have been cleared. Refreshing data...")
+                                    if logs_cleared:
+                                        st.warning(f"⚠️ {logs_message}. Refreshing data...")
+                                    else:
+                                        st.error(f"❌ Usage logs were not cleared: {logs_message}")
                                     
-                                    # Clear cache and rerun
-                                    st.cache_data.clear()
                                     time.sleep(2)
                                     st.rerun()
                                     
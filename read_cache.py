@@ -0,0 +1,126 @@
+# read_cache.py – per-table read cache for SupabaseDatabase with targeted invalidation
+
+import threading
+import time
+from typing import Callable, Dict, List
+
+import pandas as pd
+
+
+def _copy(value):
+    # Callers add columns to the frames they get back; never hand out the cached object
+    if isinstance(value, pd.DataFrame):
+        return value.copy()
+    if isinstance(value, dict):
+        return dict(value)
+    return value
+
+
+class ReadCache:
+    """Query results grouped by table, shared by every session of the process.
+
+    Writes through SupabaseDatabase either patch an entry in place or drop
+    the entries of the one table they touched. Writes by other processes
+    are caught by ``sync_versions`` (per-table change counters kept by the
+    database). Until the first successful sync, or when the counters are
+    unavailable, entries fall back to expiring after ``ttl`` seconds.
+
+    Each table has a generation number, bumped on every invalidation. A
+    result loaded while a write to the same table was in flight is
+    returned but not stored.
+    """
+
+    def __init__(self, ttl: float = 60.0, should_store: Callable[[], bool] = None):
+        self.ttl = ttl
+        self.should_store = should_store
+        self._entries: Dict[str, Dict] = {}
+        self._generations: Dict[str, int] = {}
+        self._versions: Dict[str, int] = {}
+        self.versioned = False
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, table: str, key, loader: Callable):
+        """Cached result for (table, key), calling ``loader`` on a miss"""
+        if self.ttl <= 0:
+            return loader()
+
+        with self._lock:
+            entry = self._entries.get(table, {}).get(key)
+            if entry is not None and (self.versioned or time.monotonic() - entry[0] < self.ttl):
+                self.hits += 1
+                return _copy(entry[1])
+            self.misses += 1
+            generation = self._generations.get(table, 0)
+
+        value = loader()
+
+        with self._lock:
+            storable = self.should_store is None or self.should_store()
+            if storable and self._generations.get(table, 0) == generation:
+                self._entries.setdefault(table, {})[key] = (time.monotonic(), value)
+        return _copy(value)
+
+    def patch(self, table: str, key, update: Callable):
+        """Replace the cached value for (table, key) with ``update(value)``.
+
+        A missing or expired entry is left alone: the next read loads it.
+        If ``update`` raises, the entry is dropped instead.
+        """
+        with self._lock:
+            # A load of this table already in flight predates the write
+            self._generations[table] = self._generations.get(table, 0) + 1
+            entry = self._entries.get(table, {}).get(key)
+            if entry is None:
+                return
+            try:
+                self._entries[table][key] = (entry[0], update(entry[1]))
+            except Exception as e:
+                print(f"Cache patch of {table} failed, dropping entry:", e)
+                del self._entries[table][key]
+
+    def invalidate(self, table: str = None, keep=()):
+        """Drop every entry of ``table`` except the keys in ``keep`` (all tables when None)"""
+        with self._lock:
+            tables = [table] if table is not None else list(set(self._entries) | set(self._generations))
+            for name in tables:
+                self._drop(name, keep)
+            self.invalidations += 1
+
+    def sync_versions(self, versions: Dict[str, int]) -> List[str]:
+        """Drop the entries of every table whose version moved since the last sync.
+
+        An empty ``versions`` (counters unavailable) turns the TTL back on.
+        Returns the tables that were dropped.
+        """
+        with self._lock:
+            if not versions:
+                self.versioned = False
+                return []
+            moved = [table for table, version in versions.items() if self._versions.get(table) != version]
+            for table in moved:
+                self._drop(table)
+            if moved:
+                self.invalidations += 1
+            self._versions = dict(versions)
+            self.versioned = True
+            return moved
+
+    def _drop(self, table: str, keep=()):
+        self._generations[table] = self._generations.get(table, 0) + 1
+        entries = self._entries.get(table, {})
+        self._entries[table] = {k: v for k, v in entries.items() if k in keep}
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": sum(len(entries) for entries in self._entries.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "invalidations": self.invalidations,
+                "mode": "data versions" if self.versioned else f"{self.ttl:.0f} s TTL",
+            }
@@ -0,0 +1,42 @@
+# request_context.py – per-session client details for audit attribution
+
+from dataclasses import dataclass
+
+import streamlit as st
+
+SESSION_KEY = "_request_context"
+
+
+@dataclass(frozen=True)
+class RequestContext:
+    """IP address and user agent of the browser session issuing a write"""
+    ip_address: str = None
+    user_agent: str = None
+
+    @classmethod
+    def from_streamlit(cls) -> "RequestContext":
+        """Read the current session's own request headers via st.context"""
+        try:
+            headers = st.context.headers
+            # First hop of X-Forwarded-For is the client behind any proxies
+            forwarded = headers.get("X-Forwarded-For")
+            ip_address = (forwarded.split(",")[0].strip() if forwarded
+                          else st.context.ip_address or headers.get("Remote-Addr"))
+            return cls(ip_address or "Unknown", headers.get("User-Agent", "Unknown"))
+        except Exception:
+            return cls()
+
+
+def get_request_context() -> RequestContext:
+    """This session's RequestContext, captured on first use and kept in session_state.
+
+    Outside a Streamlit session (CLI scripts) an empty context is returned.
+    """
+    try:
+        context = st.session_state.get(SESSION_KEY)
+        if context is None:
+            context = RequestContext.from_streamlit()
+            st.session_state[SESSION_KEY] = context
+        return context
+    except Exception:
+        return RequestContext()
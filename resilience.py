@@ -0,0 +1,240 @@
+# resilience.py – retries, circuit breaker and last-known-good reads for storage backends
+
+import random
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict
+
+import httpx
+from postgrest.exceptions import APIError
+
+from storage_backends import StorageBackend
+
+# Failures worth retrying: the request never got a real answer. Errors the
+# server did answer with (bad column, constraint violation) are raised at once.
+TRANSIENT_ERRORS = (
+    httpx.TransportError,
+    ConnectionError,
+    TimeoutError,
+)
+
+# PostgREST codes for "could not reach / get a connection to the database",
+# and SQLSTATE classes for connection loss (08), exhausted resources (53)
+# and a database shutting down or starting up (57P)
+TRANSIENT_API_CODES = ("PGRST000", "PGRST001", "PGRST002", "PGRST003")
+TRANSIENT_SQLSTATE_PREFIXES = ("08", "53", "57P")
+
+
+def _transient_status(status: int) -> bool:
+    return status >= 500 or status == 429
+
+
+def is_transient(error: Exception) -> bool:
+    """True for network failures, 5xx/429 answers, database connection errors
+    and a locked/busy SQLite file"""
+    if isinstance(error, TRANSIENT_ERRORS):
+        return True
+    if isinstance(error, httpx.HTTPStatusError):
+        return _transient_status(error.response.status_code)
+    if isinstance(error, APIError):
+        code = str(error.code or "")
+        if len(code) == 3 and code.isdigit():
+            # Non-JSON error body: postgrest puts the HTTP status in ``code``
+            return _transient_status(int(code))
+        return code in TRANSIENT_API_CODES or code.startswith(TRANSIENT_SQLSTATE_PREFIXES)
+    if isinstance(error, sqlite3.OperationalError):
+        message = str(error).lower()
+        return "locked" in message or "busy" in message
+    return False
+
+
+class CircuitOpenError(RuntimeError):
+    """Raised instead of calling a backend that is known to be down"""
+
+
+class CircuitBreaker:
+    """Classic closed / open / half-open breaker.
+
+    After ``failure_threshold`` consecutive transient failures the circuit
+    opens and calls fail fast for ``reset_timeout`` seconds. Then one
+    trial call is let through (half-open) while every other call keeps
+    failing fast: success closes the circuit, failure opens it again. A
+    trial that never reports back is replaced after ``reset_timeout``.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = None
+        self.trial_started = None
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            if self.state == "open":
+                if now - self.opened_at < self.reset_timeout:
+                    return False
+                self.state = "half_open"
+                self.trial_started = now
+                return True
+            if self.state == "half_open":
+                # Only the trial call goes through until it reports back
+                if self.trial_started is not None and now - self.trial_started < self.reset_timeout:
+                    return False
+                self.trial_started = now
+                return True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+            self.opened_at = None
+            self.trial_started = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                self.state = "open"
+                self.opened_at = time.monotonic()
+                self.trial_started = None
+
+
+def retry_call(fn: Callable, attempts: int = 3, base_delay: float = 0.2, max_delay: float = 2.0):
+    """Call ``fn`` up to ``attempts`` times, backing off exponentially (with jitter)
+    between transient failures. Non-transient errors are raised immediately."""
+    for attempt in range(attempts):
+        try:
+            return fn()
+        except Exception as e:
+            if not is_transient(e) or attempt == attempts - 1:
+                raise
+            delay = min(max_delay, base_delay * (2 ** attempt))
+            time.sleep(delay * random.uniform(0.5, 1.0))
+
+
+class ResilientBackend(StorageBackend):
+    """Wraps a backend with retries, a circuit breaker and last-known-good reads.
+
+    Reads (select, count, usage aggregates, ping) are idempotent. They are
+    retried with backoff, and each successful result is remembered. When a
+    read still fails, or the circuit is open, the last good result for the
+    same query is returned and ``degraded`` is set. Writes are never
+    retried, since a timed-out insert may already have landed; they only
+    fail fast while the circuit is open.
+    """
+
+    def __init__(self, inner: StorageBackend, breaker: CircuitBreaker = None,
+                 attempts: int = 3, cache_size: int = 256):
+        self.inner = inner
+        self.name = inner.name
+        self.breaker = breaker or CircuitBreaker()
+        self.attempts = attempts
+        self.cache_size = cache_size
+        self._last_good: "OrderedDict[tuple, object]" = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self.served_stale = False
+        self.stale_reads = 0
+
+    def __getattr__(self, attr):
+        # client, session, conn, lock, ... of the wrapped engine
+        return getattr(self.inner, attr)
+
+    @property
+    def degraded(self) -> bool:
+        """True while the circuit is not closed or reads are being served from cache"""
+        return self.breaker.state != "closed" or self.served_stale
+
+    def status(self) -> Dict:
+        return {
+            "circuit": self.breaker.state,
+            "consecutive_failures": self.breaker.failures,
+            "degraded": self.degraded,
+            "stale_reads": self.stale_reads,
+        }
+
+    # ------------------------------------------------------------------
+    # Call paths
+    # ------------------------------------------------------------------
+    def _guarded(self, fn: Callable, attempts: int):
+        if not self.breaker.allow():
+            raise CircuitOpenError(f"{self.name} backend unavailable (circuit open)")
+        try:
+            result = retry_call(fn, attempts=attempts)
+        except Exception as e:
+            if is_transient(e):
+                self.breaker.record_failure()
+            else:
+                # The backend answered; the request itself was bad
+                self.breaker.record_success()
+            raise
+        self.breaker.record_success()
+        return result
+
+    def _read(self, key: tuple, fn: Callable):
+        try:
+            result = self._guarded(fn, self.attempts)
+        except Exception as e:
+            if not (isinstance(e, CircuitOpenError) or is_transient(e)):
+                raise
+            with self._cache_lock:
+                if key not in self._last_good:
+                    raise
+                self.served_stale = True
+                self.stale_reads += 1
+                return self._last_good[key]
+
+        with self._cache_lock:
+            self.served_stale = False
+            self._last_good[key] = result
+            self._last_good.move_to_end(key)
+            while len(self._last_good) > self.cache_size:
+                self._last_good.popitem(last=False)
+        return result
+
+    def _write(self, fn: Callable):
+        return self._guarded(fn, 1)
+
+    # ------------------------------------------------------------------
+    # StorageBackend
+    # ------------------------------------------------------------------
+    def select(self, table, columns="*", filters=None, order=None, desc=False, limit=None):
+        key = ("select", table, columns, repr(filters), repr(order), desc, limit)
+        return self._read(key, lambda: self.inner.select(table, columns, filters, order, desc, limit))
+
+    def count(self, table, filters=None):
+        key = ("count", table, repr(filters))
+        return self._read(key, lambda: self.inner.count(table, filters))
+
+    def usage_trends(self, start=None, end=None, granularity="day", items=None, top_n=None):
+        key = ("usage_trends", start, end, granularity, repr(items), top_n)
+        return self._read(key, lambda: self.inner.usage_trends(start, end, granularity, items, top_n))
+
+    def usage_breakdown(self, start=None, end=None, dimension="department", items=None):
+        key = ("usage_breakdown", start, end, dimension, repr(items))
+        return self._read(key, lambda: self.inner.usage_breakdown(start, end, dimension, items))
+
+    def ping(self):
+        # Never served from cache: the health probe must see the real outcome
+        return self._guarded(self.inner.ping, 1)
+
+    def insert(self, table, rows):
+        return self._write(lambda: self.inner.insert(table, rows))
+
+    def update(self, table, values, filters):
+        return self._write(lambda: self.inner.update(table, values, filters))
+
+    def delete(self, table, filters):
+        return self._write(lambda: self.inner.delete(table, filters))
+
+    def record_usage(self, log_row):
+        return self._write(lambda: self.inner.record_usage(log_row))
+
+    def delete_redundant_audits(self):
+        return self._write(self.inner.delete_redundant_audits)
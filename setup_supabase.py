@@ -1,5 +1,5 @@
 # setup_supabase.py
-from supabase_db import SupabaseDatabase
+from supabase_db import get_database
 from data_processor import DataProcessor
 import pandas as pd
 import os
@@ -10,7 +10,7 @@ def setup_supabase():
     print("=" * 60)
     
     # Initialize database
-    db = SupabaseDatabase()
+    db = get_database()
     
     # Check if admin exists
     users = db.get_all_users()
@@ -41,13 +41,13 @@ def setup_supabase():
         processor = DataProcessor()
         df = processor.load_excel_data("Book2.xlsx")
         
-        success_count = 0
-        for _, row in df.iterrows():
-            item_data = row.to_dict()
-            if db.add_inventory_item(item_data):
-                success_count += 1
+        results = db.add_inventory_items(df)
+        success_count = sum(1 for r in results if r["success"])
         
         print(f"✅ Imported {success_count} sample items")
+        for r in results:
+            if not r["success"]:
+                print(f"   ⚠️  {r['item_id']}: {r['error']}")
     
     print("=" * 60)
     print("✅ Setup Complete!")
@@ -0,0 +1,744 @@
+# storage_backends.py – storage engines behind SupabaseDatabase
+
+import re
+import sqlite3
+import threading
+import time
+from datetime import date, datetime
+from typing import Dict, Iterator, List
+
+import httpx
+import numpy as np
+import pandas as pd
+from postgrest.utils import SyncClient
+from supabase import create_client, Client
+
+from instrumentation import add_bytes
+
+
+# ------------------------------------------------------------------
+# Usage aggregates
+# ------------------------------------------------------------------
+# Bucket sizes for usage_trends and groupings for usage_breakdown; both are
+# computed by the database (supabase_migrations.sql / SQLite SQL below).
+# "weekday" keys are 0 = Monday ... 6 = Sunday.
+TREND_GRANULARITIES = ("day", "week", "month", "quarter")
+USAGE_BREAKDOWNS = ("department", "purpose", "weekday")
+
+
+# ------------------------------------------------------------------
+# Filters
+# ------------------------------------------------------------------
+# Every backend takes filters as a list of (column, op, value) tuples.
+# Supported ops: eq, neq, gt, gte, lt, lte, in, is_null, not_null
+# (the value is ignored for is_null / not_null).
+SQL_OPERATORS = {
+    "eq": "=",
+    "neq": "!=",
+    "gt": ">",
+    "gte": ">=",
+    "lt": "<",
+    "lte": "<=",
+}
+
+_IDENTIFIER = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+
+def _identifier(name: str) -> str:
+    """Validate a table/column name before it is placed in SQL text"""
+    name = str(name).strip()
+    if not _IDENTIFIER.match(name):
+        raise ValueError(f"Invalid identifier: {name!r}")
+    return name
+
+
+def _order_columns(order) -> List[str]:
+    """``select``'s order argument (None, a column, or a tuple/list of columns) as a list"""
+    if not order:
+        return []
+    return [order] if isinstance(order, str) else list(order)
+
+
+def _sql_value(value):
+    """Convert pandas/NumPy/datetime values into something sqlite3 can bind"""
+    if value is None:
+        return None
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and np.isnan(value):
+        return None
+    if value is pd.NaT:
+        return None
+    if isinstance(value, (pd.Timestamp, datetime, date)):
+        return value.isoformat()
+    return value
+
+
+def clean_row(row: Dict) -> Dict:
+    """Make a DataFrame record safe to send to any backend (NaN/NaT -> None, ISO dates)"""
+    return {key: _sql_value(value) for key, value in row.items()}
+
+
+# ------------------------------------------------------------------
+# Backend interface
+# ------------------------------------------------------------------
+class StorageBackend:
+    """Interface for the engines that hold inventory, usage_logs, audit_logs and users.
+
+    Reads return lists of row dicts (the same shape as a PostgREST
+    response's ``data``) so SupabaseDatabase can build identical
+    DataFrames whichever engine is behind it.
+    """
+
+    name = "base"
+
+    def select(self, table: str, columns: str = "*", filters: List = None,
+               order=None, desc: bool = False, limit: int = None) -> List[Dict]:
+        """Matching rows; ``order`` is a column or a tuple of columns, all sorted by ``desc``"""
+        raise NotImplementedError
+
+    def count(self, table: str, filters: List = None) -> int:
+        raise NotImplementedError
+
+    def insert(self, table: str, rows) -> List[Dict]:
+        """Insert one row (dict) or many (list of dicts); returns the stored rows"""
+        raise NotImplementedError
+
+    def update(self, table: str, values: Dict, filters: List) -> List[Dict]:
+        """Update matching rows; returns the rows after the update"""
+        raise NotImplementedError
+
+    def delete(self, table: str, filters: List) -> List[Dict]:
+        """Delete matching rows; returns the deleted rows"""
+        raise NotImplementedError
+
+    def record_usage(self, log_row: Dict) -> Dict:
+        """Atomically insert a usage_logs row and decrement the item's stock.
+
+        The quantity never drops below zero. Returns
+        ``{"usage": row, "old_quantity": n, "new_quantity": m}``, or None
+        (and writes nothing) when the item does not exist.
+        """
+        raise NotImplementedError
+
+    def delete_redundant_audits(self) -> int:
+        """Delete UPDATE audit rows whose old and new values are equal; returns the count"""
+        raise NotImplementedError
+
+    def usage_trends(self, start: str = None, end: str = None, granularity: str = "day",
+                     items: List[str] = None, top_n: int = None) -> List[Dict]:
+        """Units used per (bucket, item_name) for usage in [start, end).
+
+        ``bucket`` is the first day of the day/week (Monday)/month/quarter.
+        With ``top_n`` only the items with the most units in the window are
+        returned. Rows are ``{"bucket", "item_name", "units_used", "usage_count"}``.
+        """
+        raise NotImplementedError
+
+    def usage_breakdown(self, start: str = None, end: str = None, dimension: str = "department",
+                        items: List[str] = None) -> List[Dict]:
+        """Units used per (``dimension`` value, item_name) for usage in [start, end).
+
+        Rows are ``{"dimension", "item_name", "units_used", "usage_count"}``.
+        """
+        raise NotImplementedError
+
+    def ping(self) -> bool:
+        """Cheapest possible round-trip, used by BackendHealthProbe"""
+        self.select("inventory", "item_id", limit=1)
+        return True
+
+    def iter_pages(self, table: str, key: str, columns: str = "*", filters: List = None,
+                   page_size: int = 1000) -> Iterator[List[Dict]]:
+        """Yield the table in pages ordered by ``key`` using keyset pagination.
+
+        Each page asks for ``key > last key seen`` rather than an offset, so
+        pages stay cheap however deep the scan goes. Paging stops on an empty
+        page, not a short one: PostgREST may cap a response below
+        ``page_size`` and a short page does not mean the table is exhausted.
+        """
+        last_key = None
+        while True:
+            page_filters = list(filters or [])
+            if last_key is not None:
+                page_filters.append((key, "gt", last_key))
+
+            rows = self.select(table, columns, page_filters, order=key, limit=page_size)
+            if not rows:
+                return
+
+            yield rows
+            last_key = rows[-1][key]
+
+
+# ------------------------------------------------------------------
+# Supabase (PostgREST over HTTP)
+# ------------------------------------------------------------------
+class SupabaseBackend(StorageBackend):
+    """PostgREST engine with one pooled keep-alive HTTP session per backend.
+
+    supabase-py gives each PostgREST client a default session. That
+    session has a single timeout and default pool limits, and it is
+    rebuilt whenever the client is. This backend creates its own session
+    once, with explicit connect/read timeouts and pool limits, and
+    re-attaches it to every request builder (see ``_rest``).
+    """
+
+    name = "supabase"
+
+    def __init__(self, supabase_url: str, supabase_key: str, connect_timeout: float = 5.0,
+                 read_timeout: float = 30.0, max_connections: int = 20, keepalive_expiry: float = 120.0):
+        self.client: Client = create_client(supabase_url, supabase_key)
+        default_session = self.client.postgrest.session
+        self.session = SyncClient(
+            base_url=default_session.base_url,
+            headers=default_session.headers,
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+                keepalive_expiry=keepalive_expiry,
+            ),
+            follow_redirects=True,
+            http2=True,
+            event_hooks={"response": [self._on_response]},
+        )
+        self._session_lock = threading.Lock()
+        self._rest()
+
+    @staticmethod
+    def _on_response(response: httpx.Response):
+        # PostgREST bodies are small JSON documents; reading here just buffers
+        # what the request builder would read next anyway
+        add_bytes(len(response.read()))
+        # A gateway or overload answer (503 page, 429 rate limit) is an outage,
+        # not a bad request. postgrest's APIError drops the status, so raise it
+        # as an HTTP error that resilience.is_transient recognises.
+        if response.status_code >= 500 or response.status_code == 429:
+            response.raise_for_status()
+
+    def _rest(self):
+        """The PostgREST client, wired to the pooled session"""
+        postgrest = self.client.postgrest
+        if postgrest.session is self.session:
+            return postgrest
+        with self._session_lock:
+            # First use, or supabase-py rebuilt the client (its headers may be
+            # new). Re-checked under the lock: another thread may have swapped
+            # it already, and the pooled session must never be closed.
+            postgrest = self.client.postgrest
+            default_session = postgrest.session
+            if default_session is not self.session:
+                self.session.headers = default_session.headers
+                postgrest.session = self.session
+                default_session.close()
+        return postgrest
+
+    def close(self):
+        self.session.close()
+
+    @staticmethod
+    def _apply_filters(query, filters: List = None):
+        for column, op, value in filters or []:
+            if op == "in":
+                query = query.in_(column, list(value))
+            elif op == "is_null":
+                query = query.is_(column, "null")
+            elif op == "not_null":
+                query = query.not_.is_(column, "null")
+            elif op in SQL_OPERATORS:
+                query = getattr(query, op)(column, value)
+            else:
+                raise ValueError(f"Unsupported filter operator: {op}")
+        return query
+
+    def select(self, table, columns="*", filters=None, order=None, desc=False, limit=None):
+        query = self._apply_filters(self._rest().table(table).select(columns), filters)
+        for column in _order_columns(order):
+            query = query.order(column, desc=desc)
+        if limit is not None:
+            query = query.limit(limit)
+        return query.execute().data or []
+
+    def count(self, table, filters=None):
+        query = self._rest().table(table).select("*", count="exact")
+        response = self._apply_filters(query, filters).limit(1).execute()
+        return response.count or 0
+
+    def insert(self, table, rows):
+        return self._rest().table(table).insert(rows).execute().data or []
+
+    def update(self, table, values, filters):
+        query = self._apply_filters(self._rest().table(table).update(values), filters)
+        return query.execute().data or []
+
+    def delete(self, table, filters):
+        query = self._apply_filters(self._rest().table(table).delete(), filters)
+        return query.execute().data or []
+
+    def record_usage(self, log_row):
+        # public.record_usage (supabase_migrations.sql) locks the inventory
+        # row, updates it and inserts the usage row in one round-trip
+        params = {f"p_{key}": value for key, value in clean_row(log_row).items()}
+        return self._rest().rpc("record_usage", params).execute().data or None
+
+    def delete_redundant_audits(self):
+        # One set-based DELETE on the server (supabase_migrations.sql)
+        return self._rest().rpc("delete_redundant_audits", {}).execute().data or 0
+
+    # Both RPCs return one jsonb array, which PostgREST's max-rows cap does not truncate
+    def usage_trends(self, start=None, end=None, granularity="day", items=None, top_n=None):
+        params = {"p_start": start, "p_end": end, "p_granularity": granularity,
+                  "p_items": items, "p_top_n": top_n}
+        return self._rest().rpc("usage_trends", params).execute().data or []
+
+    def usage_breakdown(self, start=None, end=None, dimension="department", items=None):
+        params = {"p_start": start, "p_end": end, "p_dimension": dimension, "p_items": items}
+        return self._rest().rpc("usage_breakdown", params).execute().data or []
+
+
+# ------------------------------------------------------------------
+# Health probe
+# ------------------------------------------------------------------
+class BackendHealthProbe:
+    """Daemon thread that pings a backend every ``interval`` seconds.
+
+    The probe keeps the pooled connection warm between user actions and
+    records whether the last round-trip succeeded and how long it took.
+    """
+
+    def __init__(self, backend: StorageBackend, interval: float = 30.0):
+        self.backend = backend
+        self.interval = interval
+        self.healthy = None
+        self.latency_ms = None
+        self.last_checked = None
+        self.last_error = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"{backend.name}-health", daemon=True)
+        self._thread.start()
+
+    def check(self) -> bool:
+        start = time.perf_counter()
+        try:
+            self.backend.ping()
+            self.healthy, self.last_error = True, None
+        except Exception as e:
+            self.healthy, self.last_error = False, str(e)
+        self.latency_ms = (time.perf_counter() - start) * 1000
+        self.last_checked = datetime.now()
+        return self.healthy
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.check()
+            self._stop.wait(self.interval)
+
+    def stop(self):
+        self._stop.set()
+
+    def status(self) -> Dict:
+        return {
+            "backend": self.backend.name,
+            "healthy": self.healthy,
+            "latency_ms": round(self.latency_ms, 1) if self.latency_ms is not None else None,
+            "last_checked": self.last_checked,
+            "last_error": self.last_error,
+        }
+
+
+# ------------------------------------------------------------------
+# SQLite (local disk, no network)
+# ------------------------------------------------------------------
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS inventory (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    item_id TEXT NOT NULL UNIQUE,
+    item_name TEXT NOT NULL,
+    category TEXT,
+    quantity INTEGER NOT NULL DEFAULT 0,
+    unit TEXT DEFAULT 'Units',
+    expiry_date TEXT,
+    storage_location TEXT,
+    supplier TEXT,
+    reorder_level INTEGER DEFAULT 50,
+    status TEXT DEFAULT 'Active',
+    notes TEXT,
+    created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+    version INTEGER NOT NULL DEFAULT 1,
+    updated_at TEXT
+);
+
+CREATE TABLE IF NOT EXISTS usage_logs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    item_id TEXT NOT NULL,
+    item_name TEXT,
+    units_used INTEGER NOT NULL,
+    purpose TEXT,
+    used_by TEXT,
+    department TEXT,
+    notes TEXT,
+    usage_date TEXT DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS audit_logs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    timestamp TEXT DEFAULT CURRENT_TIMESTAMP,
+    user_id TEXT,
+    user_name TEXT,
+    action_type TEXT,
+    table_name TEXT,
+    record_id TEXT,
+    field_name TEXT,
+    old_value TEXT,
+    new_value TEXT,
+    notes TEXT,
+    ip_address TEXT,
+    user_agent TEXT
+);
+
+-- Record timelines: WHERE table_name = ? AND record_id = ? ORDER BY timestamp DESC
+CREATE INDEX IF NOT EXISTS audit_logs_table_record_ts_idx
+    ON audit_logs (table_name, record_id, timestamp);
+
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    username TEXT NOT NULL UNIQUE,
+    password_hash TEXT,
+    full_name TEXT,
+    role TEXT DEFAULT 'user',
+    department TEXT,
+    email TEXT,
+    created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+    last_password_change TEXT
+);
+
+-- Usage trends and breakdowns: WHERE usage_date >= ? AND usage_date < ?
+CREATE INDEX IF NOT EXISTS usage_logs_usage_date_idx
+    ON usage_logs (usage_date);
+
+-- Deleted item_ids, filled by trigger, for incremental sync (InventorySync)
+CREATE TABLE IF NOT EXISTS inventory_tombstones (
+    item_id TEXT PRIMARY KEY,
+    deleted_at TEXT NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS inventory_tombstones_deleted_at_idx
+    ON inventory_tombstones (deleted_at);
+
+-- One change counter per table, bumped by trigger (SupabaseDatabase.get_data_versions)
+CREATE TABLE IF NOT EXISTS data_versions (
+    table_name TEXT PRIMARY KEY,
+    version INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE VIEW IF NOT EXISTS usage_stats_by_item AS
+SELECT
+    item_name,
+    SUM(units_used) AS total_units_used,
+    COUNT(usage_date) AS usage_count
+FROM usage_logs
+GROUP BY item_name;
+"""
+
+# SQL for TREND_GRANULARITIES and USAGE_BREAKDOWNS, mirroring date_trunc / isodow in Postgres
+SQLITE_BUCKETS = {
+    "day": "date(usage_date)",
+    "week": "date(usage_date, 'weekday 0', '-6 days')",
+    "month": "strftime('%Y-%m-01', usage_date)",
+    "quarter": "printf('%s-%02d-01', strftime('%Y', usage_date), "
+               "(CAST(strftime('%m', usage_date) AS INTEGER) - 1) / 3 * 3 + 1)",
+}
+SQLITE_BREAKDOWNS = {
+    "department": "COALESCE(department, '')",
+    "purpose": "COALESCE(purpose, '')",
+    "weekday": "CAST((CAST(strftime('%w', usage_date) AS INTEGER) + 6) % 7 AS TEXT)",
+}
+
+# Same format as datetime.now(timezone.utc).isoformat(timespec="milliseconds"),
+# so values written by SQLite and by Python compare correctly as text
+SQLITE_NOW = "strftime('%Y-%m-%dT%H:%M:%f+00:00', 'now')"
+
+# Columns added after a table was first created: (table, column, declaration).
+# CREATE TABLE IF NOT EXISTS leaves older database files untouched.
+SQLITE_ADDED_COLUMNS = [
+    ("inventory", "version", "INTEGER NOT NULL DEFAULT 1"),
+    ("inventory", "updated_at", "TEXT"),
+]
+
+# Run after SQLITE_ADDED_COLUMNS. Row versions mirror the Postgres trigger in
+# supabase_migrations.sql: a write that sets neither version nor updated_at
+# (record_usage, bulk updates) bumps the version; optimistic writers set
+# both themselves.
+SQLITE_TRIGGERS = f"""
+CREATE TRIGGER IF NOT EXISTS inventory_set_updated_at
+AFTER INSERT ON inventory
+FOR EACH ROW WHEN NEW.updated_at IS NULL
+BEGIN
+    UPDATE inventory SET updated_at = {SQLITE_NOW} WHERE id = NEW.id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS inventory_bump_version
+AFTER UPDATE ON inventory
+FOR EACH ROW WHEN NEW.version IS OLD.version AND NEW.updated_at IS OLD.updated_at
+BEGIN
+    UPDATE inventory SET version = OLD.version + 1, updated_at = {SQLITE_NOW} WHERE id = NEW.id;
+END;
+
+UPDATE inventory SET updated_at = {SQLITE_NOW} WHERE updated_at IS NULL;
+
+-- Delta sync: WHERE updated_at > ?, plus a tombstone for every item_id that
+-- leaves the table (deleted or renamed); re-adding an item clears it
+CREATE INDEX IF NOT EXISTS inventory_updated_at_idx ON inventory (updated_at);
+
+CREATE TRIGGER IF NOT EXISTS inventory_tombstone_delete
+AFTER DELETE ON inventory
+FOR EACH ROW
+BEGIN
+    INSERT OR REPLACE INTO inventory_tombstones (item_id, deleted_at) VALUES (OLD.item_id, {SQLITE_NOW});
+END;
+
+CREATE TRIGGER IF NOT EXISTS inventory_tombstone_rename
+AFTER UPDATE OF item_id ON inventory
+FOR EACH ROW WHEN NEW.item_id IS NOT OLD.item_id
+BEGIN
+    INSERT OR REPLACE INTO inventory_tombstones (item_id, deleted_at) VALUES (OLD.item_id, {SQLITE_NOW});
+    DELETE FROM inventory_tombstones WHERE item_id = NEW.item_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS inventory_tombstone_clear
+AFTER INSERT ON inventory
+FOR EACH ROW
+BEGIN
+    DELETE FROM inventory_tombstones WHERE item_id = NEW.item_id;
+END;
+"""
+
+# Tables with a data_versions counter. SQLite has no statement-level
+# triggers, so the counter moves once per changed row; only its change
+# matters, not its value.
+VERSIONED_TABLES = ("inventory", "usage_logs", "audit_logs", "users")
+
+SQLITE_TRIGGERS += "".join(
+    f"INSERT OR IGNORE INTO data_versions (table_name) VALUES ('{table}');\n"
+    for table in VERSIONED_TABLES
+) + "".join(
+    f"""
+CREATE TRIGGER IF NOT EXISTS {table}_data_version_{event.lower()}
+AFTER {event} ON {table}
+FOR EACH ROW
+BEGIN
+    UPDATE data_versions SET version = version + 1 WHERE table_name = '{table}';
+END;
+"""
+    for table in VERSIONED_TABLES
+    for event in ("INSERT", "UPDATE", "DELETE")
+)
+
+
+class SQLiteBackend(StorageBackend):
+    """Local SQLite engine with the same tables as the Supabase project"""
+
+    name = "sqlite"
+
+    def __init__(self, path: str = "inventory.db"):
+        self.path = path
+        self.lock = threading.RLock()
+        # One shared connection guarded by a lock: Streamlit runs every
+        # session on its own thread but SupabaseDatabase is cached process-wide.
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        with self.lock:
+            self.conn.executescript(SQLITE_SCHEMA)
+            self._migrate()
+            self.conn.executescript(SQLITE_TRIGGERS)
+
+    def _migrate(self):
+        """Add columns introduced since the database file was created"""
+        for table, column, declaration in SQLITE_ADDED_COLUMNS:
+            existing = {row[1] for row in self.conn.execute(f"PRAGMA table_info({table})")}
+            if column not in existing:
+                self.conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {declaration}")
+        self.conn.commit()
+
+    @staticmethod
+    def _columns(columns: str) -> str:
+        if columns.strip() == "*":
+            return "*"
+        return ", ".join(_identifier(c) for c in columns.split(","))
+
+    @staticmethod
+    def _where(filters: List = None):
+        clauses, params = [], []
+        for column, op, value in filters or []:
+            column = _identifier(column)
+            if op == "in":
+                values = [_sql_value(v) for v in value]
+                if not values:
+                    clauses.append("0")
+                    continue
+                clauses.append(f"{column} IN ({', '.join('?' * len(values))})")
+                params.extend(values)
+            elif op == "is_null":
+                clauses.append(f"{column} IS NULL")
+            elif op == "not_null":
+                clauses.append(f"{column} IS NOT NULL")
+            elif op in SQL_OPERATORS:
+                clauses.append(f"{column} {SQL_OPERATORS[op]} ?")
+                params.append(_sql_value(value))
+            else:
+                raise ValueError(f"Unsupported filter operator: {op}")
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+        return where, params
+
+    def _fetch(self, sql: str, params=()) -> List[Dict]:
+        with self.lock:
+            return [dict(row) for row in self.conn.execute(sql, params).fetchall()]
+
+    def select(self, table, columns="*", filters=None, order=None, desc=False, limit=None):
+        where, params = self._where(filters)
+        sql = f"SELECT {self._columns(columns)} FROM {_identifier(table)}{where}"
+        if order:
+            direction = "DESC" if desc else "ASC"
+            sql += " ORDER BY " + ", ".join(f"{_identifier(column)} {direction}" for column in _order_columns(order))
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(int(limit))
+        return self._fetch(sql, params)
+
+    def count(self, table, filters=None):
+        where, params = self._where(filters)
+        with self.lock:
+            row = self.conn.execute(
+                f"SELECT COUNT(*) FROM {_identifier(table)}{where}", params
+            ).fetchone()
+        return row[0]
+
+    def insert(self, table, rows):
+        if isinstance(rows, dict):
+            rows = [rows]
+        table = _identifier(table)
+        rowids = []
+        with self.lock, self.conn:
+            for row in rows:
+                columns = [_identifier(c) for c in row.keys()]
+                sql = (
+                    f"INSERT INTO {table} ({', '.join(columns)}) "
+                    f"VALUES ({', '.join('?' * len(columns))}) RETURNING rowid"
+                )
+                params = [_sql_value(v) for v in row.values()]
+                rowids.extend(r[0] for r in self.conn.execute(sql, params))
+            return self._reread(table, rowids)
+
+    def update(self, table, values, filters):
+        assignments = ", ".join(f"{_identifier(c)} = ?" for c in values.keys())
+        where, params = self._where(filters)
+        sql = f"UPDATE {_identifier(table)} SET {assignments}{where} RETURNING rowid"
+        with self.lock, self.conn:
+            rowids = [r[0] for r in self.conn.execute(sql, [_sql_value(v) for v in values.values()] + params)]
+            return self._reread(_identifier(table), rowids)
+
+    def _reread(self, table: str, rowids: List[int]) -> List[Dict]:
+        # RETURNING runs before AFTER triggers (version, updated_at), so
+        # read the rows back to return what was actually stored
+        rows = []
+        for start in range(0, len(rowids), 500):
+            chunk = rowids[start:start + 500]
+            rows += self.conn.execute(
+                f"SELECT * FROM {table} WHERE rowid IN ({', '.join('?' * len(chunk))})", chunk
+            ).fetchall()
+        return [dict(r) for r in rows]
+
+    def delete(self, table, filters):
+        where, params = self._where(filters)
+        sql = f"DELETE FROM {_identifier(table)}{where} RETURNING *"
+        with self.lock, self.conn:
+            rows = self.conn.execute(sql, params).fetchall()
+        return [dict(r) for r in rows]
+
+    def record_usage(self, log_row):
+        row = clean_row(log_row)
+        columns = [_identifier(c) for c in row.keys()]
+        with self.lock:
+            # IMMEDIATE takes the write lock up front, so other processes using
+            # the same file cannot change the quantity between read and update
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                current = self.conn.execute(
+                    "SELECT quantity FROM inventory WHERE item_id = ?", (row["item_id"],)
+                ).fetchone()
+                if current is None:
+                    self.conn.rollback()
+                    return None
+
+                old_quantity = current[0] or 0
+                new_quantity = max(old_quantity - int(row["units_used"]), 0)
+                self.conn.execute(
+                    "UPDATE inventory SET quantity = ? WHERE item_id = ?",
+                    (new_quantity, row["item_id"]),
+                )
+                usage = self.conn.execute(
+                    f"INSERT INTO usage_logs ({', '.join(columns)}) "
+                    f"VALUES ({', '.join('?' * len(columns))}) RETURNING *",
+                    list(row.values()),
+                ).fetchone()
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+
+        return {"usage": dict(usage), "old_quantity": old_quantity, "new_quantity": new_quantity}
+
+    def delete_redundant_audits(self):
+        with self.lock, self.conn:
+            cursor = self.conn.execute(
+                "DELETE FROM audit_logs WHERE action_type = 'UPDATE' "
+                "AND old_value IS NOT NULL AND old_value != '' AND old_value = new_value"
+            )
+        return cursor.rowcount
+
+    def _usage_window(self, start=None, end=None, items=None):
+        filters = []
+        if start:
+            filters.append(("usage_date", "gte", start))
+        if end:
+            filters.append(("usage_date", "lt", end))
+        if items is not None:
+            filters.append(("item_name", "in", list(items)))
+        return self._where(filters)
+
+    def usage_trends(self, start=None, end=None, granularity="day", items=None, top_n=None):
+        where, params = self._usage_window(start, end, items)
+        sql = f"""
+            WITH windowed AS (
+                SELECT item_name, units_used, {SQLITE_BUCKETS[granularity]} AS bucket
+                FROM usage_logs{where}
+            ),
+            top_items AS (
+                SELECT item_name FROM windowed
+                GROUP BY item_name
+                ORDER BY SUM(units_used) DESC, item_name
+                LIMIT ?
+            )
+            SELECT bucket, item_name, SUM(units_used) AS units_used, COUNT(*) AS usage_count
+            FROM windowed
+            WHERE item_name IN (SELECT item_name FROM top_items)
+            GROUP BY bucket, item_name
+            ORDER BY bucket, item_name
+        """
+        with self.lock:
+            rows = self.conn.execute(sql, params + [top_n if top_n else -1]).fetchall()
+        return [dict(r) for r in rows]
+
+    def usage_breakdown(self, start=None, end=None, dimension="department", items=None):
+        where, params = self._usage_window(start, end, items)
+        sql = f"""
+            SELECT {SQLITE_BREAKDOWNS[dimension]} AS dimension, item_name,
+                   SUM(units_used) AS units_used, COUNT(*) AS usage_count
+            FROM usage_logs{where}
+            GROUP BY 1, 2
+            ORDER BY 1, 2
+        """
+        with self.lock:
+            rows = self.conn.execute(sql, params).fetchall()
+        return [dict(r) for r in rows]
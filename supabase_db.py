@@ -1,13 +1,122 @@
 # supabase_db.py – FINAL FIXED & STABLE VERSION WITH RESET FUNCTIONALITY
 
 import streamlit as st
-from supabase import create_client, Client
 import pandas as pd
 import bcrypt
-from datetime import datetime
-from typing import Dict
+import os
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Tuple
 import traceback
 
+from audit_writer import AuditBuffer, shared_audit_queue
+from request_context import RequestContext
+from resilience import ResilientBackend, CircuitBreaker
+from instrumentation import instrumented
+from inventory_sync import InventorySync
+from read_cache import ReadCache
+from storage_backends import (
+    StorageBackend, SupabaseBackend, SQLiteBackend, BackendHealthProbe, clean_row,
+    TREND_GRANULARITIES, USAGE_BREAKDOWNS
+)
+
+# Database view with one row per item (see supabase_migrations.sql)
+USAGE_STATS_VIEW = "usage_stats_by_item"
+
+# Expiry buckets as (label, after_days, within_days) relative to today:
+# an item falls in a bucket when today + after_days < expiry_date <= today + within_days
+EXPIRY_BUCKETS = [
+    ("Expired", None, 0),
+    ("< 30 days", 0, 30),
+    ("30-90 days", 30, 90),
+    ("90-180 days", 90, 180),
+    ("> 180 days", 180, None),
+]
+
+
+def default_reset_quantity(category, item_name=None) -> int:
+    """Quantity an item is reset to by the Reset System tab, based on its category"""
+    category = str(category or '').lower()
+
+    if 'ppe' in category or 'glove' in str(item_name or '').lower():
+        return 500
+    elif 'reagent' in category or 'chemical' in category:
+        return 100
+    elif 'device' in category or 'equipment' in category:
+        return 10
+    elif 'consumable' in category:
+        return 200
+    elif 'desiccant' in category:
+        return 300
+    return 200  # General default
+
+
+@dataclass
+class UpdateResult:
+    """Outcome of an inventory write.
+
+    status is "ok", "noop" (nothing changed), "conflict" (the row moved on
+    since it was loaded; ``row`` is the current row), "not_found" or
+    "error". Truthy for "ok" and "noop", so callers that only checked the
+    old True/False return keep working.
+    """
+    status: str
+    row: Dict = None
+    message: str = ""
+
+    def __bool__(self):
+        return self.status in ("ok", "noop")
+
+
+def _utc_now() -> str:
+    """Timestamp in the format the database triggers write to updated_at"""
+    return datetime.now(timezone.utc).isoformat(timespec="milliseconds")
+
+
+def _upsert_items(rows: List[Dict]):
+    """Cache patch: put written inventory rows into the cached frame, keeping item_id order"""
+    def apply(frame):
+        if not rows:
+            return frame
+        changed = pd.DataFrame(rows)
+        kept = frame[~frame["item_id"].isin(changed["item_id"])]
+        return pd.concat([kept, changed], ignore_index=True).sort_values("item_id", ignore_index=True)
+    return apply
+
+
+def _drop_items(item_ids: List[str]):
+    """Cache patch: remove deleted items from the cached frame"""
+    return lambda frame: frame[~frame["item_id"].isin(item_ids)].reset_index(drop=True)
+
+
+def _consume_stock(item_id: str, new_quantity: int):
+    """Cache patch: record_usage set the quantity and the trigger bumped the version"""
+    def apply(frame):
+        frame = frame.copy()
+        mask = frame["item_id"] == item_id
+        frame.loc[mask, "quantity"] = new_quantity
+        if "version" in frame.columns:
+            frame.loc[mask, "version"] = frame.loc[mask, "version"] + 1
+        return frame
+    return apply
+
+
+def _window_bound(value):
+    """date / datetime / ISO string -> ISO string for usage window filters"""
+    if value is None or isinstance(value, str):
+        return value
+    return value.isoformat()
+
+
+def _row_version(row: Dict):
+    """The row's version as an int, or None if the row was loaded without one"""
+    version = row.get("version") if row is not None else None
+    if version is None or pd.isna(version):
+        return None
+    return int(version)
+
 
 # ------------------------------------------------------------------
 # Supabase credentials
@@ -21,15 +130,109 @@ def get_supabase_creds():
         raise RuntimeError(f"Failed to load Supabase credentials: {e}")
 
 
+# ------------------------------------------------------------------
+# Storage backend selection
+# ------------------------------------------------------------------
+def _storage_setting(name: str, default: str = None):
+    """Read a [storage] setting from the environment, then Streamlit secrets"""
+    value = os.getenv(f"STORAGE_{name}")
+    if value:
+        return value
+    try:
+        return st.secrets["storage"][name]
+    except Exception:
+        return default
+
+
+def _storage_flag(name: str, default: str) -> bool:
+    """Read an on/off [storage] setting"""
+    return str(_storage_setting(name, default)).lower() not in ("off", "false", "0", "no")
+
+
+def create_backend(engine: str = None) -> StorageBackend:
+    """Build the configured storage engine ("supabase" or "sqlite").
+
+    The engine is wrapped in a ResilientBackend (retries, circuit breaker,
+    last-known-good reads) unless STORAGE_RESILIENCE=off.
+    """
+    engine = (engine or _storage_setting("BACKEND", "supabase")).lower()
+
+    if engine == "sqlite":
+        backend = SQLiteBackend(_storage_setting("SQLITE_PATH", "inventory.db"))
+    elif engine == "supabase":
+        supabase_url, supabase_key = get_supabase_creds()
+        backend = SupabaseBackend(
+            supabase_url, supabase_key,
+            connect_timeout=float(_storage_setting("CONNECT_TIMEOUT", 5)),
+            read_timeout=float(_storage_setting("READ_TIMEOUT", 30)),
+            max_connections=int(_storage_setting("MAX_CONNECTIONS", 20)),
+        )
+    else:
+        raise ValueError(f"Unknown storage backend: {engine}")
+
+    if not _storage_flag("RESILIENCE", "on"):
+        return backend
+    return ResilientBackend(
+        backend,
+        CircuitBreaker(
+            failure_threshold=int(_storage_setting("BREAKER_THRESHOLD", 5)),
+            reset_timeout=float(_storage_setting("BREAKER_RESET", 30)),
+        ),
+        attempts=int(_storage_setting("READ_ATTEMPTS", 3)),
+    )
+
+
 # ------------------------------------------------------------------
 # Database class
 # ------------------------------------------------------------------
+# Every public method is timed into instrumentation.metrics (shown on System Info)
+@instrumented(exclude=("health", "is_degraded", "audit_queue_stats", "audit_batch", "cache_stats",
+                       "sync_stats", "check_data_versions"))
 class SupabaseDatabase:
-    def __init__(self):
-        self.supabase_url, self.supabase_key = get_supabase_creds()
-        self.supabase: Client = create_client(
-            self.supabase_url,
-            self.supabase_key
+    # Rows per keyset page; Supabase's default PostgREST max-rows is 1000
+    PAGE_SIZE = 1000
+    # Values per "in" filter; keeps PostgREST request URLs well under server limits
+    BULK_FILTER_SIZE = 200
+
+    def __init__(self, backend: StorageBackend = None):
+        self.backend = backend or create_backend()
+        # Raw Supabase client (None on local engines), kept for scripts
+        # that still talk to PostgREST directly
+        self.supabase = getattr(self.backend, "client", None)
+        # Per-thread audit buffer for the operation currently running on
+        # that thread (Streamlit sessions share this instance)
+        self._audit_local = threading.local()
+        # Background writer for audit rows; STORAGE_AUDIT_QUEUE=off writes inline
+        self.audit_queue = None
+        if _storage_flag("AUDIT_QUEUE", "on"):
+            self.audit_queue = shared_audit_queue(
+                self._insert_audit_rows,
+                spill_path=self._audit_spill_path(),
+                owner=self.backend,
+            )
+        # Edits that changed nothing are counted, not stored, unless
+        # STORAGE_AUDIT_UPDATE_ATTEMPTS=on asks for UPDATE_ATTEMPT rows
+        self.record_update_attempts = _storage_flag("AUDIT_UPDATE_ATTEMPTS", "off")
+        self._audit_counters_lock = threading.Lock()
+        self.audit_counters = {"update_attempts": 0, "suppressed_noops": 0}
+        # Started by get_database() for the shared instance
+        self.health_probe = None
+        # Read results shared by all sessions; writes patch or invalidate only
+        # their own table, and check_data_versions() catches other processes'
+        # writes. STORAGE_CACHE_TTL applies only while the version counters are
+        # unavailable (0 disables caching); last-known-good reads from a
+        # degraded backend are not kept.
+        self.cache = ReadCache(
+            ttl=float(_storage_setting("CACHE_TTL", 60)),
+            should_store=lambda: not self.is_degraded(),
+        )
+        # Resident inventory behind the cache: an expired or invalidated entry
+        # is refilled with a delta query instead of a full table read
+        self.inventory_sync = InventorySync(
+            self.backend,
+            page_size=self.PAGE_SIZE,
+            lookback=float(_storage_setting("SYNC_LOOKBACK", 5)),
+            full_every=float(_storage_setting("SYNC_FULL_EVERY", 3600)),
         )
 
     # ------------------------------------------------------------------
@@ -37,15 +240,12 @@ class SupabaseDatabase:
     # ------------------------------------------------------------------
     def authenticate_user(self, username: str, password: str):
         try:
-            response = self.supabase.table("users") \
-                .select("*") \
-                .eq("username", username) \
-                .execute()
+            rows = self.backend.select("users", filters=[("username", "eq", username)])
 
-            if not response.data:
+            if not rows:
                 return None
 
-            user = response.data[0]
+            user = rows[0]
             stored_hash = user.get("password_hash", "").strip()
 
             # Fix bcrypt prefix mismatch if present
@@ -72,28 +272,29 @@ class SupabaseDatabase:
     # ------------------------------------------------------------------
     def get_inventory(self):
         try:
-            response = self.supabase.table("inventory").select("*").execute()
-            return pd.DataFrame(response.data)
+            return self.cache.get("inventory", "all", self.inventory_sync.refresh)
         except Exception:
             return pd.DataFrame()
 
-    def add_inventory_item(self, item_data: Dict, user: Dict = None):
+    def iter_inventory(self, page_size: int = None, columns: str = "*"):
+        """Yield the inventory table as DataFrame pages ordered by item_id"""
+        for rows in self.backend.iter_pages("inventory", "item_id", columns, page_size=page_size or self.PAGE_SIZE):
+            yield pd.DataFrame(rows)
+
+    def iter_usage_logs(self, page_size: int = None):
+        """Yield usage_logs as DataFrame pages ordered by id"""
+        for rows in self.backend.iter_pages("usage_logs", "id", page_size=page_size or self.PAGE_SIZE):
+            yield pd.DataFrame(rows)
+
+    def add_inventory_item(self, item_data: Dict, user: Dict = None, context: RequestContext = None):
             try:
-                response = self.supabase.table("inventory").insert(item_data).execute()
+                inserted = self.backend.insert("inventory", item_data)
     
-                if response.data:
-                    # Get client info for audit
-                    ip_address = None
-                    user_agent = None
-                    try:
-                        import streamlit as st
-                        ctx = st.runtime.get_instance()._session_mgr.list_active_sessions()[0].request
-                        if hasattr(ctx, 'headers'):
-                            headers = ctx.headers
-                            ip_address = headers.get('X-Forwarded-For', headers.get('Remote-Addr', 'Unknown'))
-                            user_agent = headers.get('User-Agent', 'Unknown')
-                    except:
-                        pass
+                if inserted:
+                    self._patch_inventory(_upsert_items(inserted))
+
+                    # Client info for audit, captured once per session by the caller
+                    ip_address, user_agent = self._client_info(context)
     
                     # Log the item creation with all details
                     item_details = []
@@ -120,20 +321,92 @@ class SupabaseDatabase:
                 print("Add inventory error:", e)
                 return False
 
-    def update_inventory_item(self, item_id: str, updates: Dict, user: Dict = None):
-        """Update inventory item with comprehensive audit logging"""
+    def add_inventory_items(self, rows, batch_size: int = 500, user: Dict = None,
+                            context: RequestContext = None) -> List[Dict]:
+        """Insert many inventory items with chunked multi-row inserts.
+
+        ``rows`` is a DataFrame or a list of dicts. Each chunk is one insert
+        plus one summary audit event. If a chunk is rejected (e.g. a
+        duplicate item_id), only that chunk is retried row by row so the
+        bad rows can be reported. Returns one
+        ``{"item_id", "success", "error"}`` dict per input row, in order.
+        """
+        if isinstance(rows, pd.DataFrame):
+            rows = rows.to_dict("records")
+        records = [clean_row(row) for row in rows]
+        ip_address, user_agent = self._client_info(context)
+        results = [{"item_id": r.get("item_id"), "success": False, "error": None} for r in records]
+
+        with self.audit_batch():
+            for start in range(0, len(records), batch_size):
+                positions = []
+                for pos in range(start, min(start + batch_size, len(records))):
+                    if records[pos].get("item_id"):
+                        positions.append(pos)
+                    else:
+                        results[pos]["error"] = "Missing item_id"
+                if not positions:
+                    continue
+
+                try:
+                    self.backend.insert("inventory", [records[pos] for pos in positions])
+                    added = positions
+                except Exception as e:
+                    print(f"Bulk insert of rows {start}-{start + batch_size - 1} failed, retrying per row:", e)
+                    added = []
+                    for pos in positions:
+                        try:
+                            if self.backend.insert("inventory", records[pos]):
+                                added.append(pos)
+                            else:
+                                results[pos]["error"] = "Insert returned no row"
+                        except Exception as row_error:
+                            results[pos]["error"] = str(row_error)
+
+                for pos in added:
+                    results[pos]["success"] = True
+
+                if added:
+                    self.cache.invalidate("inventory")
+                    item_ids = [records[pos]["item_id"] for pos in added]
+                    self._log_audit_event(
+                        user=user,
+                        action_type="BULK_ADD",
+                        table_name="inventory",
+                        new_value=len(added),
+                        notes=f"Bulk import added {len(added)} of {len(positions)} items: "
+                              f"{', '.join(item_ids[:5])}{'...' if len(item_ids) > 5 else ''}",
+                        ip_address=ip_address,
+                        user_agent=user_agent
+                    )
+
+        return results
+
+    def update_inventory_item(self, item_id: str, updates: Dict, user: Dict = None,
+                              expected_version: int = None, original: Dict = None,
+                              context: RequestContext = None) -> "UpdateResult":
+        """Update inventory item with comprehensive audit logging.
+
+        Pass the row the form was built from as ``original`` (and its
+        ``version`` as ``expected_version``, read from ``original`` when
+        omitted). The write then needs no pre-read and only succeeds if
+        nobody changed the row since it was loaded. Otherwise the result
+        has status "conflict" and carries the current row.
+        """
         try:
-            # Get current item data BEFORE update
-            old_response = self.supabase.table("inventory") \
-                .select("*") \
-                .eq("item_id", item_id) \
-                .execute()
-
-            if not old_response.data:
-                print(f"Item {item_id} not found for update")
-                return False
+            if original is not None:
+                old_data = clean_row(dict(original))
+                if expected_version is None:
+                    expected_version = _row_version(old_data)
+            else:
+                # No row from the caller: read it so the audit has old values
+                old_rows = self.backend.select("inventory", filters=[("item_id", "eq", item_id)])
+
+                if not old_rows:
+                    print(f"Item {item_id} not found for update")
+                    return UpdateResult("not_found", message=f"Item {item_id} not found")
 
-            old_data = old_response.data[0]
+                old_data = old_rows[0]
 
             # Filter out fields that haven't actually changed
             actual_changes = {}
@@ -148,9 +421,12 @@ class SupabaseDatabase:
                 if old_str != new_str:
                     actual_changes[field] = new_val
             
-            # If nothing actually changed, still log the attempt but return True
+            # If nothing actually changed, count the attempt (optionally log it) and return True
             if not actual_changes:
-                print(f"No actual changes for item {item_id}, but logging the update attempt")
+                self._count_audit("update_attempts")
+                if not self.record_update_attempts:
+                    return UpdateResult("noop", old_data, "No fields changed")
+
                 # Log a single entry for the update attempt
                 self._log_audit_event(
                     user=user,
@@ -164,131 +440,149 @@ class SupabaseDatabase:
                     ip_address=None,
                     user_agent=None
                 )
-                return True
+                return UpdateResult("noop", old_data, "No fields changed")
 
-            # Perform the update with only changed fields
-            response = self.supabase.table("inventory") \
-                .update(actual_changes) \
-                .eq("item_id", item_id) \
-                .execute()
+            # Perform the update with only changed fields, conditional on the version
+            result = self._versioned_update(item_id, actual_changes, expected_version)
 
-            if response.data:
-                # Get client info for audit
-                ip_address = None
-                user_agent = None
-                try:
-                    import streamlit as st
-                    ctx = st.runtime.get_instance()._session_mgr.list_active_sessions()[0].request
-                    if hasattr(ctx, 'headers'):
-                        headers = ctx.headers
-                        ip_address = headers.get('X-Forwarded-For', headers.get('Remote-Addr', 'Unknown'))
-                        user_agent = headers.get('User-Agent', 'Unknown')
-                except:
-                    pass
-
-                # Log each field that was actually changed
-                changed_fields = []
-                for field, new_val in actual_changes.items():
-                    old_val = old_data.get(field)
+            if result:
+                # Client info for audit, captured once per session by the caller
+                ip_address, user_agent = self._client_info(context)
+
+                # One bulk audit write for the whole edit
+                with self.audit_batch():
+                    # Log each field that was actually changed
+                    changed_fields = []
+                    for field, new_val in actual_changes.items():
+                        old_val = old_data.get(field)
                     
-                    # Determine action type based on field
-                    if field == 'expiry_date':
-                        action_type = "EXPIRY_UPDATE"
-                        notes = f"Updated expiry date for item {item_id}"
-                    elif field == 'quantity':
-                        # Check if this is usage-related or manual adjustment
-                        action_type = "QUANTITY_UPDATE"
-                        notes = f"Updated quantity for item {item_id}"
-                    elif field == 'reorder_level':
-                        action_type = "REORDER_LEVEL_UPDATE"
-                        notes = f"Updated reorder level for item {item_id}"
-                    else:
-                        action_type = "UPDATE"
-                        notes = f"Updated {field} for item {item_id}"
+                        # Determine action type based on field
+                        if field == 'expiry_date':
+                            action_type = "EXPIRY_UPDATE"
+                            notes = f"Updated expiry date for item {item_id}"
+                        elif field == 'quantity':
+                            # Check if this is usage-related or manual adjustment
+                            action_type = "QUANTITY_UPDATE"
+                            notes = f"Updated quantity for item {item_id}"
+                        elif field == 'reorder_level':
+                            action_type = "REORDER_LEVEL_UPDATE"
+                            notes = f"Updated reorder level for item {item_id}"
+                        else:
+                            action_type = "UPDATE"
+                            notes = f"Updated {field} for item {item_id}"
                     
+                        self._log_audit_event(
+                            user=user,
+                            action_type=action_type,
+                            table_name="inventory",
+                            record_id=item_id,
+                            field_name=field,
+                            old_value=old_val,
+                            new_value=new_val,
+                            notes=notes,
+                            ip_address=ip_address,
+                            user_agent=user_agent
+                        )
+                    
+                        changed_fields.append(field)
+                
+                    # Also log a summary audit event
                     self._log_audit_event(
                         user=user,
-                        action_type=action_type,
+                        action_type="ITEM_EDIT",
                         table_name="inventory",
                         record_id=item_id,
-                        field_name=field,
-                        old_value=old_val,
-                        new_value=new_val,
-                        notes=notes,
+                        field_name=None,
+                        old_value=None,
+                        new_value=None,
+                        notes=f"Edited item {old_data.get('item_name', item_id)}. Fields changed: {', '.join(changed_fields)}",
                         ip_address=ip_address,
                         user_agent=user_agent
                     )
-                    
-                    changed_fields.append(field)
-                
-                # Also log a summary audit event
-                self._log_audit_event(
-                    user=user,
-                    action_type="ITEM_EDIT",
-                    table_name="inventory",
-                    record_id=item_id,
-                    field_name=None,
-                    old_value=None,
-                    new_value=None,
-                    notes=f"Edited item {old_data.get('item_name', item_id)}. Fields changed: {', '.join(changed_fields)}",
-                    ip_address=ip_address,
-                    user_agent=user_agent
-                )
-                
-                return True
 
-            return False
+            return result
         except Exception as e:
             print("Update inventory error:", e)
             import traceback
             traceback.print_exc()
-            return False
+            return UpdateResult("error", message=str(e))
+
+    def _versioned_update(self, item_id: str, values: Dict, expected_version: int = None) -> "UpdateResult":
+        """Write ``values`` to one inventory row and return it, in a single call.
+
+        With ``expected_version`` the update only matches the row at that
+        version and sets the next one. Without it the write is
+        unconditional and the database trigger bumps the version.
+        Only a miss costs a second read, to tell "conflict" from "not_found".
+        """
+        values = dict(values)
+        filters = [("item_id", "eq", item_id)]
+        if expected_version is not None:
+            values["version"] = int(expected_version) + 1
+            values["updated_at"] = _utc_now()
+            filters.append(("version", "eq", int(expected_version)))
+
+        rows = self.backend.update("inventory", values, filters)
+        if rows:
+            self._patch_inventory(_upsert_items(rows))
+            return UpdateResult("ok", rows[0])
+
+        current = self.backend.select("inventory", filters=[("item_id", "eq", item_id)])
+        if not current:
+            self._patch_inventory(_drop_items([item_id]))
+            return UpdateResult("not_found", message=f"Item {item_id} not found")
+        # The cached row is the stale one; the conflict brings the current row in
+        self._patch_inventory(_upsert_items(current))
+        return UpdateResult(
+            "conflict", current[0],
+            f"Item {item_id} was changed by someone else (now version {current[0].get('version')}). "
+            "Reload it and try again."
+        )
 
     def adjust_inventory_quantity(self, item_id: str, adjustment_type: str, 
-                                  quantity: int, reason: str, user: Dict = None):
-        """Manually adjust inventory quantity (add or remove)"""
+                                  quantity: int, reason: str, user: Dict = None,
+                                  original: Dict = None, context: RequestContext = None):
+        """Manually adjust inventory quantity (add or remove).
+
+        The new quantity is computed from the row the caller loaded
+        (``original``) or from a fresh read, and written only if the row is
+        still at that version. If another write got in first, the current
+        row is used and the adjustment retried, up to three times.
+        """
         try:
-            # Get current quantity
-            response = self.supabase.table("inventory") \
-                .select("quantity, item_name") \
-                .eq("item_id", item_id) \
-                .execute()
-
-            if not response.data:
-                return False, "Item not found"
-
-            current_qty = response.data[0].get("quantity", 0)
-            item_name = response.data[0].get("item_name", item_id)
-            
-            # Calculate new quantity
-            if adjustment_type == "add":
-                new_qty = current_qty + quantity
-                action = "ADD_STOCK"
-            elif adjustment_type == "remove":
-                new_qty = max(0, current_qty - quantity)
-                action = "REMOVE_STOCK"
-            else:
-                return False, "Invalid adjustment type"
-
-            # Update inventory
-            update_response = self.supabase.table("inventory") \
-                .update({"quantity": new_qty}) \
-                .eq("item_id", item_id) \
-                .execute()
-
-            if update_response.data:
-                # Get client info for audit
-                ip_address = None
-                user_agent = None
-                try:
-                    import streamlit as st
-                    ctx = st.runtime.get_instance()._session_mgr.list_active_sessions()[0].request
-                    if hasattr(ctx, 'headers'):
-                        headers = ctx.headers
-                        ip_address = headers.get('X-Forwarded-For', headers.get('Remote-Addr', 'Unknown'))
-                        user_agent = headers.get('User-Agent', 'Unknown')
-                except:
-                    pass
+            row = clean_row(dict(original)) if original is not None else None
+
+            for _ in range(3):
+                if row is None:
+                    rows = self.backend.select(
+                        "inventory", "quantity, item_name, version", filters=[("item_id", "eq", item_id)]
+                    )
+                    if not rows:
+                        return False, "Item not found"
+                    row = rows[0]
+
+                current_qty = row.get("quantity") or 0
+                item_name = row.get("item_name", item_id)
+                
+                # Calculate new quantity
+                if adjustment_type == "add":
+                    new_qty = current_qty + quantity
+                    action = "ADD_STOCK"
+                elif adjustment_type == "remove":
+                    new_qty = max(0, current_qty - quantity)
+                    action = "REMOVE_STOCK"
+                else:
+                    return False, "Invalid adjustment type"
+
+                # Update inventory only if nobody changed it since it was read
+                result = self._versioned_update(item_id, {"quantity": new_qty}, _row_version(row))
+                if result.status != "conflict":
+                    break
+                row = result.row
+
+            if result:
+                # Client info for audit, captured once per session by the caller
+                ip_address, user_agent = self._client_info(context)
 
                 # Log the adjustment
                 self._log_audit_event(
@@ -305,49 +599,93 @@ class SupabaseDatabase:
                 )
                 return True, f"Successfully {adjustment_type}ed {quantity} units"
 
-            return False, "Failed to update inventory"
+            return False, result.message or "Failed to update inventory"
         except Exception as e:
             print("Adjust inventory quantity error:", e)
             return False, str(e)
-    
+
+    # ------------------------------------------------------------------
+    # BULK QUANTITY RESET
+    # ------------------------------------------------------------------
+    def bulk_set_quantities(self, mapping: Dict[str, int], user: Dict = None,
+                            reason: str = "Bulk quantity update", context: RequestContext = None) -> int:
+        """Set many items' quantities with one update per distinct quantity.
+
+        ``mapping`` is item_id -> new quantity. Items sharing a target
+        quantity are written together with an ``item_id in (...)`` update,
+        so a category-default reset takes a handful of calls rather than
+        one per item. Writes one summary audit event and returns the
+        number of rows updated.
+        """
+        by_quantity: Dict[int, List[str]] = {}
+        for item_id, quantity in mapping.items():
+            by_quantity.setdefault(int(quantity), []).append(item_id)
+
+        updated_count = 0
+        updated_rows = []
+        try:
+            for quantity, item_ids in by_quantity.items():
+                for start in range(0, len(item_ids), self.BULK_FILTER_SIZE):
+                    chunk = item_ids[start:start + self.BULK_FILTER_SIZE]
+                    updated = self.backend.update("inventory", {"quantity": quantity}, [("item_id", "in", chunk)])
+                    updated_count += len(updated)
+                    updated_rows.extend(updated)
+        except Exception as e:
+            print("Bulk quantity update error:", e)
+            traceback.print_exc()
+        self._patch_inventory(_upsert_items(updated_rows))
+
+        summary = ", ".join(f"{len(ids)} items -> {qty}" for qty, ids in sorted(by_quantity.items()))
+        ip_address, user_agent = self._client_info(context)
+        self._log_audit_event(
+            user=user,
+            action_type="BULK_QUANTITY_SET",
+            table_name="inventory",
+            record_id="ALL" if updated_count else None,
+            field_name="quantity",
+            old_value=None,
+            new_value=f"{updated_count} records",
+            notes=f"{reason}: {updated_count} of {len(mapping)} items updated ({summary})",
+            ip_address=ip_address,
+            user_agent=user_agent
+        )
+        return updated_count
+
+    def reset_inventory_to_defaults(self, user: Dict = None, context: RequestContext = None) -> int:
+        """Reset every item's quantity to its category default (see default_reset_quantity)"""
+        mapping = {}
+        for frame in self.iter_inventory(columns="item_id, item_name, category"):
+            for item_id, item_name, category in zip(frame["item_id"], frame["item_name"], frame["category"]):
+                mapping[item_id] = default_reset_quantity(category, item_name)
+
+        return self.bulk_set_quantities(mapping, user, reason="System reset to category defaults",
+                                        context=context)
+
     # ------------------------------------------------------------------
     # DELETE INVENTORY ITEM
     # ------------------------------------------------------------------
-    def delete_inventory_item(self, item_id: str, user: Dict = None, reason: str = ""):
+    def delete_inventory_item(self, item_id: str, user: Dict = None, reason: str = "",
+                              context: RequestContext = None):
         """Delete an inventory item permanently"""
         try:
             # Get current item data BEFORE deletion for audit
-            old_response = self.supabase.table("inventory") \
-                .select("*") \
-                .eq("item_id", item_id) \
-                .execute()
+            old_rows = self.backend.select("inventory", filters=[("item_id", "eq", item_id)])
 
-            if not old_response.data:
+            if not old_rows:
                 print(f"Item {item_id} not found for deletion")
                 return False
 
-            old_data = old_response.data[0]
+            old_data = old_rows[0]
             item_name = old_data.get('item_name', item_id)
 
             # Perform the deletion
-            response = self.supabase.table("inventory") \
-                .delete() \
-                .eq("item_id", item_id) \
-                .execute()
-
-            if response.data:
-                # Get client info for audit
-                ip_address = None
-                user_agent = None
-                try:
-                    import streamlit as st
-                    ctx = st.runtime.get_instance()._session_mgr.list_active_sessions()[0].request
-                    if hasattr(ctx, 'headers'):
-                        headers = ctx.headers
-                        ip_address = headers.get('X-Forwarded-For', headers.get('Remote-Addr', 'Unknown'))
-                        user_agent = headers.get('User-Agent', 'Unknown')
-                except:
-                    pass
+            deleted = self.backend.delete("inventory", [("item_id", "eq", item_id)])
+
+            if deleted:
+                self._patch_inventory(_drop_items([item_id]))
+
+                # Client info for audit, captured once per session by the caller
+                ip_address, user_agent = self._client_info(context)
 
                 # Log the deletion
                 notes = f"Deleted item: {item_name}"
@@ -384,16 +722,20 @@ class SupabaseDatabase:
         usage_data: Dict,
         user: Dict = None,
         ip_address: str = None,
-        user_agent: str = None
+        user_agent: str = None,
+        context: RequestContext = None
     ):
         try:
+            if context is not None and ip_address is None and user_agent is None:
+                ip_address, user_agent = self._client_info(context)
+
             item_id = usage_data.get("item_id")
             units_used = int(usage_data.get("units_used", 0))
 
             if not item_id or units_used <= 0:
                 return False
 
-            # 1. Insert into usage_logs (MATCHES TABLE EXACTLY)
+            # Usage row (MATCHES TABLE EXACTLY)
             log_data = {
                 "item_id": item_id,
                 "item_name": usage_data.get("item_name", ""),
@@ -405,60 +747,50 @@ class SupabaseDatabase:
                 "usage_date": datetime.now().isoformat()
             }
 
-            usage_response = self.supabase.table("usage_logs") \
-                .insert(log_data) \
-                .execute()
-
-            if not usage_response.data:
-                return False
-
-            # 2. Get current inventory quantity
-            inv_response = self.supabase.table("inventory") \
-                .select("quantity") \
-                .eq("item_id", item_id) \
-                .execute()
+            # Insert the usage row and decrement stock atomically in one call,
+            # so concurrent usage of the same item cannot lose an update
+            result = self.backend.record_usage(log_data)
 
-            if not inv_response.data:
+            if not result:
                 return False
 
-            old_qty = inv_response.data[0].get("quantity", 0)
-            new_qty = max(old_qty - units_used, 0)
+            usage_row = result["usage"]
+            old_qty = result["old_quantity"]
+            new_qty = result["new_quantity"]
 
-            # 3. Update inventory
-            update_response = self.supabase.table("inventory") \
-                .update({"quantity": new_qty}) \
-                .eq("item_id", item_id) \
-                .execute()
+            # Only this item's row changes; other cached reads stay warm
+            self._patch_inventory(_consume_stock(item_id, new_qty))
+            self.cache.invalidate("usage_logs")
 
-            # 4. Audit BOTH events: usage logging AND inventory update
-            
-            # Audit the usage log creation
-            self._log_audit_event(
-                user=user,
-                action_type="USAGE",
-                table_name="usage_logs",
-                record_id=usage_response.data[0].get('id') if usage_response.data else None,
-                field_name="units_used",
-                old_value=None,
-                new_value=units_used,
-                notes=f"Used {units_used} units of {usage_data.get('item_name', item_id)}",
-                ip_address=ip_address,
-                user_agent=user_agent
-            )
+            # Audit BOTH events: usage logging AND inventory update in one bulk write
+            with self.audit_batch():
+                # Audit the usage log creation
+                self._log_audit_event(
+                    user=user,
+                    action_type="USAGE",
+                    table_name="usage_logs",
+                    record_id=usage_row.get('id'),
+                    field_name="units_used",
+                    old_value=None,
+                    new_value=units_used,
+                    notes=f"Used {units_used} units of {usage_data.get('item_name', item_id)}",
+                    ip_address=ip_address,
+                    user_agent=user_agent
+                )
             
-            # Audit the inventory change
-            self._log_audit_event(
-                user=user,
-                action_type="INVENTORY_USAGE",
-                table_name="inventory",
-                record_id=item_id,
-                field_name="quantity",
-                old_value=old_qty,
-                new_value=new_qty,
-                notes=f"Used {units_used} units - {usage_data.get('purpose', '')}",
-                ip_address=ip_address,
-                user_agent=user_agent
-            )
+                # Audit the inventory change
+                self._log_audit_event(
+                    user=user,
+                    action_type="INVENTORY_USAGE",
+                    table_name="inventory",
+                    record_id=item_id,
+                    field_name="quantity",
+                    old_value=old_qty,
+                    new_value=new_qty,
+                    notes=f"Used {units_used} units - {usage_data.get('purpose', '')}",
+                    ip_address=ip_address,
+                    user_agent=user_agent
+                )
 
             return True
 
@@ -470,36 +802,20 @@ class SupabaseDatabase:
     # ------------------------------------------------------------------
     # CLEAR ALL USAGE LOGS (FOR RESET FUNCTIONALITY)
     # ------------------------------------------------------------------
-    def clear_all_usage_logs(self, user: Dict = None):
+    def clear_all_usage_logs(self, user: Dict = None, context: RequestContext = None):
         """Clear all usage logs from the database (for system reset)"""
         try:
             # Get count of logs before deletion for audit
-            count_response = self.supabase.table("usage_logs") \
-                .select("*", count="exact") \
-                .execute()
-            
-            log_count = count_response.count if hasattr(count_response, 'count') else 0
+            log_count = self.backend.count("usage_logs")
             
             # Delete all usage logs
-            response = self.supabase.table("usage_logs") \
-                .delete() \
-                .neq("id", 0) \
-                .execute()
+            deleted = self.backend.delete("usage_logs", [("id", "neq", 0)])
+            self.cache.invalidate("usage_logs")
             
-            deleted_count = len(response.data) if response.data else 0
+            deleted_count = len(deleted)
             
-            # Get client info for audit
-            ip_address = None
-            user_agent = None
-            try:
-                import streamlit as st
-                ctx = st.runtime.get_instance()._session_mgr.list_active_sessions()[0].request
-                if hasattr(ctx, 'headers'):
-                    headers = ctx.headers
-                    ip_address = headers.get('X-Forwarded-For', headers.get('Remote-Addr', 'Unknown'))
-                    user_agent = headers.get('User-Agent', 'Unknown')
-            except:
-                pass
+            # Client info for audit, captured once per session by the caller
+            ip_address, user_agent = self._client_info(context)
             
             # Log the reset action
             self._log_audit_event(
@@ -539,6 +855,12 @@ class SupabaseDatabase:
         user_agent: str = None
     ):
         try:
+            # A field-level event that changes nothing is noise; never store it
+            if (field_name is not None and old_value is not None and new_value is not None
+                    and str(old_value) == str(new_value)):
+                self._count_audit("suppressed_noops")
+                return True
+
             audit_data = {
                 "timestamp": datetime.now().isoformat(),
                 "user_id": user.get("username") if user else "system",
@@ -554,51 +876,161 @@ class SupabaseDatabase:
                 "user_agent": user_agent
             }
             
-            # Insert into audit logs
-            response = self.supabase.table("audit_logs").insert(audit_data).execute()
-            
+            # Inside audit_batch() the event waits for the operation's bulk write
+            buffer = getattr(self._audit_local, "buffer", None)
+            if buffer is not None:
+                return buffer.add(audit_data)
+
+            return self._submit_audit_rows([audit_data])
+
+        except Exception as e:
+            print("Audit log error:", e)
+            import traceback
+            traceback.print_exc()
+            return False
+
+    def _submit_audit_rows(self, rows: List[Dict]):
+        """Hand audit rows to the background queue, or write them now if it is disabled"""
+        if self.audit_queue is not None:
+            return self.audit_queue.put_many(rows)
+        return self._write_audit_rows(rows)
+
+    def _audit_spill_path(self) -> str:
+        """STORAGE_AUDIT_SPOOL for the configured engine; another engine opened in
+        the same process (e.g. by benchmark_backends) spills to <name>.<engine><ext>"""
+        path = _storage_setting("AUDIT_SPOOL", "audit_spool.jsonl")
+        if self.backend.name == _storage_setting("BACKEND", "supabase").lower():
+            return path
+        root, ext = os.path.splitext(path)
+        return f"{root}.{self.backend.name}{ext}"
+
+    def _write_audit_rows(self, rows: List[Dict]):
+        """Insert audit rows now (no queue); False if the insert failed"""
+        try:
+            return self._insert_audit_rows(rows)
+        except Exception as e:
+            print("Audit log error:", e)
+            traceback.print_exc()
+            return False
+
+    def _insert_audit_rows(self, rows: List[Dict]):
+        """Insert audit rows plus their AUDIT_CREATE meta-audits: two bulk inserts in total.
+
+        A failed audit insert raises, so the audit queue can tell an outage
+        from rows the database rejects.
+        """
+        inserted = self.backend.insert("audit_logs", rows)
+        self.cache.invalidate("audit_logs")
+
+        # The rows are stored at this point; a failed meta-audit must not make
+        # the audit queue retry (and duplicate) them
+        try:
             # Also log the audit creation itself (meta-audit)
-            if response.data:
-                meta_audit = audit_data.copy()
+            meta_audits = []
+            for row in inserted:
+                meta_audit = {k: v for k, v in row.items() if k != 'id'}
                 meta_audit['action_type'] = 'AUDIT_CREATE'
                 meta_audit['table_name'] = 'audit_logs'
-                meta_audit['record_id'] = response.data[0].get('id')
+                meta_audit['record_id'] = str(row.get('id'))
                 meta_audit['notes'] = 'Audit log entry created'
-                
-                self.supabase.table("audit_logs").insert(meta_audit).execute()
+                meta_audits.append(meta_audit)
             
-            return True
+            if meta_audits:
+                self.backend.insert("audit_logs", meta_audits)
 
         except Exception as e:
-            print("Audit log error:", e)
-            import traceback
-            traceback.print_exc()
-            return False
+            print("Meta-audit log error:", e)
+
+        return True
+
+    @staticmethod
+    def _client_info(context: RequestContext = None):
+        """(ip_address, user_agent) for audit rows, from the caller's RequestContext"""
+        if context is None:
+            return None, None
+        return context.ip_address, context.user_agent
+
+    def _patch_inventory(self, update):
+        """Apply a write to the cached inventory frame; drop the other cached inventory queries"""
+        self.cache.patch("inventory", "all", update)
+        # Same patch on the sync's resident copy, so both agree until the next delta
+        self.inventory_sync.apply(update)
+        self.cache.invalidate("inventory", keep=("all",))
+
+    def cache_stats(self) -> Dict:
+        """Hit/miss counters of the shared read cache"""
+        return self.cache.stats()
+
+    def get_data_versions(self) -> Dict[str, int]:
+        """table -> change counter, bumped by database triggers on every write ({} if unavailable)"""
+        try:
+            rows = self.backend.select("data_versions", "table_name, version")
+            return {row["table_name"]: row["version"] for row in rows}
+        except Exception as e:
+            print("Get data versions error:", e)
+            return {}
+
+    def check_data_versions(self) -> Dict[str, int]:
+        """Drop cached reads of every table changed since the last check; call once per rerun.
+
+        One tiny query. Tables that did not change keep their cached reads
+        however old they are.
+        """
+        versions = self.get_data_versions()
+        self.cache.sync_versions(versions)
+        return versions
+
+    def sync_stats(self) -> Dict:
+        """Full loads, delta syncs and rows fetched by the inventory sync"""
+        return self.inventory_sync.stats()
+
+    def _count_audit(self, counter: str):
+        with self._audit_counters_lock:
+            self.audit_counters[counter] += 1
+
+    def health(self) -> Dict:
+        """Last background health probe plus circuit breaker state (empty when neither applies)"""
+        status = self.health_probe.status() if self.health_probe is not None else {}
+        if isinstance(self.backend, ResilientBackend):
+            status.update(self.backend.status())
+        return status
+
+    def is_degraded(self) -> bool:
+        """True while the backend is failing and reads may be last-known-good copies"""
+        return bool(getattr(self.backend, "degraded", False))
+
+    def audit_queue_stats(self) -> Dict:
+        """Counters from the background audit queue (empty when it is disabled)"""
+        if self.audit_queue is None:
+            return {}
+        return self.audit_queue.stats()
+
+    @contextmanager
+    def audit_batch(self):
+        """Buffer every audit event logged inside the block and flush them as one bulk insert.
+
+        The buffer also flushes on size/age (see AuditBuffer) and always
+        flushes when the block exits, even on error. Nested blocks join the
+        outermost batch.
+        """
+        if getattr(self._audit_local, "buffer", None) is not None:
+            yield self._audit_local.buffer
+            return
+
+        buffer = AuditBuffer(self._submit_audit_rows)
+        self._audit_local.buffer = buffer
+        try:
+            yield buffer
+        finally:
+            self._audit_local.buffer = None
+            buffer.flush()
 
     def cleanup_duplicate_audits(self):
         """Remove duplicate audit entries where old and new values are the same"""
         try:
-            # Get all UPDATE audit entries
-            response = self.supabase.table("audit_logs") \
-                .select("*") \
-                .eq("action_type", "UPDATE") \
-                .execute()
-            
-            duplicates_found = 0
-            for audit in response.data:
-                old_val = audit.get('old_value')
-                new_val = audit.get('new_value')
-                
-                # Check if values are the same
-                if old_val and new_val and str(old_val) == str(new_val):
-                    # Delete duplicate entry
-                    delete_response = self.supabase.table("audit_logs") \
-                        .delete() \
-                        .eq("id", audit['id']) \
-                        .execute()
-                    
-                    if delete_response.data:
-                        duplicates_found += 1
+            # Detection and deletion run as a single statement in the database
+            duplicates_found = self.backend.delete_redundant_audits()
+            self.cache.invalidate("audit_logs")
             
             print(f"Cleaned up {duplicates_found} duplicate audit entries")
             return duplicates_found
@@ -610,6 +1042,29 @@ class SupabaseDatabase:
     # ------------------------------------------------------------------
     # REPORTING
     # ------------------------------------------------------------------
+    @staticmethod
+    def _audit_filters(start_date=None, end_date=None, user_id=None, action_type=None,
+                       table_name=None, record_id=None) -> List:
+        filters = []
+
+        if start_date:
+            filters.append(("timestamp", "gte", start_date))
+        if end_date:
+            filters.append(("timestamp", "lte", end_date))
+        if user_id:
+            filters.append(("user_id", "eq", user_id))
+        if action_type:
+            filters.append(("action_type", "eq", action_type))
+        if table_name:
+            filters.append(("table_name", "eq", table_name))
+        if record_id is not None:
+            if isinstance(record_id, (list, tuple, set)):
+                filters.append(("record_id", "in", [str(r) for r in record_id]))
+            else:
+                filters.append(("record_id", "eq", str(record_id)))
+
+        return filters
+
     def get_audit_logs(
         self,
         start_date: str = None,
@@ -617,78 +1072,154 @@ class SupabaseDatabase:
         user_id: str = None,
         action_type: str = None,
         table_name: str = None,
-        limit: int = 200
+        limit: int = 200,
+        record_id=None,
+        before: Tuple = None
     ):
+        """Audit rows, newest first (by timestamp, then id).
+
+        ``record_id`` takes one id or a list of ids. Together with
+        ``table_name`` it is served by the (table_name, record_id, timestamp)
+        index. For the next page, pass the last row's ``(timestamp, id)`` as
+        ``before``.
+        """
         try:
-            query = self.supabase.table("audit_logs").select("*")
-    
-            if start_date:
-                query = query.gte("timestamp", start_date)
-            if end_date:
-                query = query.lte("timestamp", end_date)
-            if user_id:
-                query = query.eq("user_id", user_id)
-            if action_type:
-                query = query.eq("action_type", action_type)
-            if table_name:
-                query = query.eq("table_name", table_name)
+            filters = self._audit_filters(start_date, end_date, user_id, action_type,
+                                          table_name, record_id)
     
-            response = query.order("timestamp", desc=True).limit(limit).execute()
-    
-            return pd.DataFrame(response.data)
+            return self.cache.get(
+                "audit_logs", ("logs", repr(filters), limit, repr(before)),
+                lambda: pd.DataFrame(self._audit_page(filters, limit, before))
+            )
     
         except Exception as e:
             print("Get audit logs error:", e)
             print(traceback.format_exc())
             return pd.DataFrame()
 
-
-    def get_usage_stats(self):
+    def _audit_page(self, filters: List, limit: int = None, before: Tuple = None) -> List[Dict]:
+        # Keyset on (timestamp, id): rows sharing the cursor's timestamp are
+        # split at the id, so none are skipped at a page boundary. Filters
+        # are AND-only, so that is the rest of the cursor's timestamp first,
+        # then everything older.
+        order = ("timestamp", "id")
+        if before is None:
+            return self.backend.select("audit_logs", filters=filters, order=order, desc=True, limit=limit)
+
+        before_timestamp, before_id = before
+        rows = self.backend.select("audit_logs", filters=filters + [("timestamp", "eq", before_timestamp),
+                                                                    ("id", "lt", before_id)],
+                                   order="id", desc=True, limit=limit)
+        if limit is None or len(rows) < limit:
+            rows += self.backend.select("audit_logs", filters=filters + [("timestamp", "lt", before_timestamp)],
+                                        order=order, desc=True,
+                                        limit=None if limit is None else limit - len(rows))
+        return rows
+
+    def count_audit_logs(
+        self,
+        start_date: str = None,
+        end_date: str = None,
+        user_id: str = None,
+        action_type: str = None,
+        table_name: str = None,
+        record_id=None
+    ) -> int:
+        """Exact number of audit rows matching the same filters as get_audit_logs"""
         try:
-            response = self.supabase.table("usage_logs").select("*").execute()
-            df = pd.DataFrame(response.data)
+            filters = self._audit_filters(start_date, end_date, user_id, action_type,
+                                          table_name, record_id)
+            return self.cache.get("audit_logs", ("count", repr(filters)),
+                                  lambda: self.backend.count("audit_logs", filters))
+        except Exception as e:
+            print("Count audit logs error:", e)
+            return 0
 
-            if df.empty:
-                return df
 
-            return (
-                df.groupby("item_name")
-                .agg(
+    def get_usage_stats(self):
+        """Per-item usage totals, aggregated by the database"""
+        try:
+            return self.cache.get("usage_logs", "stats", self._load_usage_stats)
+        except Exception as e:
+            # View not migrated yet - aggregate the raw log locally instead
+            print("Usage stats view unavailable, aggregating locally:", e)
+            return self._aggregate_usage_locally()
+
+    def _load_usage_stats(self):
+        # Paged like the other large reads, so the PostgREST max-rows cap cannot
+        # truncate it. A NULL item_name group cannot be a keyset cursor; it is
+        # at most one row and is read on its own.
+        rows = []
+        for page in self.backend.iter_pages(USAGE_STATS_VIEW, "item_name", filters=[("item_name", "not_null", None)],
+                                            page_size=self.PAGE_SIZE):
+            rows.extend(page)
+        rows.extend(self.backend.select(USAGE_STATS_VIEW, filters=[("item_name", "is_null", None)]))
+        return pd.DataFrame(rows)
+
+    def _aggregate_usage_locally(self):
+        try:
+            # Aggregate page by page so the raw log is never held in memory at once
+            partials = [
+                page.groupby("item_name").agg(
                     total_units_used=("units_used", "sum"),
                     usage_count=("usage_date", "count")
                 )
-                .reset_index()
-            )
+                for page in self.iter_usage_logs()
+            ]
+
+            if not partials:
+                return pd.DataFrame()
+
+            return pd.concat(partials).groupby(level=0).sum().reset_index()
 
         except Exception:
             return pd.DataFrame()
 
     def get_all_users(self):
         try:
-            response = self.supabase.table("users").select("*").execute()
-            return pd.DataFrame(response.data)
+            return pd.DataFrame(self.backend.select("users"))
         except Exception:
             return pd.DataFrame()
 
     # ------------------------------------------------------------------
     # EXPIRY MANAGEMENT
     # ------------------------------------------------------------------
-    def get_expired_items(self):
-        """Get items with expiry dates and calculate days to expiry"""
+    @staticmethod
+    def _expiry_window(after_days: int = None, within_days: int = None):
+        """Filters for today + after_days < expiry_date <= today + within_days"""
+        today = datetime.now().date()
+        filters = [("expiry_date", "not_null", None)]
+        if after_days is not None:
+            filters.append(("expiry_date", "gt", (today + timedelta(days=after_days)).isoformat()))
+        if within_days is not None:
+            filters.append(("expiry_date", "lte", (today + timedelta(days=within_days)).isoformat()))
+        return filters
+
+    def get_expired_items(self, bucket: str = "all", within_days: int = None):
+        """Get items with expiry dates and calculate days to expiry.
+
+        The date window is evaluated by the database:
+        - bucket="expired":  expiry_date <= today
+        - bucket="expiring": today < expiry_date <= today + within_days (default 30)
+        - bucket="all":      every dated item, or expiry_date <= today + within_days
+        """
         try:
-            # Get all items with expiry dates
-            response = self.supabase.table("inventory") \
-                .select("*") \
-                .not_.is_("expiry_date", "null") \
-                .execute()
-            
-            df = pd.DataFrame(response.data)
+            if bucket == "expired":
+                filters = self._expiry_window(within_days=0)
+            elif bucket == "expiring":
+                filters = self._expiry_window(after_days=0, within_days=within_days if within_days is not None else 30)
+            elif bucket == "all":
+                filters = self._expiry_window(within_days=within_days)
+            else:
+                raise ValueError(f"Unknown expiry bucket: {bucket}")
+
+            df = self.cache.get("inventory", ("expiry", repr(filters)), lambda: self._load_expiry_window(filters))
             
             if df.empty:
                 return df
             
-            # Calculate days to expiry
-            current_date = pd.Timestamp.now()
+            # Calculate days to expiry (calendar days, matching the date window)
+            current_date = pd.Timestamp.now().normalize()
             df['expiry_date_dt'] = pd.to_datetime(df['expiry_date'], errors='coerce')
             df['days_to_expiry'] = (df['expiry_date_dt'] - current_date).dt.days
             
@@ -698,35 +1229,95 @@ class SupabaseDatabase:
             print("Get expired items error:", e)
             return pd.DataFrame()
 
+    def _load_expiry_window(self, filters):
+        # Paged on item_id so the PostgREST max-rows cap cannot cut the window short
+        rows = []
+        for page in self.backend.iter_pages("inventory", "item_id", filters=filters, page_size=self.PAGE_SIZE):
+            rows.extend(page)
+        df = pd.DataFrame(rows)
+        if df.empty:
+            return df
+        return df.sort_values(["expiry_date", "item_id"], ignore_index=True)
 
-    def get_usage_trends(self):
-        """Get detailed usage data for trend analysis"""
+    def count_expiry_buckets(self):
+        """Count dated items per EXPIRY_BUCKETS entry without fetching the rows"""
         try:
-            response = self.supabase.table("usage_logs") \
-                .select("*") \
-                .order("usage_date", desc=True) \
-                .limit(1000) \
-                .execute()
-            
-            return pd.DataFrame(response.data)
+            # Keyed on the date: the buckets move at midnight
+            return self.cache.get("inventory", ("expiry_counts", datetime.now().date().isoformat()), lambda: {
+                label: self.backend.count("inventory", self._expiry_window(after_days, within_days))
+                for label, after_days, within_days in EXPIRY_BUCKETS
+            })
+        except Exception as e:
+            print("Count expiry buckets error:", e)
+            return {label: 0 for label, _, _ in EXPIRY_BUCKETS}
+
+
+    def get_usage_trends(self, start=None, end=None, granularity: str = "day",
+                         items: List[str] = None, top_n: int = None):
+        """Units used per time bucket and item, for usage in [start, end).
+
+        The database buckets the whole window (``granularity`` is day,
+        week, month or quarter), so the result has at most buckets x items
+        rows however many usage events there are. ``top_n`` keeps only the
+        items with the most units in the window. Columns: bucket (first
+        day of the period), item_name, units_used, usage_count.
+        """
+        try:
+            if granularity not in TREND_GRANULARITIES:
+                raise ValueError(f"Unknown granularity: {granularity}")
+            start, end = _window_bound(start), _window_bound(end)
+            items = sorted(items) if items else None
+
+            def load():
+                df = pd.DataFrame(self.backend.usage_trends(start, end, granularity, items, top_n))
+                if not df.empty:
+                    df["bucket"] = pd.to_datetime(df["bucket"])
+                return df
+
+            key = ("trends", start, end, granularity, tuple(items or ()), top_n)
+            return self.cache.get("usage_logs", key, load)
             
         except Exception as e:
             print("Get usage trends error:", e)
             return pd.DataFrame()
 
+    def get_usage_breakdown(self, start=None, end=None, dimension: str = "department",
+                            items: List[str] = None):
+        """Units used per item and department, purpose or weekday (0 = Monday), for usage in [start, end).
+
+        Aggregated by the database; the first column is named after ``dimension``.
+        """
+        try:
+            if dimension not in USAGE_BREAKDOWNS:
+                raise ValueError(f"Unknown usage breakdown: {dimension}")
+            start, end = _window_bound(start), _window_bound(end)
+            items = sorted(items) if items else None
+
+            def load():
+                df = pd.DataFrame(self.backend.usage_breakdown(start, end, dimension, items))
+                if df.empty:
+                    return df
+                if dimension == "weekday":
+                    df["dimension"] = df["dimension"].astype(int)
+                return df.rename(columns={"dimension": dimension})
+
+            key = ("breakdown", start, end, dimension, tuple(items or ()))
+            return self.cache.get("usage_logs", key, load)
+
+        except Exception as e:
+            print("Get usage breakdown error:", e)
+            return pd.DataFrame()
+
     # ------------------------------------------------------------------
     # USAGE HISTORY - INDIVIDUAL ENTRIES
     # ------------------------------------------------------------------
     def get_usage_history(self, limit: int = 100):
         """Get individual usage log entries"""
         try:
-            response = self.supabase.table("usage_logs") \
-                .select("*") \
-                .order("usage_date", desc=True) \
-                .limit(limit) \
-                .execute()
-            
-            return pd.DataFrame(response.data)
+            return self.cache.get(
+                "usage_logs", ("history", limit),
+                lambda: pd.DataFrame(self.backend.select("usage_logs", order="usage_date", desc=True, limit=limit))
+            )
             
         except Exception as e:
             print("Get usage history error:", e)
@@ -735,31 +1326,7 @@ class SupabaseDatabase:
 
     def get_items_expiring_soon(self, days_threshold: int = 30):
         """Get items expiring within the specified number of days"""
-        try:
-            # Get all items with expiry dates
-            response = self.supabase.table("inventory") \
-                .select("*") \
-                .not_.is_("expiry_date", "null") \
-                .execute()
-            
-            df = pd.DataFrame(response.data)
-            
-            if df.empty:
-                return df
-            
-            # Calculate days to expiry
-            current_date = pd.Timestamp.now()
-            df['expiry_date_dt'] = pd.to_datetime(df['expiry_date'], errors='coerce')
-            df['days_to_expiry'] = (df['expiry_date_dt'] - current_date).dt.days
-            
-            # Filter items expiring within the threshold
-            expiring_soon = df[(df['days_to_expiry'] > 0) & (df['days_to_expiry'] <= days_threshold)]
-            
-            return expiring_soon
-            
-        except Exception as e:
-            print("Get items expiring soon error:", e)
-            return pd.DataFrame()
+        return self.get_expired_items(bucket="expiring", within_days=days_threshold)
 
 
     # ------------------------------------------------------------------
@@ -768,12 +1335,8 @@ class SupabaseDatabase:
     def get_all_users(self):
         """Get all users from the database"""
         try:
-            response = self.supabase.table("users") \
-                .select("*") \
-                .order("username") \
-                .execute()
-            
-            return pd.DataFrame(response.data)
+            return self.cache.get("users", "all",
+                                  lambda: pd.DataFrame(self.backend.select("users", order="username")))
             
         except Exception as e:
             print("Get all users error:", e)
@@ -796,9 +1359,10 @@ class SupabaseDatabase:
             # Add creation timestamp
             user_data['created_at'] = datetime.now().isoformat()
             
-            response = self.supabase.table("users").insert(user_data).execute()
+            inserted = self.backend.insert("users", user_data)
             
-            if response.data:
+            if inserted:
+                self.cache.invalidate("users")
                 # Audit the creation
                 self._log_audit_event(
                     user=current_user,
@@ -821,12 +1385,9 @@ class SupabaseDatabase:
         """Update user information"""
         try:
             # Get current user data for audit
-            current_response = self.supabase.table("users") \
-                .select("*") \
-                .eq("username", username) \
-                .execute()
+            current_rows = self.backend.select("users", filters=[("username", "eq", username)])
             
-            old_data = current_response.data[0] if current_response.data else {}
+            old_data = current_rows[0] if current_rows else {}
             
             # If password is being updated, hash it
             if 'password' in updates:
@@ -835,28 +1396,27 @@ class SupabaseDatabase:
                 updates['password_hash'] = bcrypt.hashpw(password.encode(), salt).decode()
                 updates['last_password_change'] = datetime.now().isoformat()
             
-            response = self.supabase.table("users") \
-                .update(updates) \
-                .eq("username", username) \
-                .execute()
+            updated = self.backend.update("users", updates, [("username", "eq", username)])
             
-            if response.data:
+            if updated:
+                self.cache.invalidate("users")
                 # Audit the update for each changed field
-                for field, new_value in updates.items():
-                    old_value = old_data.get(field)
-                    if field != 'password_hash':  # Don't log password hash
-                        self._log_audit_event(
-                            user=current_user,
-                            action_type="USER_UPDATE",
-                            table_name="users",
-                            record_id=username,
-                            field_name=field,
-                            old_value=old_value,
-                            new_value=new_value,
-                            notes=f"Updated user {username}",
-                            ip_address=ip_address,
-                            user_agent=user_agent
-                        )
+                with self.audit_batch():
+                    for field, new_value in updates.items():
+                        old_value = old_data.get(field)
+                        if field != 'password_hash':  # Don't log password hash
+                            self._log_audit_event(
+                                user=current_user,
+                                action_type="USER_UPDATE",
+                                table_name="users",
+                                record_id=username,
+                                field_name=field,
+                                old_value=old_value,
+                                new_value=new_value,
+                                notes=f"Updated user {username}",
+                                ip_address=ip_address,
+                                user_agent=user_agent
+                            )
                 return True, "User updated successfully"
             return False, "Failed to update user"
             
@@ -869,19 +1429,14 @@ class SupabaseDatabase:
         """Delete a user from the system"""
         try:
             # Get user data before deletion for audit
-            current_response = self.supabase.table("users") \
-                .select("*") \
-                .eq("username", username) \
-                .execute()
+            current_rows = self.backend.select("users", filters=[("username", "eq", username)])
             
-            user_data = current_response.data[0] if current_response.data else {}
+            user_data = current_rows[0] if current_rows else {}
             
-            response = self.supabase.table("users") \
-                .delete() \
-                .eq("username", username) \
-                .execute()
+            deleted = self.backend.delete("users", [("username", "eq", username)])
             
-            if response.data:
+            if deleted:
+                self.cache.invalidate("users")
                 # Audit the deletion
                 self._log_audit_event(
                     user=current_user,
@@ -904,15 +1459,39 @@ class SupabaseDatabase:
     def get_user_by_username(self, username: str):
         """Get a specific user by username"""
         try:
-            response = self.supabase.table("users") \
-                .select("*") \
-                .eq("username", username) \
-                .execute()
+            rows = self.backend.select("users", filters=[("username", "eq", username)])
             
-            if response.data:
-                return response.data[0]
+            if rows:
+                return rows[0]
             return None
             
         except Exception as e:
             print("Get user by username error:", e)
             return None
+
+
+# ------------------------------------------------------------------
+# Process-wide registry
+# ------------------------------------------------------------------
+_databases: Dict[str, SupabaseDatabase] = {}
+_databases_lock = threading.Lock()
+
+
+def get_database(engine: str = None) -> SupabaseDatabase:
+    """Return the shared SupabaseDatabase for ``engine``, creating it once per process.
+
+    main_app, SimpleAuth and the CLI scripts all use this, so the client,
+    its pooled keep-alive connections and the TLS handshake are set up
+    once instead of per entry point. The first call also starts a health
+    probe that pings the backend every STORAGE_HEALTH_INTERVAL seconds
+    (0 disables it).
+    """
+    engine = (engine or _storage_setting("BACKEND", "supabase")).lower()
+    with _databases_lock:
+        if engine not in _databases:
+            db = SupabaseDatabase(create_backend(engine))
+            interval = float(_storage_setting("HEALTH_INTERVAL", 30))
+            if interval > 0:
+                db.health_probe = BackendHealthProbe(db.backend, interval)
+            _databases[engine] = db
+        return _databases[engine]
@@ -0,0 +1,309 @@
+-- supabase_migrations.sql
+-- Server-side objects used by supabase_db.py.
+-- Run in the Supabase SQL editor; every statement is safe to re-run.
+-- storage_backends.SQLITE_SCHEMA holds the equivalent objects for the local engine.
+
+-- ------------------------------------------------------------------
+-- Per-item usage totals (SupabaseDatabase.get_usage_stats)
+-- ------------------------------------------------------------------
+create or replace view public.usage_stats_by_item
+with (security_invoker = on) as
+select
+    item_name,
+    sum(units_used)::bigint as total_units_used,
+    count(usage_date)::bigint as usage_count
+from public.usage_logs
+group by item_name;
+
+grant select on public.usage_stats_by_item to anon, authenticated;
+
+-- ------------------------------------------------------------------
+-- Atomic usage logging (SupabaseDatabase.log_usage)
+-- Locks the inventory row, decrements stock (never below zero) and
+-- inserts the usage row in one transaction. Returns null, writing
+-- nothing, when the item does not exist.
+-- ------------------------------------------------------------------
+create or replace function public.record_usage(
+    p_item_id text,
+    p_units_used integer,
+    p_item_name text default null,
+    p_purpose text default null,
+    p_used_by text default null,
+    p_department text default null,
+    p_notes text default null,
+    p_usage_date timestamptz default now()
+)
+returns jsonb
+language plpgsql
+security invoker
+as $$
+declare
+    v_old_quantity public.inventory.quantity%type;
+    v_new_quantity public.inventory.quantity%type;
+    v_usage public.usage_logs;
+begin
+    select quantity into v_old_quantity
+    from public.inventory
+    where item_id = p_item_id
+    for update;
+
+    if not found then
+        return null;
+    end if;
+
+    v_old_quantity := coalesce(v_old_quantity, 0);
+    v_new_quantity := greatest(v_old_quantity - p_units_used, 0);
+
+    update public.inventory
+    set quantity = v_new_quantity
+    where item_id = p_item_id;
+
+    insert into public.usage_logs
+        (item_id, item_name, units_used, purpose, used_by, department, notes, usage_date)
+    values
+        (p_item_id, p_item_name, p_units_used, p_purpose, p_used_by, p_department, p_notes, p_usage_date)
+    returning * into v_usage;
+
+    return jsonb_build_object(
+        'usage', to_jsonb(v_usage),
+        'old_quantity', v_old_quantity,
+        'new_quantity', v_new_quantity
+    );
+end;
+$$;
+
+grant execute on function public.record_usage(text, integer, text, text, text, text, text, timestamptz)
+    to anon, authenticated;
+
+-- ------------------------------------------------------------------
+-- Row versions for optimistic concurrency (SupabaseDatabase.update_inventory_item)
+-- Editors update "where version = <version they loaded>" and set
+-- version + 1 themselves. Every other update (record_usage, bulk
+-- resets) gets its version bumped here, so stale editors still conflict.
+-- ------------------------------------------------------------------
+alter table public.inventory add column if not exists version integer not null default 1;
+alter table public.inventory add column if not exists updated_at timestamptz not null default now();
+
+create or replace function public.inventory_bump_version()
+returns trigger
+language plpgsql
+as $$
+begin
+    if new.version is not distinct from old.version then
+        new.version := old.version + 1;
+    end if;
+    new.updated_at := now();
+    return new;
+end;
+$$;
+
+drop trigger if exists inventory_bump_version on public.inventory;
+create trigger inventory_bump_version
+    before update on public.inventory
+    for each row execute function public.inventory_bump_version();
+
+-- ------------------------------------------------------------------
+-- Redundant audit cleanup (SupabaseDatabase.cleanup_duplicate_audits)
+-- Finds and deletes UPDATE audit rows that changed nothing in one
+-- statement. Returns the number of rows deleted.
+-- ------------------------------------------------------------------
+create or replace function public.delete_redundant_audits()
+returns integer
+language sql
+security invoker
+as $$
+    with deleted as (
+        delete from public.audit_logs
+        where action_type = 'UPDATE'
+          and old_value is not null
+          and old_value <> ''
+          and old_value = new_value
+        returning 1
+    )
+    select count(*)::integer from deleted;
+$$;
+
+grant execute on function public.delete_redundant_audits() to anon, authenticated;
+
+-- ------------------------------------------------------------------
+-- Record timelines (SupabaseDatabase.get_audit_logs with record_id)
+-- ------------------------------------------------------------------
+create index if not exists audit_logs_table_record_ts_idx
+    on public.audit_logs (table_name, record_id, "timestamp" desc);
+
+-- ------------------------------------------------------------------
+-- Incremental inventory sync (inventory_sync.InventorySync)
+-- Clients ask for rows with updated_at after their watermark, and for
+-- item_ids that left the table (deleted or renamed) since then.
+-- Re-adding an item clears its tombstone.
+-- ------------------------------------------------------------------
+create index if not exists inventory_updated_at_idx
+    on public.inventory (updated_at);
+
+create table if not exists public.inventory_tombstones (
+    item_id text primary key,
+    deleted_at timestamptz not null default now()
+);
+
+create index if not exists inventory_tombstones_deleted_at_idx
+    on public.inventory_tombstones (deleted_at);
+
+create or replace function public.inventory_tombstone()
+returns trigger
+language plpgsql
+security definer
+set search_path = public
+as $$
+begin
+    if tg_op = 'DELETE' or (tg_op = 'UPDATE' and new.item_id is distinct from old.item_id) then
+        insert into public.inventory_tombstones (item_id, deleted_at)
+        values (old.item_id, now())
+        on conflict (item_id) do update set deleted_at = excluded.deleted_at;
+    end if;
+
+    if tg_op = 'DELETE' then
+        return old;
+    end if;
+
+    delete from public.inventory_tombstones where item_id = new.item_id;
+    return new;
+end;
+$$;
+
+drop trigger if exists inventory_tombstone on public.inventory;
+create trigger inventory_tombstone
+    after insert or update of item_id or delete on public.inventory
+    for each row execute function public.inventory_tombstone();
+
+grant select on public.inventory_tombstones to anon, authenticated;
+
+-- ------------------------------------------------------------------
+-- Data versions (SupabaseDatabase.get_data_versions / check_data_versions)
+-- One change counter per table, bumped once per writing statement, so
+-- the app can ask "did anything change?" with one tiny query before
+-- refetching. Writers of the same table serialise briefly on its row.
+-- ------------------------------------------------------------------
+create table if not exists public.data_versions (
+    table_name text primary key,
+    version bigint not null default 0,
+    updated_at timestamptz not null default now()
+);
+
+insert into public.data_versions (table_name)
+values ('inventory'), ('usage_logs'), ('audit_logs'), ('users')
+on conflict (table_name) do nothing;
+
+create or replace function public.bump_data_version()
+returns trigger
+language plpgsql
+security definer
+set search_path = public
+as $$
+begin
+    update public.data_versions
+    set version = version + 1, updated_at = now()
+    where table_name = tg_table_name;
+    return null;
+end;
+$$;
+
+do $$
+declare
+    t text;
+begin
+    foreach t in array array['inventory', 'usage_logs', 'audit_logs', 'users'] loop
+        execute format('drop trigger if exists %I on public.%I', t || '_data_version', t);
+        execute format(
+            'create trigger %I after insert or update or delete or truncate on public.%I '
+            'for each statement execute function public.bump_data_version()',
+            t || '_data_version', t
+        );
+    end loop;
+end;
+$$;
+
+grant select on public.data_versions to anon, authenticated;
+
+-- ------------------------------------------------------------------
+-- Usage trends (SupabaseDatabase.get_usage_trends / get_usage_breakdown)
+-- Bucketed over the whole [p_start, p_end) window in the database, so
+-- the result size follows buckets x items, not the number of events.
+-- Both return one jsonb array, which PostgREST's max-rows cap does not
+-- truncate.
+-- ------------------------------------------------------------------
+create index if not exists usage_logs_usage_date_idx
+    on public.usage_logs (usage_date);
+
+create or replace function public.usage_trends(
+    p_start timestamptz default null,
+    p_end timestamptz default null,
+    p_granularity text default 'day',
+    p_items text[] default null,
+    p_top_n integer default null
+)
+returns jsonb
+language sql
+stable
+security invoker
+as $$
+    with windowed as (
+        select u.item_name, u.units_used, u.usage_date
+        from public.usage_logs u
+        where (p_start is null or u.usage_date >= p_start)
+          and (p_end is null or u.usage_date < p_end)
+          and (p_items is null or u.item_name = any(p_items))
+    ),
+    top_items as (
+        select w.item_name
+        from windowed w
+        group by w.item_name
+        order by sum(w.units_used) desc, w.item_name
+        limit p_top_n
+    ),
+    buckets as (
+        select date_trunc(p_granularity, w.usage_date)::date as bucket,
+               w.item_name,
+               sum(w.units_used)::bigint as units_used,
+               count(*)::bigint as usage_count
+        from windowed w
+        where w.item_name in (select item_name from top_items)
+        group by 1, 2
+    )
+    select coalesce(jsonb_agg(to_jsonb(b) order by b.bucket, b.item_name), '[]'::jsonb)
+    from buckets b;
+$$;
+
+create or replace function public.usage_breakdown(
+    p_start timestamptz default null,
+    p_end timestamptz default null,
+    p_dimension text default 'department',
+    p_items text[] default null
+)
+returns jsonb
+language sql
+stable
+security invoker
+as $$
+    with groups as (
+        select case p_dimension
+                   when 'department' then coalesce(u.department, '')
+                   when 'purpose' then coalesce(u.purpose, '')
+                   when 'weekday' then (extract(isodow from u.usage_date)::integer - 1)::text
+               end as dimension,
+               u.item_name,
+               sum(u.units_used)::bigint as units_used,
+               count(*)::bigint as usage_count
+        from public.usage_logs u
+        where (p_start is null or u.usage_date >= p_start)
+          and (p_end is null or u.usage_date < p_end)
+          and (p_items is null or u.item_name = any(p_items))
+        group by 1, 2
+    )
+    select coalesce(jsonb_agg(to_jsonb(g) order by g.dimension, g.item_name), '[]'::jsonb)
+    from groups g;
+$$;
+
+grant execute on function public.usage_trends(timestamptz, timestamptz, text, text[], integer)
+    to anon, authenticated;
+grant execute on function public.usage_breakdown(timestamptz, timestamptz, text, text[])
+    to anon, authenticated;